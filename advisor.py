@@ -0,0 +1,438 @@
+#!/home/devon/anaconda2/bin/python
+
+# advisor.py
+# a long-running local advice service, so that many client processes can share
+# one set of warm solver caches. Clients send one JSON request per line over
+# localhost TCP or a Unix socket, e.g.
+#
+#   {"id": 1, "numdecks": 6, "shoe": [24,24,24,24,24,24,24,24,95,24],
+#    "dealer": 10, "hand": [10, 6], "rules": {"errtol": 1e-8}, "deadline": 0.05}
+#
+# where shoe holds the remaining counts of 2..11 (a fresh shoe if it is left out),
+# and get back one JSON line with the action and its expected value. Concurrent
+# requests are gathered into batches, identical ones are solved once, and the
+# rest are spread over a pool of solver processes. Every answer goes into one
+# result cache shared by all clients. If a request has a deadline and the solver
+# has not answered in time, it is answered from the stored tables instead, and
+# the solve carries on to warm the cache. {"op": "metrics"} returns throughput
+# and latency numbers.
+#
+# usage: ./advisor.py serve [--port 7766 | --unix /tmp/coca.sock] [--workers 4]
+#        ./advisor.py load [--port 7766 | --unix /tmp/coca.sock] [--clients 8] [--requests 2000]
+#        ./advisor.py metrics [--port 7766 | --unix /tmp/coca.sock]
+
+import numpy as np
+import multiprocessing
+import collections
+import SocketServer
+import threading
+import argparse
+import socket
+import signal
+import Queue
+import json
+import time
+import coca
+
+
+# the canonical form of a request, used as the result cache key
+def requestKey(request):
+    numdecks = int(request.get('numdecks', 6))
+    shoe = coca.Shoe(numdecks=numdecks)
+    if numdecks > 0 and request.get('shoe') is not None:
+        if len(request['shoe']) != 10:
+            raise ValueError("shoe must hold the counts of 2..11.")
+        for c in xrange(10):
+            shoe.num[c+2] = int(request['shoe'][c])
+        if min(shoe.num[2:12]) < 0 or sum(shoe.num[2:12]) == 0:
+            raise ValueError("shoe counts must not be negative, and some cards must be left.")
+    dealer = int(request['dealer'])
+    hand = sorted(int(card) for card in request['hand'])
+    if len(hand) < 2 or min(hand+[dealer]) < 2 or max(hand+[dealer]) > 11:
+        raise ValueError("hand must hold at least two cards, and all cards must be 2..11.")
+    my_hand = coca.Hand()
+    for card in hand:
+        my_hand.addCard(card)
+    if my_hand.points > 21 and not my_hand.ispair:
+        raise ValueError("hand must not be bust, it has %d points." % my_hand.points)
+    rules = coca.rulesArgs(coca.Rules(**request.get('rules', {})))
+    return (numdecks, tuple(shoe.num[2:12]), dealer, tuple(hand),
+            json.dumps(rules, sort_keys=True))
+
+# the shoe, hands and rules for a request key
+def keyProblem(key):
+    numdecks, counts, dealer, hand, rules = key
+    shoe = coca.Shoe(numdecks=numdecks)
+    if numdecks > 0:
+        for c in xrange(10):
+            shoe.num[c+2] = counts[c]
+        shoe.total = sum(counts)
+    dealer_hand = coca.Hand()
+    dealer_hand.addCard(dealer)
+    my_hand = coca.Hand()
+    for card in hand:
+        my_hand.addCard(card)
+    return shoe, dealer_hand, my_hand, coca.Rules(**json.loads(rules))
+
+# the rules as they apply to this hand: doubling and surrender are
+# only allowed on the first two cards, and insurance is never advised
+def handRules(my_hand, rules):
+    rules = coca.Rules.from_buffer_copy(rules)
+    if my_hand.numcards > 2:
+        rules.allowed[coca.DOUBLE] = 0
+        rules.allowed[coca.SURRENDER] = 0
+    rules.allowed[coca.INSURANCE] = 0
+    return rules
+
+
+# worker process setup: each keeps its own transposition cache warm between batches
+def initWorker(cache_capacity):
+    coca.enableCache(capacity=cache_capacity)
+
+# solves one request key in a worker process
+def solveKey(key):
+    try:
+        shoe, dealer_hand, my_hand, rules = keyProblem(key)
+        action, exp = coca.getAction(shoe, dealer_hand, my_hand, rules=handRules(my_hand, rules))
+        return {'action': action, 'exp': exp[action], 'all_exp': list(exp)}
+    except Exception as e:
+        return {'error': '%s: %s' % (type(e).__name__, e)}
+
+# answers a request key from the stored chart for its shoe and rules if
+# there is one, else from the built-in infinite-deck table
+def tableAnswer(key, store):
+    shoe, dealer_hand, my_hand, rules = keyProblem(key)
+    chart = store.lookup(shoe, rules)
+    if chart is None:
+        chart = coca.tables['default_table']
+    allowed = np.array(handRules(my_hand, rules).allowed, dtype=bool)
+    allowed[coca.SPLIT] &= bool(my_hand.ispair and my_hand.depth < 2+rules.max_split_depth)
+    action, exp = coca.lookupActions(dealer_hand.points, my_hand.points, my_hand.softness > 0,
+            my_hand.ispair, chart, allowed=allowed)
+    exp = float(exp)
+    return {'action': int(action), 'exp': None if np.isnan(exp) else exp, 'all_exp': None}
+
+
+# a request waiting on the solver
+class Pending(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+    def finish(self, result):
+        self.result = result
+        self.done.set()
+
+
+# gathers requests into batches for the worker pool,
+# and keeps the shared result cache and the metrics.
+# Each key in a batch is its own pool task, answered as soon as it is solved.
+# No request waits on the solver longer than max_deadline, 
+# whatever its own deadline or the default. A task that fails in the pool,
+# or is not back after solve_timeout seconds (e.g. its worker died), is
+# answered with an error, so that the next request for it is solved afresh.
+class Advisor(object):
+
+    def __init__(self, workers=None, batch_window=0.002, max_batch=256, cache_size=1<<18,
+            worker_cache=1<<20, default_deadline=None, max_deadline=10.0, solve_timeout=60.0):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self.default_deadline = default_deadline
+        self.max_deadline = max_deadline
+        self.solve_timeout = solve_timeout
+        self.pool = multiprocessing.Pool(processes=workers, initializer=initWorker,
+                initargs=(worker_cache,))
+        self.store = coca.getTableStore()
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.inflight = {}
+        self.tasks = {}
+        self.numtasks = 0
+        self.closed = threading.Event()
+        self.queue = Queue.Queue()
+        self.tstart = time.time()
+        self.counts = collections.Counter()
+        self.latencies = collections.deque(maxlen=100000)
+        self.dispatcher = threading.Thread(target=self.dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    # answers one request dict, waiting at most its deadline for the solver
+    def advise(self, request):
+        tstart = time.time()
+        key = requestKey(request)
+        source = 'cache'
+        with self.lock:
+            result = self.cache.get(key)
+            if result is None:
+                pending = self.inflight.get(key)
+                if pending is None:
+                    pending = self.inflight[key] = Pending()
+                    self.queue.put(key)
+            else:
+                self.cache[key] = self.cache.pop(key) # most recently used
+        if result is None:
+            source = 'solver'
+            deadline = request.get('deadline', self.default_deadline)
+            if deadline is None or deadline > self.max_deadline:
+                deadline = self.max_deadline
+            if not pending.done.wait(deadline):
+                source = 'table'
+                result = tableAnswer(key, self.store)
+            else:
+                result = pending.result
+        seconds = time.time()-tstart
+        with self.lock:
+            self.counts['requests'] += 1
+            self.counts[source] += 1
+            self.counts['errors'] += 'error' in result
+            self.latencies.append(seconds)
+        answer = {'id': request.get('id'), 'source': source, 'seconds': seconds}
+        answer.update(result)
+        return answer
+
+    # collects queued keys for up to batch_window and sends them to the pool,
+    # checking on the tasks already sent whenever the queue is idle
+    def dispatch(self):
+        while not self.closed.is_set():
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+            except Queue.Empty:
+                self.reap()
+                continue
+            tstop = time.time()+self.batch_window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get(timeout=max(tstop-time.time(), 0.0)))
+                except Queue.Empty:
+                    break
+            with self.lock:
+                self.counts['batches'] += 1
+                self.counts['solved'] += len(batch)
+                for key in batch:
+                    self.numtasks += 1
+                    task = self.pool.apply_async(solveKey, (key,), callback=(lambda result,
+                            key=key, serial=self.numtasks: self.finish(key, result, serial)))
+                    self.tasks[key] = (task, time.time(), self.numtasks)
+            self.reap()
+
+    # answers the tasks that failed in the pool or are overdue with an error
+    def reap(self):
+        with self.lock:
+            tasks = self.tasks.items()
+        for key, (task, tstart, serial) in tasks:
+            if task.ready() and not task.successful():
+                try:
+                    task.get(0)
+                except Exception as e:
+                    self.finish(key, {'error': '%s: %s' % (type(e).__name__, e)}, serial)
+            elif not task.ready() and time.time()-tstart > self.solve_timeout:
+                self.finish(key, {'error': 'the solver did not answer in %g s' % self.solve_timeout},
+                        serial)
+
+    # caches a key's result and wakes the requests waiting on it. serial 
+    # numbers the task, so that a result coming back after its task was reaped 
+    # is still cached but leaves a newer task for the same key alone.
+    def finish(self, key, result, serial):
+        with self.lock:
+            if key in self.tasks and self.tasks[key][2] == serial:
+                self.tasks.pop(key)
+            if 'error' not in result:
+                self.cache[key] = result
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            pending = self.inflight.pop(key, None)
+            if pending is not None:
+                pending.finish(result)
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            counts = dict(self.counts)
+            cached = len(self.cache)
+        seconds = time.time()-self.tstart
+        requests = counts.get('requests', 0)
+        metrics = {'uptime': seconds, 'requests': requests, 'requests_per_second': requests/seconds,
+                'cache_hits': counts.get('cache', 0), 'solver': counts.get('solver', 0),
+                'table_fallbacks': counts.get('table', 0), 'errors': counts.get('errors', 0),
+                'solved': counts.get('solved', 0), 'batches': counts.get('batches', 0),
+                'mean_batch': counts.get('solved', 0)/float(max(counts.get('batches', 0), 1)),
+                'cached_results': cached, 'workers': self.workers}
+        if latencies.size:
+            metrics.update({'latency_mean': latencies.mean(), 'latency_max': latencies.max(),
+                    'latency_p50': np.percentile(latencies, 50),
+                    'latency_p99': np.percentile(latencies, 99)})
+        return metrics
+
+    def close(self):
+        self.closed.set()
+        self.dispatcher.join()
+        self.pool.terminate()
+        self.pool.join()
+
+
+# reads JSON requests from a connection, one per line, and writes one answer line each
+class AdvisorHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if request.get('op') == 'metrics':
+                    answer = self.server.advisor.metrics()
+                else:
+                    answer = self.server.advisor.advise(request)
+            except Exception as e:
+                answer = {'error': '%s: %s' % (type(e).__name__, e)}
+            self.wfile.write(json.dumps(answer)+'\n')
+            self.wfile.flush()
+
+class AdvisorTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class AdvisorUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def makeServer(advisor, port=7766, unix=None):
+    if unix is not None:
+        server = AdvisorUnixServer(unix, AdvisorHandler)
+    else:
+        server = AdvisorTCPServer(('127.0.0.1', port), AdvisorHandler)
+    server.advisor = advisor
+    return server
+
+
+# a blocking client, one request at a time on its own connection
+class AdvisorClient(object):
+
+    def __init__(self, port=7766, unix=None):
+        if unix is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(unix)
+        else:
+            self.sock = socket.create_connection(('127.0.0.1', port))
+        self.rfile = self.sock.makefile('rb')
+
+    def request(self, request):
+        self.sock.sendall(json.dumps(request)+'\n')
+        return json.loads(self.rfile.readline())
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+# random requests from num_states shoe states dealt from numdecks-deck shoes,
+# so that repeats exercise the result cache as real play would
+def loadRequests(num_requests, num_states=200, numdecks=6, deadline=None, seed=0):
+    rng = coca.Rng(seed=seed)
+    picks = np.random.RandomState(seed)
+    states = []
+    for depth in picks.randint(0, int(0.75*52*numdecks)+1, size=num_states):
+        shoe = coca.Shoe(numdecks=numdecks)
+        coca.drawCards(shoe, depth, rng=rng)
+        states.append(list(shoe.num[2:12]))
+    requests = []
+    for r in xrange(num_requests):
+        hand = [int(c) for c in picks.randint(2, 12, size=2)]
+        request = {'id': r, 'numdecks': numdecks, 'shoe': states[picks.randint(num_states)],
+                'dealer': int(picks.randint(2, 12)), 'hand': hand}
+        if deadline is not None:
+            request['deadline'] = deadline
+        requests.append(request)
+    return requests
+
+# sends requests from num_clients concurrent connections, and
+# returns the latency percentiles and throughput seen by the clients
+def runLoad(requests, num_clients=8, port=7766, unix=None):
+    latencies = [[] for c in xrange(num_clients)]
+    sources = collections.Counter()
+    lock = threading.Lock()
+    def client(c):
+        conn = AdvisorClient(port=port, unix=unix)
+        for request in requests[c::num_clients]:
+            tstart = time.time()
+            answer = conn.request(request)
+            latencies[c].append(time.time()-tstart)
+            with lock:
+                sources[answer.get('source', 'error')] += 1
+        conn.close()
+    threads = [threading.Thread(target=client, args=(c,)) for c in xrange(num_clients)]
+    tstart = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.time()-tstart
+    latencies = np.concatenate([np.array(l) for l in latencies])
+    return {'requests': len(latencies), 'seconds': seconds,
+            'requests_per_second': len(latencies)/seconds, 'sources': dict(sources),
+            'latency_p50': np.percentile(latencies, 50), 'latency_p99': np.percentile(latencies, 99),
+            'latency_max': latencies.max()}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serve blackjack advice, or load-test the service.')
+    parser.add_argument('command', choices=['serve', 'load', 'metrics'])
+    parser.add_argument('--port', type=int, default=7766, help='localhost TCP port')
+    parser.add_argument('--unix', default=None, help='Unix socket path, instead of TCP')
+    parser.add_argument('--workers', type=int, default=None, help='solver processes')
+    parser.add_argument('--batch-window', type=float, default=0.002,
+            help='seconds to gather a batch of requests')
+    parser.add_argument('--max-batch', type=int, default=256, help='largest batch')
+    parser.add_argument('--cache-size', type=int, default=1<<18, help='cached results')
+    parser.add_argument('--deadline', type=float, default=None,
+            help='default seconds before falling back to the stored tables (serve), '
+            'or the deadline sent with each request (load)')
+    parser.add_argument('--max-deadline', type=float, default=10.0,
+            help='longest any request waits on the solver (serve)')
+    parser.add_argument('--solve-timeout', type=float, default=60.0,
+            help='seconds before a solve is given up on as lost (serve)')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent load clients')
+    parser.add_argument('--requests', type=int, default=2000, help='load requests')
+    parser.add_argument('--states', type=int, default=200, help='distinct shoe states in the load')
+    parser.add_argument('--decks', type=int, default=6, help='decks in the load shoes')
+    parser.add_argument('--seed', type=int, default=0, help='load random seed')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        advisor = Advisor(workers=args.workers, batch_window=args.batch_window,
+                max_batch=args.max_batch, cache_size=args.cache_size,
+                default_deadline=args.deadline, max_deadline=args.max_deadline,
+                solve_timeout=args.solve_timeout)
+        server = makeServer(advisor, port=args.port, unix=args.unix)
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, stop)
+        print 'Serving on %s' % (args.unix or '127.0.0.1:%d' % args.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            advisor.close()
+
+    elif args.command == 'load':
+        requests = loadRequests(args.requests, num_states=args.states, numdecks=args.decks,
+                deadline=args.deadline, seed=args.seed)
+        result = runLoad(requests, num_clients=args.clients, port=args.port, unix=args.unix)
+        print '%d requests in %.2f s, %.1f requests/s' % (result['requests'], result['seconds'],
+                result['requests_per_second'])
+        print 'latency p50 %.2f ms, p99 %.2f ms, max %.2f ms' % (1.0e3*result['latency_p50'],
+                1.0e3*result['latency_p99'], 1.0e3*result['latency_max'])
+        print 'answered from: %s' % ', '.join('%s %d' % s for s in sorted(result['sources'].items()))
+
+    else:
+        conn = AdvisorClient(port=args.port, unix=args.unix)
+        print json.dumps(conn.request({'op': 'metrics'}), indent=1, sort_keys=True)
+        conn.close()
@@ -22,101 +22,36 @@ rules = coca.Rules(allowed_actions=[1,1,1,1,1,0], max_split_depth=2, double_afte
         dealer_hits_soft_17=0, can_hit_split_aces=0, errtol=1.0e-5)
 strategy = coca.Strategy(type='optimal_infinite_deck')
 #strategy = coca.Strategy(type='optimal')
-best_action = np.empty((10, 34), dtype=np.int32)
-all_exp = np.empty((10, 34, 6), dtype=np.float64)
 tstart = time.time()
 
-# first, hard hands 
-print "\n-- Hard hands --"
-print "    Dealer:\t",
-for dealer_card in coca.allCards:
-    print ("%d\t\t\t"%dealer_card),
-print "\nMe:",
-for my_points in xrange(19, 4, -1):
-    print ("\n %d\t\t" % (my_points)), 
-    for dealer_card in coca.allCards:
-
-        # shuffle and deal
-        shoe.shuffle()
-        dealer_hand = coca.Hand()
-        dealer_hand.addCard(dealer_card)
-
-        # set the player hand artificially since there
-        # are many ways to make these hands
-        my_hand = coca.Hand()
-        my_hand.points = my_points
-        my_hand.numcards = 2
-        my_hand.depth = 2
-        my_hand.ispair = 0
-        
-        # get the best possible action and its expected value
-        action, exp =  coca.getAction(shoe, dealer_hand, my_hand, rules=rules, strategy=strategy)
-        #print exp
-        print_color_no_return("%s (%+.5f)\t" % (coca.actionLabels[action], exp[action]),
-                action_colors[action])
-        ind = coca.getChartIndFromCards(my_hand, dealer_hand)
-        best_action[ind] = action 
-        all_exp[ind] = exp 
-print 
+# solve the whole chart at once
+best_action, all_exp = coca.computeChart(shoe, rules=rules, strategy=strategy)
 
-# soft hands 
-print "\n-- Soft hands --"
-print "    Dealer:\t",
-for dealer_card in coca.allCards:
-    print ("%d\t\t\t"%dealer_card),
-print "\nMe:",
-for my_points in xrange(10, 1, -1):
-    print ("\n %d\t\t" % (my_points)), 
-    for dealer_card in coca.allCards:
-
-        # shuffle the shoe and deal the hand
-        shoe.shuffle()
-        dealer_hand = coca.Hand()
-        my_hand = coca.Hand()
-        dealer_hand.addCard(dealer_card)
-        my_hand.addCard(11)
-        my_hand.addCard(my_points)
-
-        # get the best possible action and its expected value
-        action, exp =  coca.getAction(shoe, dealer_hand, my_hand, rules=rules, strategy=strategy)
-        print_color_no_return("%s (%+.5f)\t" % (coca.actionLabels[action], exp[action]),
-                action_colors[action])
-        ind = coca.getChartIndFromCards(my_hand, dealer_hand)
-        best_action[ind] = action 
-        all_exp[ind] = exp 
-print 
+# time it
+tstop = time.time()
 
-# pairs 
-print "\n-- Pairs --"
-print "    Dealer:\t",
-for dealer_card in coca.allCards:
-    print ("%d\t\t\t"%dealer_card),
-print "\nMe:",
-for my_points in xrange(11, 1, -1):
-    #print ("\n%s,%s\t\t" % (coca.cardLabels[my_points], coca.cardLabels[my_points])), 
-    print ("\n %d\t\t" % (2*my_points)), 
+# print a chart section, rows given as (label, chart index)
+def print_section(title, rows):
+    print "\n-- %s --" % title
+    print "    Dealer:\t",
     for dealer_card in coca.allCards:
-
-        # shuffle the shoe and deal the hand
-        shoe.shuffle()
-        dealer_hand = coca.Hand()
-        my_hand = coca.Hand()
-        dealer_hand.addCard(dealer_card)
-        my_hand.addCard(my_points)
-        my_hand.addCard(my_points)
-
-        # get the best possible action and its expected value
-        action, exp =  coca.getAction(shoe, dealer_hand, my_hand, rules=rules, strategy=strategy)
-        print_color_no_return("%s (%+.5f)\t" % (coca.actionLabels[action], exp[action]),
-                action_colors[action])
-        ind = coca.getChartIndFromCards(my_hand, dealer_hand)
-        best_action[ind] = action 
-        all_exp[ind] = exp 
-print 
+        print ("%d\t\t\t"%dealer_card),
+    print "\nMe:",
+    for label, my_ind in rows:
+        print ("\n %d\t\t" % (label)), 
+        for dealer_ind in xrange(10):
+            action = best_action[dealer_ind, my_ind]
+            exp = all_exp[dealer_ind, my_ind]
+            print_color_no_return("%s (%+.5f)\t" % (coca.actionLabels[action], exp[action]),
+                    action_colors[action])
+    print 
+
+# first, hard hands, then soft hands and pairs
+print_section("Hard hands", [(my_points, 19-my_points) for my_points in xrange(19, 4, -1)])
+print_section("Soft hands", [(my_points, 25-my_points) for my_points in xrange(10, 1, -1)])
+print_section("Pairs", [(2*my_points, 35-my_points) for my_points in xrange(11, 1, -1)])
 print 
 
-# time it
-tstop = time.time()
 print "elapsed time = %f" % (tstop-tstart)
 print 
 
@@ -0,0 +1,402 @@
+#!/home/devon/anaconda2/bin/python
+
+# benchmark.py
+# times the solver and the simulator, and checks their results against
+# the reference numbers in tables/benchmark_reference.json so that speed
+# work cannot silently change the strategy. Those are a snapshot of this 
+# code's own output, so the 'tables' group also checks the solver against
+# sources it was not generated from: the hand-entered infinite-deck basic 
+# strategy, published dealer outcome probabilities, and a finite-deck chart's
+# house edge summed over every deal solved on its own. Writes everything 
+# as JSON. Exits nonzero if any check fails.
+#
+# usage: ./benchmark.py [--out results.json] [--only cells charts errtol exact tables sim]
+#        ./benchmark.py --update-reference
+#        ./benchmark.py --compare old_results.json
+
+import numpy as np
+import multiprocessing
+import argparse
+import platform
+import json
+import time
+import sys
+import os
+import coca
+
+referencePath = '%s/tables/benchmark_reference.json' % os.path.dirname(os.path.abspath(__file__))
+
+# single cells, as (name, player cards, dealer card), solved on a 6-deck shoe
+benchCells = [
+    ('hard16_v10', [10, 6], 10),
+    ('soft18_v9', [11, 7], 9),
+    ('hard11_v6', [7, 4], 6),
+    ('pair8_v10', [8, 8], 10),
+    ('pairA_v6', [11, 11], 6),
+]
+
+# full charts, by number of decks (-1 for an infinite shoe)
+benchDecks = [-1, 1, 2, 6, 8]
+
+# errtol values swept on the infinite-deck chart
+benchErrtols = [1.0e-3, 1.0e-4, 1.0e-5, 1.0e-6]
+
+# charts also solved exactly, by number of decks
+exactDecks = [-1, 1]
+
+# Monte Carlo tables, as (number of seats, rounds)
+benchGames = [(1, 1000000), (4, 250000)]
+
+# independent tables over the process pool, as (tables, seats, rounds per table)
+benchPool = (8, 4, 250000)
+
+# the pair rows of the chart, A,A first
+pairRows = range(24, 34)
+
+# the rules the built-in tables were generated with (see basic_strategy_infinite_deck.py)
+tableRules = dict(allowed_actions=[1,1,1,1,1,0], max_split_depth=2, double_after_split=1,
+        dealer_hits_soft_17=0, can_hit_split_aces=0, errtol=1.0e-5)
+
+# the cells, as (dealer card, chart row), where the optimal solver should differ 
+# from the built-in table, which is basic strategy for a dealer who peeks for 
+# blackjack. The solver's game has no hole card, so a dealer blackjack takes 
+# every bet, and surrender is early. Against an ace that makes surrendering 
+# hard 5-7 and 3,3, and hitting soft 18, correct.
+tableDeviations = [(11, 12), (11, 13), (11, 14), (11, 18), (11, 32)]
+
+# the dealer's final hand {17, 18, 19, 20, 21, blackjack, bust} by up card 2-A, 
+# infinite deck, dealer stands on soft 17, as published by the Wizard of Odds
+# (wizardofodds.com/games/blackjack/appendix/2a/)
+publishedDealer = np.array([
+    [0.139809, 0.134907, 0.129655, 0.124026, 0.117993, 0.000000, 0.353608],
+    [0.135034, 0.130482, 0.125581, 0.120329, 0.114700, 0.000000, 0.373875],
+    [0.130490, 0.125938, 0.121386, 0.116485, 0.111233, 0.000000, 0.394468],
+    [0.122251, 0.122251, 0.117700, 0.113148, 0.108246, 0.000000, 0.416404],
+    [0.165438, 0.106267, 0.106267, 0.101715, 0.097163, 0.000000, 0.423150],
+    [0.368566, 0.137797, 0.078625, 0.078625, 0.074074, 0.000000, 0.262312],
+    [0.128567, 0.359336, 0.128567, 0.069395, 0.069395, 0.000000, 0.244741],
+    [0.119995, 0.119995, 0.350765, 0.119995, 0.060824, 0.000000, 0.228425],
+    [0.111424, 0.111424, 0.111424, 0.342194, 0.034501, 0.076923, 0.212109],
+    [0.130789, 0.130789, 0.130789, 0.130789, 0.053866, 0.307692, 0.115286]])
+
+# published to six decimals
+publishedTol = 1.0e-6
+
+
+# an action chart as 10 strings of 34 digits, for compact JSON
+def actionStrings(best_action):
+    return [''.join(str(a) for a in row) for row in best_action]
+
+def actionArray(strings):
+    return np.array([[int(a) for a in row] for row in strings], dtype=np.int32)
+
+# the expected value of the chosen action in every chart cell
+def bestExp(best_action, all_exp):
+    return np.choose(best_action, np.rollaxis(np.asarray(all_exp), -1))
+
+
+# times cold single-cell solves with getAction, and counts their solver nodes
+def benchmarkCells(errtol, repeat=3):
+    rules = coca.Rules(errtol=errtol)
+    results = {}
+    for name, cards, dealer_card in benchCells:
+        shoe = coca.Shoe(numdecks=6)
+        my_hand = coca.Hand()
+        dealer_hand = coca.Hand()
+        for card in cards:
+            coca.dealCardToHand(shoe, my_hand, card, way='choose')
+        coca.dealCardToHand(shoe, dealer_hand, dealer_card, way='choose')
+        times = []
+        for trial in xrange(repeat):
+            coca.clearCache()
+            tstart = time.time()
+            action, exp = coca.getAction(shoe, dealer_hand, my_hand, rules=rules)
+            times.append(time.time()-tstart)
+        coca.clearCache()
+        coca.resetStats()
+        coca.enableStats()
+        coca.getAction(shoe, dealer_hand, my_hand, rules=rules)
+        coca.disableStats()
+        stats = coca.getSolverStats()
+        results['cell_%s' % name] = {'seconds': min(times), 'action': action,
+                'exp': list(exp[:5]), 'nodes': stats.nodes, 'dealer_nodes': stats.dealer_nodes,
+                'pruned': stats.pruned+stats.dealer_pruned}
+    return results
+
+# times one full chart solve
+def benchmarkChart(numdecks, errtol, threads, exact=False):
+    shoe = coca.Shoe(numdecks=numdecks)
+    rules = coca.Rules(errtol=errtol)
+    tstart = time.time()
+    best_action, all_exp, times = coca.computeChart(shoe, rules=rules, threads=threads,
+            return_times=True, exact=exact)
+    seconds = time.time()-tstart
+    slowest = np.unravel_index(np.argmax(times), times.shape)
+    result = {'seconds': seconds, 'cell_seconds': times.sum(),
+            'pair_seconds': times[:,pairRows].sum(), 'pair_row_seconds': list(times[:,pairRows].sum(axis=0)),
+            'slowest_cell': [int(slowest[0]), int(slowest[1])], 'slowest_seconds': times.max(),
+            'house_edge': coca.houseEdge(shoe, all_exp, best_action=best_action),
+            'actions': actionStrings(best_action)}
+    return result, best_action, all_exp
+
+def benchmarkCharts(errtol, threads):
+    results = {}
+    for numdecks in benchDecks:
+        name = 'chart_%s' % ('inf' if numdecks < 0 else '%ddeck' % numdecks)
+        results[name] = benchmarkChart(numdecks, errtol, threads)[0]
+    return results
+
+# sweeps errtol on the infinite-deck chart, measuring the largest change
+# in any cell's best expected value against the finest errtol
+def benchmarkErrtol(threads):
+    results = {}
+    charts = {}
+    for errtol in benchErrtols:
+        name = 'errtol_%.0e' % errtol
+        results[name], best_action, all_exp = benchmarkChart(-1, errtol, threads)
+        charts[name] = bestExp(best_action, all_exp)
+    finest = charts['errtol_%.0e' % min(benchErrtols)]
+    for name in charts:
+        results[name]['max_exp_error'] = np.abs(charts[name]-finest).max()
+    return results
+
+# solves charts exactly, measuring the largest error in any cell's
+# best expected value at the given errtol
+def benchmarkExact(errtol, threads):
+    results = {}
+    for numdecks in exactDecks:
+        name = 'exact_%s' % ('inf' if numdecks < 0 else '%ddeck' % numdecks)
+        results[name], exact_action, exact_exp = benchmarkChart(numdecks, errtol, threads,
+                exact=True)
+        best_action, all_exp = coca.computeChart(coca.Shoe(numdecks=numdecks),
+                rules=coca.Rules(errtol=errtol), threads=threads)
+        results[name]['errtol_max_exp_error'] = np.abs(bestExp(best_action, all_exp)
+                -bestExp(exact_action, exact_exp)).max()
+    return results
+
+# the house edge of standing on every two-card hand, infinite deck,
+# worked out from the published dealer outcomes alone
+def publishedStandEdge():
+    prob = np.array(8*[1.0/13] + [4.0/13, 1.0/13])
+    edge = 0.0
+    for d in xrange(10):
+        for c0 in xrange(10):
+            for c1 in xrange(10):
+                points = c0+c1+4
+                if points > 21:
+                    points -= 10
+                if points == 21:
+                    payoff = 1.5*np.ones(7)
+                    payoff[5] = 0.0
+                else:
+                    payoff = np.array([np.sign(points-t) for t in xrange(17, 22)] + [-1.0, 1.0])
+                edge -= prob[d]*prob[c0]*prob[c1]*np.dot(payoff, publishedDealer[d])
+    return edge
+
+# solves the infinite-deck chart optimally and exactly, and compares it to the hand-entered 
+# built-in table, and the solver's dealer outcomes and house edge for standing 
+# on everything to the published dealer outcomes. Also solves a 1-deck chart 
+# at errtol, and compares its house edge to the one summed deal by deal.
+def benchmarkTables(errtol, threads):
+    shoe = coca.Shoe(numdecks=-1)
+    stored_action, stored_exp = coca.tables['default_table']
+    tstart = time.time()
+    rules = coca.Rules(**dict(tableRules, errtol=0.0))
+    best_action, all_exp = coca.computeChart(shoe, rules=rules, strategy=coca.Strategy(),
+            threads=threads, exact=True)
+    seconds = time.time()-tstart
+    mismatches = set((d+2, m) for d, m in zip(*np.nonzero(best_action != stored_action)))
+    dealer = np.zeros((10, 7), dtype=np.float64)
+    for d in xrange(10):
+        hand = coca.Hand()
+        hand.addCard(d+2)
+        dealer[d] = coca.dealerOutcomes(shoe, hand, rules=rules)
+    return {'tables_default_table': {'seconds': seconds,
+            'mismatched_cells': sorted(mismatches),
+            'unexpected_mismatches': len(mismatches ^ set(tableDeviations))},
+            'tables_published': {'seconds': 0.0,
+            'max_dealer_error': np.abs(dealer-publishedDealer).max(),
+            'stand_house_edge': coca.houseEdge(shoe, all_exp[:,:,coca.STAND]),
+            'stand_house_edge_published': publishedStandEdge()},
+            'tables_per_deal': perDealResult(1, errtol, threads)}
+
+# solves the chart and sums its house edge deal by deal
+def perDealResult(numdecks, errtol, threads):
+    shoe = coca.Shoe(numdecks=numdecks)
+    rules = coca.Rules(errtol=errtol)
+    tstart = time.time()
+    best_action, all_exp = coca.computeChart(shoe, rules=rules, threads=threads)
+    edge, composition_edge = perDealEdge(numdecks, best_action, rules)
+    return {'seconds': time.time()-tstart, 'errtol': errtol,
+            'chart_house_edge': coca.houseEdge(shoe, all_exp, best_action=best_action),
+            'per_deal_house_edge': edge, 'composition_house_edge': composition_edge}
+
+# the house edge of playing the chart on a finite shoe, summed deal by deal,
+# with every deal solved by getAction() on the shoe less its own cards rather than
+# averaged into its chart cell. Also returns the composition-dependent edge, 
+# playing each deal's own best action, which is at least as good as the chart's.
+def perDealEdge(numdecks, best_action, rules):
+    edge = 0.0
+    composition_edge = 0.0
+    for d in coca.allCards:
+        dealer_shoe = coca.Shoe(numdecks=numdecks)
+        dealer_hand = coca.Hand()
+        pd = coca.dealCardToHand(dealer_shoe, dealer_hand, d, way='choose')
+        for c0 in coca.allCards:
+            for c1 in coca.allCards[c0-2:]:
+                shoe = coca.Shoe.from_buffer_copy(dealer_shoe)
+                my_hand = coca.Hand()
+                p0 = coca.dealCardToHand(shoe, my_hand, c0, way='choose')
+                p1 = coca.dealCardToHand(shoe, my_hand, c1, way='choose')
+                if p0*p1 == 0.0:
+                    continue
+                action, exp = coca.getAction(shoe, dealer_hand, my_hand, rules=rules)
+                prb = pd*p0*p1*(1 if c0 == c1 else 2)
+                edge -= prb*exp[best_action[coca.getChartIndFromCards(my_hand, dealer_hand)]]
+                composition_edge -= prb*exp[action]
+    return edge, composition_edge
+
+# times seeded Monte Carlo rounds on a 6-deck table with the default strategy
+def benchmarkSim(seed=1234):
+    results = {}
+    for numseats, numrounds in benchGames:
+        game = coca.Game(num_decks=6, num_seats=numseats, seed=seed)
+        tstart = time.time()
+        game.play(numrounds)
+        seconds = time.time()-tstart
+        results['sim_%dseat' % numseats] = {'seconds': seconds, 'rounds': numrounds,
+                'rounds_per_second': numrounds/seconds, 'mean': list(game.mean)}
+    numtables, numseats, numrounds = benchPool
+    result = coca.simulateTables(numtables, numrounds, seed=seed, num_decks=6, num_seats=numseats)
+    results['sim_pool_%dtables' % numtables] = {'seconds': result['seconds'],
+            'rounds': numtables*numrounds, 'rounds_per_second': result['rounds_per_second'],
+            'processes': multiprocessing.cpu_count(), 'mean': list(result['seats']['mean'])}
+    return results
+
+benchGroups = [
+    ('cells', lambda args: benchmarkCells(args.errtol)),
+    ('charts', lambda args: benchmarkCharts(args.errtol, args.threads)),
+    ('errtol', lambda args: benchmarkErrtol(args.threads)),
+    ('exact', lambda args: benchmarkExact(args.errtol, args.threads)),
+    ('tables', lambda args: benchmarkTables(args.errtol, args.threads)),
+    ('sim', lambda args: benchmarkSim()),
+]
+
+
+# compares results against the reference numbers, returning a list of checks
+def checkResults(results, reference, exp_tol, edge_tol, sim_tol):
+    checks = []
+    def check(name, quantity, value, ref, tol):
+        checks.append({'name': name, 'quantity': quantity, 'value': value, 'reference': ref,
+                'tolerance': tol, 'ok': bool(abs(value-ref) <= tol)})
+    for name in sorted(results):
+        result = results[name]
+        if 'unexpected_mismatches' in result:
+            check(name, 'unexpected_mismatches', result['unexpected_mismatches'], 0, 0)
+        if 'max_dealer_error' in result:
+            check(name, 'max_dealer_error', result['max_dealer_error'], 0.0, publishedTol)
+            check(name, 'stand_house_edge', result['stand_house_edge'],
+                    result['stand_house_edge_published'], 10*publishedTol)
+        if 'per_deal_house_edge' in result:
+            check(name, 'chart_house_edge', result['chart_house_edge'],
+                    result['per_deal_house_edge'], result['errtol'])
+        if name not in reference:
+            continue
+        ref = reference[name]
+        if 'house_edge' in result:
+            check(name, 'house_edge', result['house_edge'], ref['house_edge'], edge_tol)
+            check(name, 'action_mismatches', int(np.sum(actionArray(result['actions'])
+                    != actionArray(ref['actions']))), 0, 0)
+        if 'exp' in result:
+            check(name, 'action', result['action'], ref['action'], 0)
+            check(name, 'max_exp_error', np.abs(np.array(result['exp'])-ref['exp']).max(),
+                    0.0, exp_tol)
+        if 'mean' in result:
+            check(name, 'max_mean_error', np.abs(np.array(result['mean'])-ref['mean']).max(),
+                    0.0, sim_tol)
+    return checks
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the solver and simulator.')
+    parser.add_argument('--out', default=None, help='write the results to this JSON file')
+    parser.add_argument('--only', nargs='+', default=[name for name, _ in benchGroups],
+            choices=[name for name, _ in benchGroups], help='benchmark groups to run')
+    parser.add_argument('--errtol', type=float, default=1.0e-5,
+            help='solver error tolerance for cells and charts')
+    parser.add_argument('--threads', type=int, default=multiprocessing.cpu_count(),
+            help='chart solver threads')
+    parser.add_argument('--exp-tol', type=float, default=1.0e-8,
+            help='allowed change in any expected value')
+    parser.add_argument('--edge-tol', type=float, default=1.0e-8,
+            help='allowed change in the house edge')
+    parser.add_argument('--sim-tol', type=float, default=1.0e-12,
+            help='allowed change in the seeded simulation means')
+    parser.add_argument('--compare', default=None,
+            help='print the speedup over the results in this JSON file (from --out)')
+    parser.add_argument('--update-reference', action='store_true',
+            help='overwrite the reference numbers with these results')
+    args = parser.parse_args()
+
+    results = {}
+    for name, bench in benchGroups:
+        if name in args.only:
+            tstart = time.time()
+            results.update(bench(args))
+            print '%s: %.1f s' % (name, time.time()-tstart)
+            sys.stdout.flush()
+
+    reference = {}
+    if os.path.exists(referencePath):
+        with open(referencePath) as f:
+            reference = json.load(f)
+    if args.update_reference:
+        reference.update(dict((name, result) for name, result in results.iteritems()
+                if not name.startswith('tables_')))
+        with open(referencePath, 'w') as f:
+            json.dump(reference, f, indent=1, sort_keys=True)
+        print 'Updated %s' % referencePath
+    checks = checkResults(results, reference, args.exp_tol, args.edge_tol, args.sim_tol)
+
+    print
+    for name in sorted(results):
+        result = results[name]
+        line = ' %-22s %9.4f s' % (name, result['seconds'])
+        if 'house_edge' in result:
+            line += '   house edge %+.5f pct' % (100.0*result['house_edge'])
+        if 'nodes' in result:
+            line += '   %d nodes' % result['nodes']
+        if 'errtol_max_exp_error' in result:
+            line += '   errtol error %.2g' % result['errtol_max_exp_error']
+        if 'rounds_per_second' in result:
+            line += '   %.3g rounds/s' % result['rounds_per_second']
+        print line
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)['results']
+        print
+        print 'Speedup over %s:' % args.compare
+        for name in sorted(set(results) & set(old)):
+            line = ' %-22s %7.2fx' % (name, old[name]['seconds']/results[name]['seconds'])
+            if 'pair_seconds' in results[name] and 'pair_seconds' in old[name]:
+                line += '   pair rows %.3f s -> %.3f s, %.2fx' % (old[name]['pair_seconds'],
+                        results[name]['pair_seconds'],
+                        old[name]['pair_seconds']/results[name]['pair_seconds'])
+            print line
+
+    print
+    failed = [c for c in checks if not c['ok']]
+    for c in failed:
+        print ' - FAIL: %s %s = %g, reference %g (tolerance %g)' % (c['name'], c['quantity'],
+                c['value'], c['reference'], c['tolerance'])
+    print '%d of %d checks passed' % (len(checks)-len(failed), len(checks))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(),
+                    'platform': platform.platform(), 'python': platform.python_version(),
+                    'numpy': np.__version__, 'engine_version': coca._caco.engine_version(),
+                    'threads': args.threads, 'errtol': args.errtol, 'results': results,
+                    'checks': checks}, f, indent=1, sort_keys=True)
+    sys.exit(1 if failed else 0)
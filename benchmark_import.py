@@ -0,0 +1,56 @@
+#!/home/devon/anaconda2/bin/python
+
+# benchmark_import.py
+# times 'import coca' in fresh interpreters and checks that the core 
+# solver API does not drag in plotting or load tables at import time.
+# Exits nonzero on a regression.
+#
+# usage: ./benchmark_import.py [max_seconds]
+
+import subprocess
+import sys
+import os
+
+# modules that must not be imported by the core API
+forbidden = ['matplotlib', 'scipy', 'cocaplot']
+
+# seconds allowed for importing coca, on top of importing numpy
+max_seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+num_trials = 10
+
+probe = '''
+import time, sys
+import numpy
+tstart = time.time()
+import coca
+from coca import Hand, Shoe, Rules, Strategy, getAction, dealCardToHand
+tstop = time.time()
+print tstop-tstart
+print ' '.join(sorted(m for m in sys.modules if m.split('.')[0] in %r))
+print len(dict.keys(coca.tables))
+''' % (forbidden,)
+
+path = os.path.dirname(os.path.abspath(__file__))
+times = []
+for trial in xrange(num_trials):
+    out = subprocess.check_output([sys.executable, '-c', probe], cwd=path).splitlines()
+    times.append(float(out[0]))
+    loaded = out[1].split()
+    numtables = int(out[2])
+
+best = min(times)
+print 'import coca: best %.1f ms, median %.1f ms over %d trials (limit %.1f ms)' % (1000*best,
+        1000*sorted(times)[num_trials/2], num_trials, 1000*max_seconds)
+failed = False
+if best > max_seconds:
+    print ' - FAIL: import is too slow'
+    failed = True
+if loaded:
+    print ' - FAIL: import pulled in %s' % ', '.join(loaded)
+    failed = True
+if numtables:
+    print ' - FAIL: strategy tables were loaded at import time'
+    failed = True
+if not failed:
+    print ' - OK'
+sys.exit(1 if failed else 0)
@@ -0,0 +1,321 @@
+#!/home/devon/anaconda2/bin/python
+
+# betting.py
+# sizes bets by true count. The edge and variance of a unit bet in each true
+# count bin are measured once per game setup (deck count, penetration, rules,
+# playing strategy and counting system) from simulated round records and kept
+# in an edge store. Bet spreads are then solved from those tables, for Kelly
+# betting or a risk of ruin, in vectorized numpy, so changing the bankroll or
+# the table limits does not need a new simulation.
+#
+# usage: ./betting.py --decks 6 --penetration 0.75 --bankroll 10000 --min 10 --max 500 --ror 0.05
+
+import numpy as np
+import multiprocessing
+import argparse
+import hashlib
+import json
+import time
+import os
+import coca
+
+
+# the number of rounds each worker job plays. Jobs play streams of one seed
+# in order, so the tables do not depend on the number of processes.
+jobRounds = 1<<21
+
+# the rules, strategy and counting setup of a game, as stored with its edges
+def gameMetadata(num_decks=6, penetration=0.75, rules=None, strategy=None, system='hilo',
+        num_seats=1, peek=True):
+    if rules is None:
+        rules = coca.Rules()
+    if strategy is None:
+        strategy = coca.Strategy(type='table', actions=coca.tables['default_table'][0])
+    if strategy.optimal:
+        raise ValueError("Bet sizing needs a strategy table, not the optimal solver.")
+    return {'num_decks': num_decks, 'penetration': penetration, 'system': system,
+            'num_seats': num_seats, 'peek': int(peek), 'allowed': list(rules.allowed),
+            'max_split_depth': rules.max_split_depth,
+            'double_after_split': rules.double_after_split,
+            'dealer_hits_soft_17': rules.dealer_hits_soft_17,
+            'can_hit_split_aces': rules.can_hit_split_aces,
+            'strategy': list(strategy.actions)}
+
+# the Game described by metadata, on one stream of the seed
+def metadataGame(meta, seed, stream):
+    rules = coca.Rules(allowed_actions=meta['allowed'], max_split_depth=meta['max_split_depth'],
+            double_after_split=meta['double_after_split'],
+            dealer_hits_soft_17=meta['dealer_hits_soft_17'],
+            can_hit_split_aces=meta['can_hit_split_aces'])
+    strategy = coca.Strategy(type='table',
+            actions=np.array(meta['strategy'], dtype=np.int32).reshape((10, 34)))
+    return coca.Game(num_decks=meta['num_decks'], num_seats=meta['num_seats'], rules=rules,
+            strategy=strategy, penetration=meta['penetration'], peek=meta['peek'], seed=seed,
+            stream=stream, system=meta['system'])
+
+# plays one job's rounds and sums the net result and its square per true count
+# bin over every seat. Counts outside the bins go to the end bins. Runs in a
+# worker process.
+def tallyJob(args):
+    meta, bins, seed, stream, num_rounds = args
+    game = metadataGame(meta, seed, stream)
+    step = bins[1]-bins[0]
+    rounds = np.zeros(len(bins), dtype=np.int64)
+    sums = np.zeros(len(bins), dtype=np.float64)
+    sums2 = np.zeros(len(bins), dtype=np.float64)
+    for chunk in game.playChunks(num_rounds):
+        b = np.clip(np.rint((chunk['true_count']-bins[0])/step), 0, len(bins)-1).astype(np.intp)
+        rounds += np.bincount(b, minlength=len(bins))
+        sums += np.bincount(b, weights=chunk['net'], minlength=len(bins))
+        sums2 += np.bincount(b, weights=chunk['net']**2, minlength=len(bins))
+    return rounds, sums, sums2
+
+# measures the frequency of each true count bin at the deal, and the mean (the
+# player's edge) and variance of a unit bet's net result in it, over num_rounds
+# rounds of the game. Returns a dict of (len(bins),) arrays with the game's metadata.
+def countEdges(meta, tc_range=(-10, 10), tc_step=1.0, num_rounds=1<<24, seed=0, processes=None):
+    bins = np.arange(tc_range[0], tc_range[1]+0.5*tc_step, tc_step)
+    jobs = [(meta, bins, seed, i, min(jobRounds, num_rounds-start))
+            for i, start in enumerate(xrange(0, num_rounds, jobRounds))]
+    tstart = time.time()
+    if processes == 1:
+        results = map(tallyJob, jobs)
+    else:
+        pool = multiprocessing.Pool(processes=processes)
+        try:
+            results = pool.map(tallyJob, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    rounds = np.sum([r[0] for r in results], axis=0)
+    sums = np.sum([r[1] for r in results], axis=0)
+    sums2 = np.sum([r[2] for r in results], axis=0)
+    n = np.maximum(rounds, 1)
+    edge = np.where(rounds > 0, sums/n, np.nan)
+    var = np.where(rounds > 1, (sums2-sums**2/n)/np.maximum(rounds-1, 1), np.nan)
+    return {'bins': bins, 'rounds': rounds, 'frequency': rounds/float(np.sum(rounds)),
+            'edge': edge, 'var': var, 'stderr': np.sqrt(var/n), 'metadata': meta,
+            'num_rounds': num_rounds, 'seed': seed, 'seconds': time.time()-tstart}
+
+
+# the measured edge tables, one .npz file per game setup and simulation size,
+# named by a hash of everything that determines them, the engine version included
+class EdgeStore(object):
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ.get('COCA_EDGE_STORE', '%s/tables/edges' % coca._path)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    # the game metadata as stored, tagged with the engine that simulated it
+    def metadata(self, meta):
+        return dict(meta, engine_version=coca._caco.engine_version())
+
+    def key(self, meta, tc_range, tc_step, num_rounds, seed):
+        args = json.dumps({'game': self.metadata(meta), 'tc_range': list(tc_range),
+                'tc_step': tc_step, 'num_rounds': num_rounds, 'seed': seed}, sort_keys=True)
+        return hashlib.sha1(args.encode('utf-8')).hexdigest()[:20]
+
+    def filename(self, *args):
+        return os.path.join(self.path, '%s.npz' % self.key(*args))
+
+    # returns the stored edges, or None if they have not been measured
+    # or were measured by another engine version
+    def lookup(self, meta, tc_range, tc_step, num_rounds, seed):
+        fname = self.filename(meta, tc_range, tc_step, num_rounds, seed)
+        if not os.path.exists(fname):
+            self.misses += 1
+            return None
+        data = np.load(fname)
+        if json.loads(str(data['metadata'])) != json.loads(json.dumps(self.metadata(meta))):
+            self.misses += 1
+            return None
+        self.hits += 1
+        edges = dict((name, np.array(data[name])) for name in ['bins', 'rounds', 'frequency',
+                'edge', 'var', 'stderr'])
+        edges.update({'metadata': meta, 'num_rounds': int(data['num_rounds']),
+                'seed': int(data['seed']), 'seconds': float(data['seconds'])})
+        return edges
+
+    # writes measured edges to the store, atomically
+    def save(self, edges, tc_range, tc_step):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fname = self.filename(edges['metadata'], tc_range, tc_step, edges['num_rounds'],
+                edges['seed'])
+        tmpname = '%s.%d.tmp.npz' % (fname[:-4], os.getpid())
+        np.savez(tmpname, metadata=json.dumps(self.metadata(edges['metadata']), sort_keys=True),
+                num_rounds=edges['num_rounds'], seed=edges['seed'], seconds=edges['seconds'],
+                **dict((name, edges[name]) for name in ['bins', 'rounds', 'frequency', 'edge',
+                'var', 'stderr']))
+        os.rename(tmpname, fname)
+
+    # returns the edges for this game, simulating and storing them on a miss
+    def getEdges(self, meta, tc_range=(-10, 10), tc_step=1.0, num_rounds=1<<24, seed=0,
+            processes=None):
+        edges = self.lookup(meta, tc_range, tc_step, num_rounds, seed)
+        if edges is None:
+            edges = countEdges(meta, tc_range=tc_range, tc_step=tc_step, num_rounds=num_rounds,
+                    seed=seed, processes=processes)
+            self.save(edges, tc_range, tc_step)
+        return edges
+
+_defaultStore = None
+def getEdgeStore():
+    global _defaultStore
+    if _defaultStore is None:
+        _defaultStore = EdgeStore()
+    return _defaultStore
+
+# returns the edge tables for a game setup, from the edge store if they
+# have been measured before. See gameMetadata() for the game arguments.
+def getEdges(tc_range=(-10, 10), tc_step=1.0, num_rounds=1<<24, seed=0, processes=None,
+        store=None, **game_args):
+    if store is None:
+        store = getEdgeStore()
+    return store.getEdges(gameMetadata(**game_args), tc_range=tc_range, tc_step=tc_step,
+            num_rounds=num_rounds, seed=seed, processes=processes)
+
+
+# the win rate, variance per round and risk of ruin of each row of bets,
+# shape (S, len(bins)), with the diffusion approximation for the risk of ruin
+def spreadStats(bets, frequency, edge, var, bankroll):
+    win = np.dot(bets, frequency*edge)
+    var = np.dot(bets**2, frequency*(var+edge**2)) - win**2
+    with np.errstate(divide='ignore', over='ignore'):
+        ror = np.where(win > 0, np.exp(-2.0*win*bankroll/np.maximum(var, 1.0e-300)), 1.0)
+    return win, var, ror
+
+# solves for the bet in each true count bin of edges, from getEdges().
+# Bets are kelly times the Kelly bet, bankroll*edge/variance, within the table
+# limits and a spread of at most max_spread, in multiples of unit if given.
+# Bins with no edge get the table minimum, or nothing if wong_out.
+# With ror, bets are scaled down further if needed so that the risk of ruin
+# is at most ror. Bins measured over fewer than min_rounds rounds use the
+# edge and variance of the nearest bin that has enough.
+# Returns a dict with the bets, the win rate and standard deviation per round,
+# the risk of ruin, N0 (the rounds needed for the win rate to match one
+# standard deviation), and whether the ror constraint could be met.
+def optimalBets(edges, bankroll, table_min, table_max, kelly=1.0, ror=None, max_spread=None,
+        unit=None, wong_out=False, min_rounds=1000, num_scales=2048):
+
+    if table_min <= 0 or table_max < table_min:
+        raise ValueError("Table limits must satisfy 0 < table_min <= table_max.")
+    if ror is not None and not 0 < ror < 1:
+        raise ValueError("The risk of ruin must be between 0 and 1.")
+    if max_spread is not None:
+        table_max = min(table_max, max_spread*table_min)
+
+    # fill in sparsely measured bins from their nearest neighbor
+    rounds = edges['rounds']
+    good = np.nonzero(rounds >= min_rounds)[0]
+    if not len(good):
+        raise ValueError("No true count bin has %d rounds measured." % min_rounds)
+    nearest = good[np.argmin(np.abs(np.arange(len(rounds))[:,None]-good[None,:]), axis=1)]
+    frequency = edges['frequency']
+    edge = edges['edge'][nearest]
+    var = edges['var'][nearest]
+
+    # bets for a range of scales of the Kelly fraction edge/var, one row each
+    positive = edge > 0
+    kfrac = np.where(positive, edge/var, 0.0)
+    scales = kelly*bankroll*np.ones(1)
+    if ror is not None and np.any(positive):
+        smin = table_min/np.max(kfrac[positive])
+        smax = table_max/np.min(kfrac[positive])
+        scales = np.geomspace(smin, max(smax, smin), num_scales)
+        scales = np.append(scales[scales < kelly*bankroll], kelly*bankroll)
+    bets = np.clip(scales[:,None]*kfrac[None,:], table_min, table_max)
+    if unit is not None:
+        bets = np.clip(unit*np.round(bets/unit), table_min, table_max)
+    bets[:,~positive] = 0.0 if wong_out else table_min
+    win, spreadvar, risk = spreadStats(bets, frequency, edge, var, bankroll)
+
+    # the most profitable scale that meets the risk of ruin,
+    # or the least risky one if none does
+    feasible = True
+    best = len(scales)-1
+    if ror is not None:
+        ok = np.nonzero(risk <= ror)[0]
+        if len(ok):
+            best = ok[np.argmax(win[ok])]
+        else:
+            feasible = False
+            best = np.argmin(risk)
+
+    win, spreadvar, risk = win[best], spreadvar[best], risk[best]
+    played = bets[best][bets[best] > 0]
+    return {'bins': edges['bins'], 'bets': bets[best], 'frequency': frequency, 'edge': edge,
+            'win': win, 'sd': np.sqrt(spreadvar), 'ror': risk, 'feasible': feasible,
+            'n0': spreadvar/win**2 if win > 0 else np.inf,
+            'spread': np.max(played)/np.min(played) if len(played) else 0.0,
+            'kelly': scales[best]/bankroll}
+
+# returns the bet spread for a game setup, measuring its edges only
+# the first time. See optimalBets() and gameMetadata() for the arguments.
+def betSpread(bankroll, table_min, table_max, kelly=1.0, ror=None, max_spread=None, unit=None,
+        wong_out=False, tc_range=(-10, 10), tc_step=1.0, num_rounds=1<<24, seed=0,
+        processes=None, **game_args):
+    edges = getEdges(tc_range=tc_range, tc_step=tc_step, num_rounds=num_rounds, seed=seed,
+            processes=processes, **game_args)
+    return optimalBets(edges, bankroll, table_min, table_max, kelly=kelly, ror=ror,
+            max_spread=max_spread, unit=unit, wong_out=wong_out)
+
+def printSpread(result, edges):
+    print ' TC     freq     edge       sd        bet'
+    for b in xrange(len(result['bins'])):
+        if edges['rounds'][b] == 0:
+            continue
+        print '%+4.0f  %6.3f%%  %+6.3f%%  %7.4f  %9.2f' % (result['bins'][b],
+                100*result['frequency'][b], 100*edges['edge'][b], np.sqrt(edges['var'][b]),
+                result['bets'][b])
+    print 'Win rate %+.4f per round (%+.2f per 100), sd %.3f per round' % (result['win'],
+            100*result['win'], result['sd'])
+    print 'Risk of ruin %.4f%s, N0 %.0f rounds, spread 1-%.1f, %.3f Kelly' % (result['ror'],
+            '' if result['feasible'] else ' (above the target)', result['n0'],
+            result['spread'], result['kelly'])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Optimal bet spreads by true count.')
+    parser.add_argument('--decks', type=int, default=6, help='number of decks')
+    parser.add_argument('--penetration', type=float, default=0.75,
+            help='fraction of the shoe dealt before reshuffling')
+    parser.add_argument('--system', default='hilo', choices=sorted(coca.countingSystems.keys()),
+            help='counting system')
+    parser.add_argument('--h17', type=int, default=0, help='dealer hits soft 17')
+    parser.add_argument('--das', type=int, default=1, help='double after split')
+    parser.add_argument('--surrender', type=int, default=1, help='surrender allowed')
+    parser.add_argument('--tc-range', type=float, nargs=2, default=[-10, 10],
+            help='lowest and highest true count bins')
+    parser.add_argument('--tc-step', type=float, default=1.0, help='true count bin width')
+    parser.add_argument('--rounds', type=int, default=1<<24, help='rounds simulated for the edges')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes')
+    parser.add_argument('--bankroll', type=float, required=True, help='bankroll')
+    parser.add_argument('--min', type=float, required=True, help='table minimum bet')
+    parser.add_argument('--max', type=float, required=True, help='table maximum bet')
+    parser.add_argument('--kelly', type=float, default=1.0, help='fraction of the Kelly bet')
+    parser.add_argument('--ror', type=float, default=None, help='largest risk of ruin allowed')
+    parser.add_argument('--max-spread', type=float, default=None, help='largest bet spread')
+    parser.add_argument('--unit', type=float, default=None, help='bets are multiples of this')
+    parser.add_argument('--wong-out', action='store_true',
+            help='sit out rounds with no edge instead of betting the minimum')
+    args = parser.parse_args()
+
+    allowed = [1, 1, 1, 1, args.surrender, 0]
+    rules = coca.Rules(allowed_actions=allowed, dealer_hits_soft_17=args.h17,
+            double_after_split=args.das)
+    tstart = time.time()
+    edges = getEdges(tc_range=args.tc_range, tc_step=args.tc_step, num_rounds=args.rounds,
+            seed=args.seed, processes=args.processes, num_decks=args.decks,
+            penetration=args.penetration, rules=rules, system=args.system)
+    tedges = time.time()
+    result = optimalBets(edges, args.bankroll, args.min, args.max, kelly=args.kelly, ror=args.ror,
+            max_spread=args.max_spread, unit=args.unit, wong_out=args.wong_out)
+    tstop = time.time()
+    printSpread(result, edges)
+    print 'Edges in %.2f s, bets in %.2f ms' % (tedges-tstart, 1000*(tstop-tedges))
@@ -1,41 +1,62 @@
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.tri as mtri
-from matplotlib.collections import PolyCollection
-from matplotlib import colors
 import ctypes
 from ctypes import *
-import warnings
 import os 
 import time
-import inspect 
-import itertools
-from scipy.stats import norm
-
-# nice plot styling
-matplotlib.rcParams['text.usetex'] = True
-matplotlib.rcParams['font.family'] = 'serif'
-matplotlib.rcParams['font.serif'] = 'computer modern roman'
+import struct
+import hashlib
+import json
 
 # load the underlying C shared library
-_path = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+_path = os.path.dirname(os.path.abspath(__file__))
 _caco = ctypes.CDLL('%s/cocalib.so'%_path)
 _caco.deal_card_to_hand_choose.restype = c_double 
 _caco.expected_value.restype = c_double 
+_caco.cache_enable.argtypes = [c_long, c_int]
+_caco.seed_rand.argtypes = [c_uint64]
+_caco.rng_seed.argtypes = [c_void_p, c_uint64, c_int]
+_caco.wall_time.restype = c_double
 
 # nice helpers
 allCards = [2,3,4,5,6,7,8,9,10,11]
 cardLabels = ["", "", "2","3","4","5","6","7","8","9","10","A"]
 actionLabels = ["Stand ", "Hit   ", "Double", "Split ", "Surrender", "Insurance", ""]
-
-# built-in strategy tables
-tables = {
-    # basic strategy generated by this program for an infinite deck
-    'default_table': (np.fromfile('tables/basic_strategy_infinite_deck_actions.np',
-        dtype=np.int32).reshape((10,34)), np.fromfile('tables/basic_strategy_infinite_deck_exp.np',
-            dtype=np.float64).reshape((10,34,6))), 
-}
+STAND, HIT, DOUBLE, SPLIT, SURRENDER, INSURANCE = range(6)
+outcomeLabels = ["17", "18", "19", "20", "21", "Blackjack", "Bust"]
+maxSeats = 8
+
+# one seat's round in a streaming simulation, laid out as RoundRecord in cocalib.c.
+# action is the first action on the seat's two cards, -1 if there was no choice.
+roundRecordDtype = np.dtype([('round', '<i8'), ('net', '<f8'), ('true_count', '<f4'),
+        ('seat', 'i1'), ('dealer_card', 'i1'), ('chart_ind', 'i1'), ('action', 'i1'),
+        ('numhands', 'i1')], align=True)
+_chunkSize = 4096 # shoes per vectorized block
+
+# built-in strategy tables, opened on first access
+class _BuiltinTables(dict):
+
+    files = {
+        # basic strategy generated by this program for an infinite deck
+        'default_table': ('basic_strategy_infinite_deck_actions.np', 
+            'basic_strategy_infinite_deck_exp.np'),
+    }
+
+    def __missing__(self, name):
+        if name not in self.files:
+            raise KeyError(name)
+        actions, exps = self.files[name]
+        self[name] = (np.memmap('%s/tables/%s'%(_path, actions), dtype=np.int32, mode='r', 
+            shape=(10,34)), np.memmap('%s/tables/%s'%(_path, exps), dtype=np.float64, mode='r', 
+                shape=(10,34,6)))
+        return self[name]
+
+    def __contains__(self, name):
+        return name in self.files or dict.__contains__(self, name)
+
+    def keys(self):
+        return sorted(set(self.files.keys()) | set(dict.keys(self)))
+
+tables = _BuiltinTables()
 
 # TODO: define different sets of default rules?
 vegasRules = {}
@@ -113,12 +134,19 @@ class Rules(Structure):
         #mystr += ' allowed_moves = '
         return mystr
 
+# the keyword arguments that rebuild these rules
+def rulesArgs(rules):
+    return {'allowed_actions': list(rules.allowed), 'max_split_depth': rules.max_split_depth,
+            'double_after_split': rules.double_after_split,
+            'dealer_hits_soft_17': rules.dealer_hits_soft_17,
+            'can_hit_split_aces': rules.can_hit_split_aces, 'errtol': rules.errtol}
+
 class Strategy(Structure):
 
     # c struct fields 
     _fields_ = [("actions", 340*c_int), ("optimal", c_int)]
 
-    def __init__(self, type='optimal'):
+    def __init__(self, type='optimal', actions=None):
 
         self.type = type
         self.optimal = 0
@@ -142,43 +170,730 @@ class Strategy(Structure):
             for i in xrange(340):
                 self.actions[i] = c_int(actions[i])
 
+        elif self.type == 'table':
+            if actions is None:
+                raise ValueError("A (10,34) table of actions is required.") 
+            actions = np.asarray(actions, dtype=np.int32)
+            if actions.shape != (10, 34):
+                raise ValueError("A (10,34) table of actions is required.") 
+            for i, act in enumerate(actions.ravel()):
+                self.actions[i] = c_int(act)
+
         else:
             raise ValueError("Invalid strategy type.") 
 
 
+    # the strategy's (10,34) action chart
+    def table(self):
+        return np.array(self.actions, dtype=np.int32).reshape((10, 34))
+
+    # the action for this hand from the strategy chart, falling back as 
+    # the C solver does when it is not allowed under these rules
+    def fromTable(self, dealer_hand, my_hand, rules=None):
+        if rules is None:
+            rules = Rules()
+        allowed = (c_int*6)(*rules.allowed)
+        allowed[SPLIT] *= int(my_hand.ispair and my_hand.depth < 2+rules.max_split_depth)
+        allowed[SURRENDER] *= int(my_hand.depth <= 2 and dealer_hand.depth == 1)
+        allowed[INSURANCE] = 0
+        return _caco.table_action(byref(self), my_hand, dealer_hand, allowed)
+
     def __str__(self):
         mystr = 'Strategy:\n'
         #mystr += ' allowed_moves = '
         return mystr
 
 
+# returns a fresh 64-bit seed from the operating system
+def randomSeed():
+    return struct.unpack('<Q', os.urandom(8))[0]
+
+# seeds the default random stream, used when no Rng is given
+def seedRandom(seed=None):
+    if seed is None:
+        seed = randomSeed()
+    _caco.seed_rand(c_uint64(seed))
+
+class Rng(Structure):
+
+    # c struct fields 
+    _fields_ = [("s", 4*c_uint64)]
+
+    # streams with the same seed never overlap, so workers
+    # can share a seed and take one stream each
+    def __init__(self, seed=None, stream=0):
+        if seed is None:
+            seed = randomSeed()
+        self.seed = seed
+        self.stream = stream
+        _caco.rng_seed(byref(self), c_uint64(seed), c_int(stream))
+
+    def __str__(self):
+        return 'Rng: seed %d, stream %d' % (self.seed, self.stream)
+
+class Game(Structure):
+
+    # c struct fields 
+    _fields_ = [("shoe", Shoe), ("rules", Rules), ("rng", Rng), ("penetration", c_double), ("numseats", c_int),
+            ("peek", c_int), ("rounds", c_long), ("shuffles", c_long),
+            ("_mean", maxSeats*c_double), ("_m2", maxSeats*c_double), ("tags", 12*c_int)]
+
+    # strategy is one Strategy for every seat, or a list with one for each seat.
+    # system is the card counting system for the true counts in streamed records
+    def __init__(self, num_decks=6, num_seats=1, rules=None, strategy=None, penetration=0.75,
+            peek=True, seed=None, stream=0, system='hilo'):
+
+        if num_seats < 1 or num_seats > maxSeats:
+            raise ValueError("Between 1 and %d seats are allowed." % maxSeats)
+        if rules is None:
+            rules = Rules()
+        if strategy is None:
+            strategy = Strategy(type='table', actions=tables['default_table'][0])
+        strategies = strategy if isinstance(strategy, (list, tuple)) else num_seats*[strategy]
+        if len(strategies) != num_seats:
+            raise ValueError("One strategy is needed for each seat.")
+        if any(s.optimal for s in strategies):
+            raise ValueError("Simulations need a strategy table, not the optimal solver.")
+
+        self.shoe = Shoe(numdecks=num_decks)
+        self.rules = rules
+        self.strategies = (Strategy*num_seats)(*strategies)
+        self.penetration = penetration
+        self.numseats = num_seats
+        self.peek = int(peek)
+        self.system = system
+        for c in xrange(10):
+            self.tags[c+2] = countingSystems[system][c]
+
+        rng = Rng(seed=seed, stream=stream)
+        self.rng = rng
+        self.seed = rng.seed
+        self.stream = stream
+        self.seeded = seed is not None
+
+    # plays num_rounds more rounds, continuing from the current shoe.
+    # Returns the net result for each seat, shape (num_rounds, num_seats)
+    def play(self, num_rounds):
+        net = np.empty((num_rounds, self.numseats), dtype=np.float64)
+        _caco.simulate_rounds(byref(self), self.strategies, c_long(num_rounds),
+                net.ctypes.data_as(POINTER(c_double)), None)
+        return net
+
+    # plays num_rounds more rounds, keeping only the running statistics
+    def simulate(self, num_rounds):
+        _caco.simulate_rounds(byref(self), self.strategies, c_long(num_rounds), None, None)
+
+    # plays num_rounds more rounds, yielding chunks of chunk_rounds*num_seats
+    # records (see roundRecordDtype), ordered by round and then seat.
+    # With a path, the records are appended to that RecordFile instead and
+    # each chunk is a memory-mapped view of the file, so memory stays flat.
+    # Chunks are reused, so copy any that must outlive the next iteration.
+    def playChunks(self, num_rounds, chunk_rounds=1<<16, path=None):
+        records = None
+        if path is not None:
+            records = self.openRecords(path)
+        else:
+            buf = np.empty(chunk_rounds*self.numseats, dtype=roundRecordDtype)
+        done = 0
+        while done < num_rounds:
+            n = min(chunk_rounds, num_rounds-done)
+            if records is not None:
+                chunk = records.append(n*self.numseats)
+            else:
+                chunk = buf[:n*self.numseats]
+            _caco.simulate_rounds(byref(self), self.strategies, c_long(n), None,
+                    chunk.ctypes.data_as(c_void_p))
+            if records is not None:
+                records.commit(chunk, self.state())
+            done += n
+            yield chunk
+
+    # opens the record file at path to append this game's rounds to. An existing
+    # file must hold records of the same game, and a Game that has not played
+    # yet takes the file's saved state, and its seed if it was given none, so
+    # that it carries on from the last committed round instead of replaying.
+    def openRecords(self, path):
+        if not os.path.exists(path):
+            return RecordFile(path, metadata=self.metadata(), state=self.state())
+        records = RecordFile(path)
+        meta = self.metadata()
+        if not self.seeded:
+            meta['seed'], meta['stream'] = records.metadata['seed'], records.metadata['stream']
+        if json.loads(json.dumps(meta)) != records.metadata:
+            raise ValueError("%s holds records from a different game." % path)
+        if self.state() != records.state:
+            if self.rounds or self.shuffles:
+                raise ValueError("This game has played rounds that are not in %s." % path)
+            self.setState(records.state)
+            self.seed, self.stream = meta['seed'], meta['stream']
+        return records
+
+    # the position of the game: its random stream, shoe, rounds and statistics
+    def state(self):
+        return {'rng': [int(x) for x in self.rng.s], 'shoe': list(self.shoe.num),
+                'total': self.shoe.total, 'rounds': self.rounds, 'shuffles': self.shuffles,
+                'mean': list(self._mean), 'm2': list(self._m2)}
+
+    def setState(self, state):
+        for i in xrange(4):
+            self.rng.s[i] = state['rng'][i]
+        for c in xrange(12):
+            self.shoe.num[c] = state['shoe'][c]
+        self.shoe.total = state['total']
+        self.rounds = state['rounds']
+        self.shuffles = state['shuffles']
+        for s in xrange(maxSeats):
+            self._mean[s] = state['mean'][s]
+            self._m2[s] = state['m2'][s]
+
+    # everything needed to reproduce this game, stored with streamed records
+    def metadata(self):
+        strategies = [list(s.actions) for s in self.strategies]
+        if all(s == strategies[0] for s in strategies):
+            strategies = strategies[0]
+        return {'num_decks': self.shoe.numdecks, 'num_seats': self.numseats,
+                'penetration': self.penetration, 'peek': self.peek, 'seed': self.seed,
+                'stream': self.stream, 'system': self.system,
+                'allowed': list(self.rules.allowed), 'max_split_depth': self.rules.max_split_depth,
+                'double_after_split': self.rules.double_after_split,
+                'dealer_hits_soft_17': self.rules.dealer_hits_soft_17,
+                'can_hit_split_aces': self.rules.can_hit_split_aces,
+                'strategy': strategies, 'dtype': roundRecordDtype.descr}
+
+    # running statistics of the net result per round over all rounds played, per seat
+    @property
+    def mean(self):
+        return np.array(self._mean[:self.numseats])
+
+    @property
+    def var(self):
+        return np.array(self._m2[:self.numseats])/max(self.rounds-1, 1)
+
+    @property
+    def stderr(self):
+        return np.sqrt(self.var/max(self.rounds, 1))
+
+    def __str__(self):
+        mystr = 'Game: %d rounds, %d shuffles, %s\n' % (self.rounds, self.shuffles, self.shoe)
+        for s in xrange(self.numseats):
+            mystr += ' - Seat %d: mean = %+.5f +- %.5f, variance = %.4f\n' % (s, self.mean[s],
+                    self.stderr[s], self.var[s])
+        return mystr
+
 # deals the specified card from the shoe to the hand
 # returns the probability of this deal occuring given the
 # state of the shoe. If the card is not in the shoe, 
 # the hand and shoe are untouched and we return 0.
-def dealCardToHand(shoe, hand, card = 11, way = 'random'):
+def dealCardToHand(shoe, hand, card = 11, way = 'random', rng = None):
     if card < 2 or card > 11:
         raise ValueError("Invalid card value.")
     if way == 'choose':
         prb = _caco.deal_card_to_hand_choose(byref(shoe), byref(hand), c_int(card))
     elif way == 'random':
-        prb = _caco.deal_card_to_hand_random(byref(shoe), byref(hand), c_int(card))
+        prb = _caco.deal_card_to_hand_random(byref(shoe), byref(hand),
+                byref(rng) if rng is not None else None)
     return prb
 
 
+class CacheStats(Structure):
+
+    # c struct fields 
+    _fields_ = [("capacity", c_long), ("numentries", c_long), ("hits", c_long), ("misses", c_long),
+            ("inserts", c_long), ("evictions", c_long)]
+
+    def asDict(self):
+        return dict((name, getattr(self, name)) for name, _ in self._fields_)
+
+    def __str__(self):
+        lookups = max(self.hits+self.misses, 1)
+        return 'Cache: %d/%d entries, %d hits, %d misses (%.1f%% hit rate), %d evictions' % (
+                self.numentries, self.capacity, self.hits, self.misses, 100.0*self.hits/lookups,
+                self.evictions)
+
+
+# turns on the transposition cache for expected_value(), 
+# holding at most (roughly) capacity solved subproblems.
+# The cache stays warm across getAction calls until it is
+# cleared or disabled. Only the optimal strategy is cached.
+# A cached subproblem is reused whenever it was solved with
+# at least the current bet, so its errtol pruning is no coarser.
+# exact=True only reuses identical bets, reproducing the 
+# uncached results bit for bit at a lower hit rate.
+# The cache is shared by the whole process, so it must stay off while 
+# getAction is called from several threads at once.
+def enableCache(capacity=1<<20, exact=False):
+    if not _caco.cache_enable(c_long(capacity), c_int(exact)):
+        raise MemoryError("Could not allocate the solver cache.")
+
+def disableCache():
+    _caco.cache_disable()
+
+def clearCache():
+    _caco.cache_clear()
+
+def getCacheStats():
+    stats = CacheStats()
+    _caco.cache_get_stats(byref(stats))
+    return stats
+
+
+# counters of the work done by the solver, summed over
+# every solve since stats were enabled or last reset
+class SolverStats(Structure):
+
+    # c struct fields 
+    _fields_ = [("nodes", c_long), ("expanded", c_long*6), ("pruned", c_long),
+            ("dealer_solves", c_long), ("dealer_nodes", c_long), ("dealer_pruned", c_long),
+            ("cache_hits", c_long), ("cache_misses", c_long),
+            ("dealer_cache_hits", c_long), ("dealer_cache_misses", c_long),
+            ("max_depth", c_long)]
+
+    def asDict(self):
+        stats = dict((name, getattr(self, name)) for name, _ in self._fields_)
+        stats['expanded'] = dict((actionLabels[a].strip().lower(), self.expanded[a])
+                for a in xrange(4))
+        return stats
+
+    def __str__(self):
+        lines = ['Solver: %d nodes, max depth %d, %d pruned by errtol' % (self.nodes,
+                self.max_depth, self.pruned)]
+        lines.append('  expanded: ' + ', '.join(['%s %d' % (actionLabels[a].strip().lower(),
+                self.expanded[a]) for a in xrange(4)]))
+        lines.append('  dealer: %d distributions, %d nodes, %d pruned by errtol' % (
+                self.dealer_solves, self.dealer_nodes, self.dealer_pruned))
+        lines.append('  cache: %d hits, %d misses; dealer cache: %d hits, %d misses' % (
+                self.cache_hits, self.cache_misses, self.dealer_cache_hits,
+                self.dealer_cache_misses))
+        return '\n'.join(lines)
+
+
+# turns on the solver counters for getAction, dealerOutcomes and computeChart.
+# They are off by default, and cost a little speed while on.
+def enableStats():
+    _caco.stats_enable(c_int(1))
+
+def disableStats():
+    _caco.stats_enable(c_int(0))
+
+def resetStats():
+    _caco.stats_reset()
+
+def getSolverStats():
+    stats = SolverStats()
+    _caco.stats_get(byref(stats))
+    return stats
+
+
+# draws num_cards random cards from the shoe, removing them as they
+# are drawn, into a NumPy array of card values (2-11, 0 once the shoe is empty)
+def drawCards(shoe, num_cards, rng=None):
+    cards = np.empty(num_cards, dtype=np.int32)
+    _caco.random_cards_from_shoe(byref(shoe), byref(rng) if rng is not None else None,
+            c_long(num_cards), cards.ctypes.data_as(POINTER(c_int)))
+    return cards
+
+
+# a directory of solved charts, one file per (rules, shoe, engine version).
+# Each file is a fixed-size header followed by the raw action and EV tables,
+# which are opened with np.memmap so that processes share their pages.
+class TableStore(object):
+
+    magic = 'COCATBL\0'
+    formatVersion = 1
+    headerSize = 1024
+    actionsShape = (10, 34)
+    expShape = (10, 34, 6)
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ.get('COCA_TABLE_STORE', '%s/tables/store'%_path)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    # everything that determines a chart, hashed for the file name
+    def metadata(self, shoe, rules):
+        return {'engine_version': _caco.engine_version(), 
+                'numdecks': shoe.numdecks, 'shoe': list(shoe.num[2:12]),
+                'allowed': list(rules.allowed), 'max_split_depth': rules.max_split_depth,
+                'double_after_split': rules.double_after_split,
+                'dealer_hits_soft_17': rules.dealer_hits_soft_17,
+                'can_hit_split_aces': rules.can_hit_split_aces, 'errtol': rules.errtol}
+
+    def key(self, shoe, rules):
+        meta = json.dumps(self.metadata(shoe, rules), sort_keys=True)
+        return hashlib.sha1(meta.encode('utf-8')).hexdigest()[:20]
+
+    def filename(self, shoe, rules):
+        return os.path.join(self.path, '%s.coca' % self.key(shoe, rules))
+
+    # returns memory-mapped (actions, exps), or None if the chart 
+    # is not stored or was made by another engine version
+    def lookup(self, shoe, rules):
+        fname = self.filename(shoe, rules)
+        header = self.readHeader(fname)
+        if header is None or header != self.metadata(shoe, rules):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.openTables(fname)
+
+    def openTables(self, fname):
+        actions = np.memmap(fname, dtype=np.int32, mode='r', offset=self.headerSize,
+                shape=self.actionsShape)
+        all_exp = np.memmap(fname, dtype=np.float64, mode='r', 
+                offset=self.headerSize+actions.nbytes, shape=self.expShape)
+        return actions, all_exp
+
+    # the metadata stored in a table file, None if it is missing or unreadable
+    def readHeader(self, fname):
+        try:
+            with open(fname, 'rb') as f:
+                header = f.read(self.headerSize)
+        except IOError:
+            return None
+        if len(header) < self.headerSize or header[:8] != self.magic:
+            return None
+        version, length = struct.unpack('<II', header[8:16])
+        if version != self.formatVersion:
+            return None
+        return json.loads(header[16:16+length].decode('utf-8'))
+
+    # writes a chart to the store, atomically
+    def save(self, shoe, rules, best_action, all_exp):
+        meta = json.dumps(self.metadata(shoe, rules), sort_keys=True).encode('utf-8')
+        if 16+len(meta) > self.headerSize:
+            raise ValueError("Table metadata does not fit in the header.")
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fname = self.filename(shoe, rules)
+        tmpname = '%s.%d.tmp' % (fname, os.getpid())
+        with open(tmpname, 'wb') as f:
+            header = self.magic + struct.pack('<II', self.formatVersion, len(meta)) + meta
+            f.write(header + '\0'*(self.headerSize-len(header)))
+            f.write(np.ascontiguousarray(best_action, dtype=np.int32).tobytes())
+            f.write(np.ascontiguousarray(all_exp, dtype=np.float64).tobytes())
+        os.rename(tmpname, fname)
+
+    # returns the chart for this shoe and rules,
+    # solving and storing it on a miss
+    def getChart(self, shoe, rules, threads=None):
+        chart = self.lookup(shoe, rules)
+        if chart is None:
+            best_action, all_exp = computeChart(shoe, rules=rules, threads=threads)
+            self.save(shoe, rules, best_action, all_exp)
+            chart = self.openTables(self.filename(shoe, rules))
+        return chart
+
+_defaultStore = None
+def getTableStore():
+    global _defaultStore
+    if _defaultStore is None:
+        _defaultStore = TableStore()
+    return _defaultStore
+
+# returns the optimal chart (actions, exps) for this shoe and rules,
+# from the table store if it has been solved before.
+def getChart(shoe, rules=Rules(), threads=None, store=None):
+    if store is None:
+        store = getTableStore()
+    return store.getChart(shoe, rules, threads=threads)
+
+
 # returns the optimal move based on the desired strategy 
-def getAction(shoe, dealer_hand, my_hand, rules=Rules(), strategy=Strategy(), return_exp=True):
+# if return_stats, also returns the cache hits and misses for this call
+def getAction(shoe, dealer_hand, my_hand, rules=Rules(), strategy=Strategy(), return_exp=True,
+        return_stats=False):
     if strategy.optimal or return_exp:
         exp_values = np.array([0.0,0.0,0.0,0.0,0.0,0.0], dtype=np.float64) 
         action = c_int(0)
+        if return_stats:
+            before = getCacheStats()
         _caco.simulate_unit_bet(my_hand, dealer_hand, shoe, rules, strategy, byref(action),
                 exp_values.ctypes.data_as(POINTER(c_double)))
+        result = (action.value,)
         if return_exp:
-            return action.value, exp_values
-        else:
-            return action.value
+            result += (exp_values,)
+        if return_stats:
+            stats = getCacheStats()
+            for name in ['hits', 'misses', 'inserts', 'evictions']:
+                setattr(stats, name, getattr(stats, name)-getattr(before, name))
+            result += (stats,)
+        if len(result) == 1:
+            return result[0]
+        return result
+    else:
+        return strategy.fromTable(dealer_hand, my_hand, rules=rules)
+
+# solves for the optimal move within a time budget, for real-time advice.
+# Solves first at a coarse errtol, then again at errtol/factor and so on, 
+# until the best action provably beats all the others, min_errtol is 
+# reached, or seconds run out. The first pass always finishes; a pass that 
+# would overrun the deadline is abandoned and the last finished one is used.
+# Returns a dict with the action, every action's expected value and the 
+# lower and upper bounds errtol pruning leaves on it, the errtol reached, 
+# whether the action is dominant, the number of finished passes and the time taken.
+def getActionAnytime(shoe, dealer_hand, my_hand, seconds, rules=Rules(), errtol=1.0e-2,
+        min_errtol=None, factor=10.0):
+    tstart = _caco.wall_time()
+    deadline = tstart+seconds
+    if min_errtol is None:
+        min_errtol = rules.errtol
+    rtmp = Rules.from_buffer_copy(rules)
+    rtmp.errtol = max(errtol, min_errtol)
+    exp_values = np.zeros(6, dtype=np.float64)
+    bounds = np.zeros(6, dtype=np.float64)
+    action = c_int(0)
+    result = None
+    passes = 0
+    while True:
+        finished = _caco.simulate_unit_bet_bounded(my_hand, dealer_hand, shoe, rtmp, Strategy(),
+                c_double(deadline if passes else 0.0), byref(action),
+                exp_values.ctypes.data_as(POINTER(c_double)), bounds.ctypes.data_as(POINTER(c_double)))
+        if not finished:
+            break
+        passes += 1
+        others = exp_values > -999.0
+        others[action.value] = False
+        lower, upper = exp_values-bounds, exp_values+bounds
+        result = {'action': action.value, 'exp': exp_values.copy(), 'lower': lower, 'upper': upper,
+                'errtol': rtmp.errtol,
+                'dominant': bool(not others.any() or lower[action.value] > upper[others].max())}
+        if result['dominant'] or rtmp.errtol <= min_errtol or _caco.wall_time() >= deadline:
+            break
+        rtmp.errtol = max(rtmp.errtol/factor, min_errtol)
+    result['passes'] = passes
+    result['seconds'] = _caco.wall_time()-tstart
+    return result
+
+# solves one hand against many shoes in a single C call, spread over a pool
+# of threads with the GIL released. shoes is an (N,10) array of the number of 
+# 2..11 left in each shoe (or a list of Shoes). Identical shoes are solved once, 
+# and the rest are sorted so that neighbouring compositions are solved together 
+# in blocks of block_size, reusing the subproblems they share through a cache of 
+# cache_capacity entries per thread. Values are as from getAction() with the 
+# cache enabled, and do not depend on the number of threads.
+# Returns the (N,) best actions and (N,6) expected values.
+def evaluateCompositions(shoes, dealer_hand, my_hand, rules=Rules(), strategy=Strategy(),
+        infinite=False, threads=None, block_size=64, cache_capacity=1<<15):
+    if threads is None:
+        import multiprocessing
+        threads = multiprocessing.cpu_count()
+    if len(shoes) and isinstance(shoes[0], Shoe):
+        infinite = shoes[0].numdecks < 0
+        shoes = [shoe.num[2:12] for shoe in shoes]
+    counts = np.asarray(shoes, dtype=np.int32).reshape((-1, 10))
+    if np.any(counts < 0):
+        raise ValueError("Shoe counts must not be negative.")
+    if not len(counts):
+        return np.empty(0, dtype=np.int32), np.empty((0, 6), dtype=np.float64)
+    unique, inverse = np.unique(counts, axis=0, return_inverse=True)
+    unique = np.ascontiguousarray(unique, dtype=np.int32)
+    actions = np.empty(len(unique), dtype=np.int32)
+    exps = np.empty((len(unique), 6), dtype=np.float64)
+    _caco.evaluate_compositions(unique.ctypes.data_as(POINTER(c_int)), c_long(len(unique)),
+            c_int(-1 if infinite else 1), my_hand, dealer_hand, rules, byref(strategy),
+            c_int(threads), c_long(block_size), c_long(cache_capacity),
+            actions.ctypes.data_as(POINTER(c_int)), exps.ctypes.data_as(POINTER(c_double)))
+    return actions[inverse], exps[inverse]
+
+# returns the probability of each final dealer hand, 
+# indexed as in outcomeLabels, given the dealer's cards
+# and the current state of the shoe. The dealer never has 
+# a pair, so a Hand of A,A counts as a soft 12.
+def dealerOutcomes(shoe, dealer_hand, rules=Rules()):
+    outcomes = np.zeros(7, dtype=np.float64)
+    _caco.get_dealer_outcomes(dealer_hand, shoe, rules, outcomes.ctypes.data_as(POINTER(c_double)))
+    return outcomes
+
+# solves every cell of the (10,34) strategy chart in a single C call,
+# spread over a pool of threads, with the GIL released. Each cell is solved 
+# on the shoe less its deal, the dealer's up card and the player's two cards,
+# and a hard total averages its values over the pairs of cards that make it,
+# so that houseEdge() of the chart is exact for a finite shoe.
+# Returns the best action and all expected values for each cell, filling
+# best_action and all_exp in place if they are given. Results are
+# bit-identical for any number of threads.
+# If return_times, also returns the (10,34) wall time in seconds spent on each cell.
+# exact=True ignores rules.errtol and solves every subproblem exactly, memoized
+# on the remaining shoe in caches holding at most max_memory bytes in all. 
+# This is quick for an infinite shoe, and takes a minute or two for 1 or 2 decks.
+def computeChart(shoe, rules=Rules(), strategy=Strategy(), threads=None, best_action=None,
+        all_exp=None, return_times=False, exact=False, max_memory=1<<31):
+    if threads is None:
+        import multiprocessing
+        threads = multiprocessing.cpu_count()
+    if best_action is None:
+        best_action = np.empty((10, 34), dtype=np.int32)
+    if all_exp is None:
+        all_exp = np.empty((10, 34, 6), dtype=np.float64)
+    if best_action.shape != (10, 34) or best_action.dtype != np.int32 \
+            or not best_action.flags.c_contiguous:
+        raise ValueError("best_action must be a contiguous (10,34) int32 array.")
+    if all_exp.shape != (10, 34, 6) or all_exp.dtype != np.float64 \
+            or not all_exp.flags.c_contiguous:
+        raise ValueError("all_exp must be a contiguous (10,34,6) float64 array.")
+    times = None
+    if return_times:
+        times = np.zeros((10, 34), dtype=np.float64)
+    arrays = (best_action.ctypes.data_as(POINTER(c_int)), all_exp.ctypes.data_as(POINTER(c_double)),
+            times.ctypes.data_as(POINTER(c_double)) if return_times else None)
+    if exact:
+        _caco.compute_chart_exact(shoe, rules, byref(strategy), c_int(threads), c_long(max_memory),
+                *arrays)
     else:
-        return strategy.fromTable(dealer_hand, my_hand)
+        _caco.compute_chart(shoe, rules, byref(strategy), c_int(threads), *arrays)
+    if return_times:
+        return best_action, all_exp, times
+    return best_action, all_exp
+
+# the effect of removing one card of each rank from the shoe, on every chart cell
+# and on the game as a whole. The chart is solved for the shoe and for the ten 
+# shoes with one card removed in a single C call, where each cell's eleven solves
+# share their caches, so the perturbed shoes mostly reuse the work of the base 
+# solve (the shoe less r then x is the shoe less x then r).
+# exact=True solves with no errtol pruning; exact=False uses rules.errtol.
+# Exact is the default because it is also the faster mode here, at the cost of
+# memory. On one core, with the default rules, the exact solve took 135 s for
+# 1 deck, 821 s for 6 decks and 787 s for 8 decks, with 1.3 GB resident for
+# 6 and 8 decks (max_memory caps it). errtol=1e-8 took 347, 1162 and 1073 s in
+# 36 MB, and was off by up to 5e-8 in the game effects and 4e-5 in a cell's.
+# Returns the (10,34,10) change in each cell's best expected value, indexed like
+# the chart and then by the removed card 2..11, and the (10,) change in the 
+# player's expected return for the game (the negated house edge). Ranks 
+# that are not in the shoe give NaN.
+def effectOfRemoval(shoe, rules=Rules(), strategy=Strategy(), threads=None, exact=True,
+        max_memory=1<<31):
+    if shoe.numdecks < 0:
+        raise ValueError("The effect of removal needs a finite shoe.")
+    if threads is None:
+        import multiprocessing
+        threads = multiprocessing.cpu_count()
+    shoes = (Shoe*11)()
+    for s in xrange(11):
+        shoes[s] = shoe
+        if s > 0 and shoe.num[s+1] > 0:
+            shoes[s].num[s+1] -= 1
+            shoes[s].total -= 1
+    best_action = np.empty((11, 10, 34), dtype=np.int32)
+    all_exp = np.empty((11, 10, 34, 6), dtype=np.float64)
+    _caco.compute_charts(shoes, c_int(11), rules, byref(strategy), c_int(threads), c_int(exact),
+            c_long(max_memory), best_action.ctypes.data_as(POINTER(c_int)),
+            all_exp.ctypes.data_as(POINTER(c_double)), None)
+    best_exp = np.choose(best_action, np.rollaxis(all_exp, -1))
+    counts = np.array([shoes[s].num[2:12] for s in xrange(11)], dtype=np.float64)
+    game = -houseEdge(counts, best_exp)
+    missing = np.array(shoe.num[2:12]) == 0
+    cells = np.rollaxis(best_exp[1:]-best_exp[0], 0, 3)
+    cells[:,:,missing] = np.nan
+    game = game[1:]-game[0]
+    game[missing] = np.nan
+    return cells, game
+
+# measures the error of the errtol-pruned chart against the exact one.
+# Returns a dict with the largest and mean error in each cell's best expected value,
+# the number of cells whose best action differs, both house edges and both run times.
+def errtolError(shoe, rules=Rules(), threads=None, max_memory=1<<31):
+    tstart = time.time()
+    best_action, all_exp = computeChart(shoe, rules=rules, threads=threads)
+    tmid = time.time()
+    exact_action, exact_exp = computeChart(shoe, rules=rules, threads=threads, exact=True,
+            max_memory=max_memory)
+    tstop = time.time()
+    error = np.abs(np.choose(best_action, np.rollaxis(all_exp, -1))
+            - np.choose(exact_action, np.rollaxis(exact_exp, -1)))
+    return {'errtol': rules.errtol, 'max_exp_error': error.max(), 'mean_exp_error': error.mean(),
+            'action_mismatches': int(np.sum(best_action != exact_action)),
+            'house_edge': houseEdge(shoe, all_exp, best_action=best_action),
+            'house_edge_exact': houseEdge(shoe, exact_exp, best_action=exact_action),
+            'seconds': tmid-tstart, 'seconds_exact': tstop-tmid}
+
+# the chart index of the player's first two cards,
+# indexed by (card-2, card-2), built on first use
+_twoCardInds = None
+def _getTwoCardInds():
+    global _twoCardInds
+    if _twoCardInds is None:
+        _twoCardInds = np.zeros((10, 10), dtype=np.intp)
+        dealer_hand = Hand()
+        dealer_hand.addCard(2)
+        for m0 in allCards: 
+            for m1 in allCards: 
+                my_hand = Hand()
+                my_hand.addCard(m0)
+                my_hand.addCard(m1)
+                _twoCardInds[m0-2, m1-2] = getChartIndFromCards(my_hand, dealer_hand)[1]
+    return _twoCardInds
+
+# rank counts as an (N,10) float array, whether cards are removed as 
+# they are dealt, and whether a single shoe was passed in
+def _shoeCounts(shoes, infinite):
+    if isinstance(shoes, Shoe):
+        return np.array(shoes.num[2:12], dtype=np.float64)[None,:], shoes.numdecks >= 0, True
+    counts = np.asarray(shoes, dtype=np.float64)
+    if counts.shape[-1] != 10:
+        raise ValueError("Shoes must be given as rank counts for cards 2-11.")
+    return counts.reshape((-1, 10)), not infinite, counts.ndim == 1
+
+# the probability of each (dealer up, player card, player card) deal, shape (N,10,10,10)
+def _dealWeights(counts, finite):
+    total = np.sum(counts, axis=1)[:,None,None,None]
+    eye = np.eye(10)
+    n0 = counts[:,:,None,None]
+    n1 = counts[:,None,:,None]
+    n2 = counts[:,None,None,:]
+    if finite:
+        n1 = n1 - eye[None,:,:,None]
+        n2 = n2 - eye[None,:,None,:] - eye[None,None,:,:]
+        return (n0/total)*np.clip(n1/np.maximum(total-1, 1), 0, None) \
+                *np.clip(n2/np.maximum(total-2, 1), 0, None)
+    return (n0/total)*(n1/total)*(n2/total)
+
+# returns the probability of each initial deal (dealer up card and
+# two player cards), indexed like the strategy chart.
+# shoes is a Shoe, or an (N,10) array of rank counts for cards 2-11 
+# giving an (N,10,34) result. Cards are removed from the counts as they are 
+# dealt unless infinite is set.
+def dealProbabilities(shoes, infinite=False):
+    counts, finite, single = _shoeCounts(shoes, infinite)
+    onehot = np.zeros((100, 34), dtype=np.float64)
+    onehot[np.arange(100), _getTwoCardInds().ravel()] = 1.0
+    dealprob = np.empty((counts.shape[0], 10, 34), dtype=np.float64)
+    for start in xrange(0, counts.shape[0], _chunkSize):
+        chunk = counts[start:start+_chunkSize]
+        dealprob[start:start+_chunkSize] = np.dot(_dealWeights(chunk, finite).reshape((-1, 10, 100)),
+                onehot)
+    if single:
+        return dealprob[0]
+    return dealprob
+
+# returns the house edge (minus the player's expected win per unit bet) for 
+# each shoe, weighting the expected values in the chart by the deal probabilities.
+# ev_table holds the (10,34) expected values of the chosen actions, or all
+# (10,34,6) expected values if best_action is given. Either may have a leading
+# dimension to give each shoe its own table.
+# For a finite shoe the values must be solved on the shoe left after each deal,
+# as computeChart() does, so the edge is exact for a table solved for that shoe.
+# A table from an infinite shoe, or one shared by shoes of other compositions,
+# only approximates their edges.
+def houseEdge(shoes, ev_table, best_action=None, infinite=False):
+    ev_table = np.asarray(ev_table, dtype=np.float64)
+    if best_action is not None:
+        ev_table = np.choose(best_action, np.rollaxis(ev_table, -1))
+    counts, finite, single = _shoeCounts(shoes, infinite)
+    inds = _getTwoCardInds()
+    edge = np.empty(counts.shape[0], dtype=np.float64)
+    for start in xrange(0, counts.shape[0], _chunkSize):
+        weights = _dealWeights(counts[start:start+_chunkSize], finite)
+        if ev_table.ndim == 2:
+            edge[start:start+_chunkSize] = -np.dot(weights.reshape((-1, 1000)), 
+                    ev_table[:,inds].ravel())
+        else:
+            evdeal = ev_table[start:start+_chunkSize][:,:,inds]
+            edge[start:start+_chunkSize] = -np.sum((weights*evdeal).reshape((-1, 1000)), axis=1)
+    if single:
+        return edge[0]
+    return edge
 
 def getChartIndFromCards(my_hand, dealer_hand):
 
@@ -189,192 +904,351 @@ def getChartIndFromCards(my_hand, dealer_hand):
 
     return (dealer_ind.value, my_ind.value) 
 
-
-# simulates a hand of blackjack given the optimal strategy
-def simulateGame(max_hands=50, num_decks=6, num_players=4, rules=vegasRules, strategy='omniscient', seed=None):
-
-    if seed is None:
-        _caco.seed_rand(c_int(int(1000*time.time())))
+# the chart indices (dealer_ind, my_ind) for arrays of hands, as chart_ind_from_hands()
+def getChartInds(dealer_up, points, softness, ispair):
+    points = np.asarray(points, dtype=np.intp)
+    my_ind = np.where(ispair, 35-points//2, np.where(softness, 36-points, 19-points))
+    return np.asarray(dealer_up, dtype=np.intp)-2, my_ind
+
+# the secondary option for each action when it is not allowed,
+# as in table_action(): surrender to stand or hit, double and split to hit,
+# and hit to stand
+_fallbackUnder17 = np.array([STAND, STAND, HIT, HIT, HIT, STAND])
+_fallback17 = np.array([STAND, STAND, HIT, HIT, STAND, STAND])
+
+# looks up the actions for arrays of hands in a strategy table, with the
+# same fallbacks as the C solver for actions that are not allowed.
+# table is a Strategy, a (10,34) action chart, or an (actions, exps) pair
+# such as tables['default_table'] or the output of computeChart().
+# allowed is a (6,) or (N,6) mask of allowed actions, by default everything
+# but insurance, with splits limited to pairs. Hard totals over 19 stand, 
+# pairs of tens included, as in table_action().
+# Returns the action for each hand, and the table's EV for that action
+# (NaN for hard totals over 19), or None if the table has no EVs.
+def lookupActions(dealer_up, points, softness, ispair, table, allowed=None):
+    exps = None
+    if isinstance(table, Strategy):
+        actions = table.table()
+    elif isinstance(table, tuple):
+        actions, exps = table
     else:
-        _caco.seed_rand(c_int(seed))
-
-    shoe = Shoe(numdecks=num_decks)
-    dealer = Hand()
-    players = (num_players*Hand)() 
-
-    print ' == Begin hand =='
-
-    # one hand at a time for now
-    shoe.shuffle()
-    print 'Shoe:', shoe 
-    for p, player in enumerate(players):
-        dealCardToHand(shoe, player, way='random')
-    dealCardToHand(shoe, dealer, way='random')
-    print 'Starting hands:'
-    print ' - Dealer has', dealer 
-    for p, player in enumerate(players):
-        print ' - Player %d has'%p, player
-
-    print 'Shoe:', shoe 
-
-    # deal a second round of cards
-    dealer_peek = 0
-    for p, player in enumerate(players):
-        dealCardToHand(shoe, player, way='random')
-        dealer_peek |= _caco.blackjack(player)
-    if dealer_peek:
-        # TODO: still not right...
-        print ' - One or more players has blackjack. Dealer peeks!'
-        hole_card = _caco.random_card_from_shoe(byref(shoe))
-
-    print 'Shoe:', shoe 
-
-    # if dealer blackjack...
-
-    for p, player in enumerate(players):
-        print 'Player %d acting now:'%p 
-        print ' -', player
-
-        action, _ = getOptimalMove(shoe, dealer, player, strategy=strategy)
-        print ' - best action =', actionLabels[action]
-
-        if action == 0:
-            print ' - stood on', player
-
-        atmp = action
-        while atmp == 1:
-            dealCardToHand(shoe, player, way='random')
-            print ' - hit and got', player
-            atmp, _ = getOptimalMove(shoe, dealer, player, strategy=strategy)
-
-        if action == 2:
-            dealCardToHand(shoe, player, way='random')
-            print ' - doubled and got', player
-
-        if action == 3:
-            print ' - no splits yet!' 
-
-        #if action == 3:
-
-
-
-    #if _caco.blackjack(dealer):
-
-    #for h in xrange(max_hands):
-        ## todo: when to shuffle?
-        #shoe.shuffle()
-
-
-def plotChart(ar, title=None, cmap=None,
-        vrange=None, grid=True, textarr=None, textfmt=None, contours=None):
-
-    # set up the axes 
-    fig, ax = plt.subplots(3, 1, figsize=(10, 20), gridspec_kw={'height_ratios': [16./35.,9./35.,10./35.]},sharex=True)
-    fig.subplots_adjust(hspace=0.02)
-    if title is not None:
-        ax[0].set_title(title, fontsize=18) 
-    dticks = np.linspace(2, 10, 11)
-    for axx in ax:
-        if grid:
-            axx.grid(ls='-', lw=0.3)
-        axx.set_xticks(dticks)
-        axx.set_xticks(dticks+0.4, minor=True)
-        axx.set_xticklabels('')
-        axx.set_yticklabels('')
-    hardticks = np.linspace(5, 20, 16)
-    ax[0].set_yticks(hardticks)
-    ax[0].set_yticks(hardticks+0.4, minor=True)
-    ax[0].set_yticklabels(["%d"%i for i in range(5,20)], minor=True)
-    ax[0].set_ylabel("Hard hands")
-    softticks = np.linspace(13, 21, 10)
-    ax[1].set_yticks(softticks)
-    ax[1].set_yticks(softticks+0.4, minor=True)
-    ax[1].set_yticklabels(["A,%d"%(i-11) for i in range(13,22)], minor=True)
-    ax[1].set_ylabel("Soft hands")
-    pairticks = np.linspace(2, 11, 11)
-    ax[2].set_yticks(pairticks)
-    ax[2].set_yticks(pairticks+0.4, minor=True)
-    ax[2].set_yticklabels(["%s,%s"%(cardLabels[i], cardLabels[i]) for i in xrange(2,12)], minor=True)
-    ax[2].set_ylabel("Pairs")
-    ax[2].set_xticklabels(["%s"%(cardLabels[i]) for i in xrange(2,12)], minor=True)
-    ax[2].set_xlabel("Dealer up")
-
-    # plot it
-    if vrange is None:
-        vrange = (np.min(ar), np.max(ar))
-    if cmap is None:
-        cmap = colors.ListedColormap(['green','yellow','red','cyan','white'])
-        bounds = [0,1,2,3,4,5] 
-        norm = colors.BoundaryNorm(bounds, cmap.N)
+        actions = table
+    actions = np.asarray(actions)
+    dealer_up, points, softness, ispair = np.broadcast_arrays(np.asarray(dealer_up, dtype=np.intp),
+            np.asarray(points, dtype=np.intp), np.asarray(softness, dtype=bool),
+            np.asarray(ispair, dtype=bool))
+    if allowed is None:
+        allowed = np.ones((points.size, 6), dtype=bool)
+        allowed[:,INSURANCE] = False
+        allowed[:,SPLIT] = ispair.ravel()
     else:
-        norm = None
-
-    imargs = {'interpolation': 'nearest', 'aspect': 'auto', 'cmap': cmap, 'vmin': vrange[0],
-            'vmax': vrange[1], 'norm': norm}
-    hard_actions = ar[:,:15]
-    imargs['extent'] = [2,10,5,20] 
-    ax[0].imshow(hard_actions.T, **imargs)
-    soft_actions = ar[:,15:24]
-    imargs['extent'] = [2,10,13,21] 
-    ax[1].imshow(soft_actions.T, **imargs)
-    split_actions = ar[:,24:34]
-    imargs['extent'] = [2,10,2,11] 
-    ax[2].imshow(split_actions.T, **imargs)
-
-    # draw contours
-    if contours is not None:
-        for area, char in zip(contours, ['X','O']):
-            for ind in area:
-                if ind[1] < 16:
-                    ax[0].text(dticks[ind[0]]+0.4, 26-hardticks[ind[1]]+0.4, char, va='center', ha='center')
-                elif ind[1] < 25:
-                    print ind[1]
-                    ax[1].text(dticks[ind[0]]+0.4, 33-softticks[ind[1]-16]+0.4, char, va='center', ha='center')
-                else:
-                    ax[2].text(dticks[ind[0]]+0.4, 12-pairticks[ind[1]-25]+0.4, char, va='center', ha='center')
-    
-    # draw text if asked for
-    if textarr is not None and textfmt is not None:
-        hard_text = textarr[:,:15]
-        for d in xrange(0, 10):
-            for m in xrange(0, 15):
-                ax[0].text(dticks[d]+0.4, (24-hardticks[m])+0.4, textfmt(hard_text[d,m],
-                    hard_actions[d,m]), va='center', ha='center')
-        soft_text = textarr[:,15:24]
-        for d in xrange(0, 10):
-            for m in xrange(0, 9):
-                ax[1].text(dticks[d]+0.4, (33-softticks[m])+0.4, textfmt(soft_text[d,m],
-                    soft_actions[d,m]), va='center', ha='center')
-        pair_text = textarr[:,24:34]
-        for d in xrange(0, 10):
-            for m in xrange(0, 10):
-                ax[2].text(dticks[d]+0.4, (12-pairticks[m])+0.4, textfmt(pair_text[d,m],
-                    split_actions[d,m]), va='center', ha='center')
-    
-    plt.show()
-    return fig, ax
-
-
-
-def getChartContours(ar):
-
-
-    sorted_inds = np.dstack(np.unravel_index(np.argsort(ar.ravel()), ar.shape))[0]
-
-    # tally a cumulative probabilty through the sorted cells, breaking at 
-    # standard deviations from the unit bet
-    one_sigma = []
-    two_sigma = []
-    cumprb = 0.0
-    invartot = 1.0/np.sum(ar)
-    for ind in sorted_inds: 
-        ind = tuple(ind)
-        prb = np.abs(ar[ind]*invartot)
-        if cumprb < 0.6827:
-            one_sigma.append(ind)
-        elif cumprb < 0.9545:
-            two_sigma.append(ind)
-        cumprb += prb
-
-    return one_sigma, two_sigma
+        allowed = np.broadcast_to(np.asarray(allowed, dtype=bool), (points.size, 6))
+
+    # hard 20 and 21 are off the chart and always stand
+    dealer_ind, my_ind = getChartInds(dealer_up, points, softness, ispair)
+    offchart = (points > 19) & ~softness
+    my_ind = np.where(offchart, 0, my_ind)
+    action = np.where(offchart, STAND, actions[dealer_ind, my_ind]).ravel()
+
+    # fall back until the action is allowed. A disallowed stand has
+    # nowhere to go and is kept, where table_action() would never return.
+    rows = np.arange(points.size)
+    high = (points >= 17).ravel()
+    while True:
+        blocked = ~allowed[rows, action]
+        fallback = np.where(blocked, np.where(high, _fallback17[action],
+                _fallbackUnder17[action]), action)
+        if np.all(fallback == action):
+            break
+        action = fallback
+    action = action.reshape(points.shape)
+
+    if exps is None:
+        return action, None
+    exp = np.asarray(exps)[dealer_ind, my_ind, action]
+    return action, np.where(offchart, np.nan, exp)
+
+
+# plays rounds of blackjack from a strategy table, entirely in C.
+# Returns the net result of each round for each seat, shape (max_hands, num_players),
+# and the Game, which holds the running mean, variance and standard error.
+def simulateGame(max_hands=50, num_decks=6, num_players=4, rules=None, strategy=None, seed=None,
+        penetration=0.75, peek=True, stream=0, chunk_rounds=None, path=None, system='hilo'):
+    game = Game(num_decks=num_decks, num_seats=num_players, rules=rules, strategy=strategy,
+            penetration=penetration, peek=peek, seed=seed, stream=stream, system=system)
+    if chunk_rounds is not None or path is not None:
+        return game.playChunks(max_hands, chunk_rounds=chunk_rounds or 1<<16, path=path), game
+    net = game.play(max_hands)
+    return net, game
+
+# plays one table for simulateTables(), in a worker process
+def _simulateTable(args):
+    index, game_args, seed, num_rounds = args
+    tstart = time.time()
+    game = Game(seed=seed, stream=index, **game_args)
+    game.simulate(num_rounds)
+    return {'table': index, 'seed': seed, 'stream': index, 'num_decks': game.shoe.numdecks,
+            'num_seats': game.numseats, 'penetration': game.penetration, 'rounds': game.rounds,
+            'shuffles': game.shuffles, 'mean': game.mean, 'var': game.var, 'stderr': game.stderr,
+            'seconds': time.time()-tstart}
+
+# plays many independent tables, spread over a pool of processes.
+# tables is a number of identical tables, or a list of dicts of Game arguments
+# (num_decks, num_seats, rules, strategy with one per seat, penetration, ...), 
+# one for each table, with game_args filling in whatever they leave out.
+# Table i plays num_rounds rounds on stream i of the seed, so results do not 
+# depend on the number of processes. 
+# Returns a dict with the results of each table, and each seat's net result per
+# round (its win rate), variance and standard error merged over every table that 
+# has that seat.
+def simulateTables(tables, num_rounds, seed=None, processes=None, **game_args):
+    if num_rounds < 1:
+        raise ValueError("Each table must play at least one round.")
+    if seed is None:
+        seed = randomSeed()
+    if not isinstance(tables, (list, tuple)):
+        tables = tables*[{}]
+    if not tables:
+        raise ValueError("At least one table is needed.")
+    jobs = [(i, dict(game_args, **table), seed, num_rounds) for i, table in enumerate(tables)]
+    tstart = time.time()
+    if processes == 1:
+        results = map(_simulateTable, jobs)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=processes)
+        try:
+            results = pool.map(_simulateTable, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    seconds = time.time()-tstart
+
+    # merge each seat's statistics over the tables, in table order
+    numseats = max(r['num_seats'] for r in results)
+    rounds = np.zeros(numseats, dtype=np.int64)
+    mean = np.zeros(numseats, dtype=np.float64)
+    m2 = np.zeros(numseats, dtype=np.float64)
+    for r in results:
+        for s in xrange(r['num_seats']):
+            n = rounds[s]+r['rounds']
+            delta = r['mean'][s]-mean[s]
+            mean[s] += delta*r['rounds']/n
+            m2[s] += r['var'][s]*max(r['rounds']-1, 1) + delta**2*rounds[s]*r['rounds']/n
+            rounds[s] = n
+    var = m2/np.maximum(rounds-1, 1)
+    total = sum(r['rounds']*r['num_seats'] for r in results)
+    return {'seed': seed, 'tables': results, 'seconds': seconds,
+            'rounds_per_second': sum(r['rounds'] for r in results)/seconds,
+            'hands_per_second': total/seconds,
+            'seats': {'rounds': rounds, 'mean': mean, 'var': var, 'stderr': np.sqrt(var/np.maximum(rounds, 1))}}
+
+
+# an append-only file of simulated round records. A fixed-size header holds
+# the number of records committed, the game's state after the last of them 
+# and, from metaOffset, the game's metadata. The records follow as raw 
+# roundRecordDtype, so the file is read without copying by np.memmap. 
+# Records past the committed count (from an interrupted write) are ignored 
+# and overwritten by the next append. Only the same game (by its metadata) 
+# can append to an existing file, see Game.openRecords().
+class RecordFile(object):
+
+    magic = 'COCASIM\0'
+    formatVersion = 2
+    headerSize = 4096
+    metaOffset = 1024
+
+    def __init__(self, path, metadata=None, state=None):
+        self.path = path
+        if not os.path.exists(path):
+            if metadata is None:
+                raise IOError("No record file at %s." % path)
+            meta = json.dumps(metadata, sort_keys=True).encode('utf-8')
+            if self.metaOffset+len(meta) > self.headerSize:
+                raise ValueError("Record metadata does not fit in the header.")
+            with open(path, 'wb') as f:
+                header = self.magic + struct.pack('<II', self.formatVersion, len(meta))
+                header += self.counts(0, state)
+                header += '\0'*(self.metaOffset-len(header)) + meta
+                f.write(header + '\0'*(self.headerSize-len(header)))
+        with open(path, 'rb') as f:
+            header = f.read(self.headerSize)
+        if len(header) < self.headerSize or header[:8] != self.magic:
+            raise IOError("%s is not a record file." % path)
+        version, length = struct.unpack('<II', header[8:16])
+        if version != self.formatVersion:
+            raise IOError("%s has record format version %d, not %d." % (path, version,
+                    self.formatVersion))
+        self.numrecords, statelen = struct.unpack('<QI', header[16:28])
+        self.state = json.loads(header[28:28+statelen].decode('utf-8')) if statelen else None
+        self.metadata = json.loads(header[self.metaOffset:self.metaOffset+length].decode('utf-8'))
+        if metadata is not None and json.loads(json.dumps(metadata)) != self.metadata:
+            raise ValueError("%s holds records from a different game." % path)
+
+    # the record count and game state, as packed from byte 16 of the header
+    def counts(self, numrecords, state):
+        state = json.dumps(state, sort_keys=True).encode('utf-8') if state is not None else ''
+        if 28+len(state) > self.metaOffset:
+            raise ValueError("Game state does not fit in the header.")
+        return struct.pack('<QI', numrecords, len(state)) + state
+
+    def __len__(self):
+        return self.numrecords
+
+    # grows the file by num_records and returns them as a writable memory map
+    def append(self, num_records):
+        offset = self.headerSize + self.numrecords*roundRecordDtype.itemsize
+        with open(self.path, 'r+b') as f:
+            f.truncate(offset + num_records*roundRecordDtype.itemsize)
+        return np.memmap(self.path, dtype=roundRecordDtype, mode='r+', offset=offset,
+                shape=(num_records,))
+
+    # flushes records returned by append() and counts them in the header,
+    # along with the game's state after them, in a single write
+    def commit(self, records, state=None):
+        records.flush()
+        self.numrecords += len(records)
+        self.state = json.loads(json.dumps(state)) if state is not None else None
+        with open(self.path, 'r+b') as f:
+            f.seek(16)
+            f.write(self.counts(self.numrecords, state))
+
+    # all committed records, memory-mapped read-only
+    def records(self):
+        if self.numrecords == 0:
+            return np.zeros(0, dtype=roundRecordDtype)
+        return np.memmap(self.path, dtype=roundRecordDtype, mode='r', offset=self.headerSize,
+                shape=(self.numrecords,))
+
+def openRecords(path):
+    return RecordFile(path).records()
+
+
+# card-counting tags for cards 2-11
+countingSystems = {
+    'hilo': [1, 1, 1, 1, 1, 0, 0, 0, -1, -1],
+    'ko': [1, 1, 1, 1, 1, 1, 0, 0, -1, -1],
+    'zen': [1, 1, 2, 2, 2, 1, 0, 0, -2, -1],
+    'omega2': [1, 1, 2, 2, 2, 1, 0, -1, -2, 0],
+}
 
+# the true count of a shoe: the running count of the cards dealt so far, 
+# per deck remaining. counts may be a Shoe or rank counts for cards 2-11.
+def trueCount(counts, numdecks, system='hilo'):
+    if isinstance(counts, Shoe):
+        counts = counts.num[2:12]
+    tags = countingSystems[system]
+    full = [4*numdecks]*8 + [16*numdecks, 4*numdecks]
+    running = 0
+    remaining = 0
+    for c in xrange(10):
+        running += tags[c]*(full[c]-counts[c])
+        remaining += counts[c]
+    return 52.0*running/max(remaining, 1)
+
+# strategy and EV tables solved for shoe compositions binned by true count,
+# for several deck counts, as built by deviations.py 
+class DeviationTable(object):
+
+    def __init__(self, path):
+        data = np.load(path)
+        self.path = path
+        self.system = str(data['system'])
+        self.decks = [int(d) for d in data['decks']]
+        self.bins = np.array(data['bins'], dtype=np.float64)
+        if 'step' in data.files:
+            self.step = float(data['step'])
+        else:
+            self.step = self.bins[1]-self.bins[0] if len(self.bins) > 1 else 1.0
+        self.samples = np.array(data['samples'])
+        self.compositions = np.array(data['compositions'])
+        self.actions = np.array(data['actions'])
+        self.exps = np.array(data['exps'])
+        self.rules = json.loads(str(data['rules']))
+
+        # the rules as plain Python values, so that lookup() does
+        # not build Rules or numpy arrays for every hand
+        rules = Rules(**self.rules)
+        self.allowed = [bool(a) for a in rules.allowed]
+        self.allowed[INSURANCE] = False
+        self.double_after_split = rules.double_after_split > 0
+        self.max_split_depth = rules.max_split_depth
+        self.fallback = (_fallbackUnder17.tolist(), _fallback17.tolist())
+
+        # the nearest bin holding a solved table, for every bin,
+        # or -1 for a deck count with no solved bins at all
+        self.nearest = -np.ones(self.samples.shape, dtype=np.intp)
+        for d in xrange(len(self.decks)):
+            solved = np.nonzero(self.samples[d])[0]
+            if not len(solved):
+                continue
+            for b in xrange(len(self.bins)):
+                self.nearest[d,b] = solved[np.argmin(np.abs(solved-b))]
+
+    # the (deck, bin) index for this shoe
+    def index(self, shoe):
+        if shoe.numdecks not in self.decks:
+            raise ValueError("No deviation tables for a %d-deck shoe." % shoe.numdecks)
+        d = self.decks.index(shoe.numdecks)
+        if self.nearest[d,0] < 0:
+            raise ValueError("No true count bin was solved for a %d-deck shoe." % shoe.numdecks)
+        tc = trueCount(shoe, shoe.numdecks, system=self.system)
+        b = int(round((tc-self.bins[0])/self.step))
+        return d, self.nearest[d, min(max(b, 0), len(self.bins)-1)]
+
+    # returns the best action and the EVs for all actions, from the chart
+    # solved for the true count bin nearest to this shoe. Actions the table's
+    # rules do not allow for this hand fall back as in lookupActions().
+    # Hard 20 and 21, pairs of tens included, stand with no EVs.
+    def lookup(self, shoe, dealer_hand, my_hand):
+        points = my_hand.points
+        if points > 19 and not my_hand.softness:
+            return STAND, None
+        d, b = self.index(shoe)
+
+        # the chart cell, as in getChartInds()
+        dealer_ind = dealer_hand.points-2
+        if my_hand.ispair:
+            my_ind = 35-points//2
+        elif my_hand.softness:
+            my_ind = 36-points
+        else:
+            my_ind = 19-points
+        action = int(self.actions[d,b,dealer_ind,my_ind])
+
+        allowed = list(self.allowed)
+        allowed[DOUBLE] = allowed[DOUBLE] and my_hand.numcards == 2 and (my_hand.depth == 2
+                or self.double_after_split)
+        allowed[SPLIT] = allowed[SPLIT] and bool(my_hand.ispair
+                and my_hand.depth < 2+self.max_split_depth)
+        allowed[SURRENDER] = allowed[SURRENDER] and my_hand.depth <= 2 and dealer_hand.depth == 1
+        fallback = self.fallback[points >= 17]
+        while not allowed[action] and fallback[action] != action:
+            action = fallback[action]
+        return action, self.exps[d,b,dealer_ind,my_ind]
+
+_deviationTable = None
+def loadDeviationTable(path):
+    global _deviationTable
+    _deviationTable = DeviationTable(path)
+    return _deviationTable
+
+# returns the count-aware action and EVs for this hand, from the table 
+# loaded with loadDeviationTable() unless another one is given. 
+# Hard 20 and 21, pairs of tens included, always stand, with no EVs.
+def lookupAction(shoe, dealer_hand, my_hand, table=None):
+    if table is None:
+        table = _deviationTable
+    if table is None:
+        raise ValueError("No deviation table loaded, see loadDeviationTable().")
+    return table.lookup(shoe, dealer_hand, my_hand)
+
+
+# plotting lives in cocaplot, which is only imported when needed
+def plotChart(*args, **kwargs):
+    import cocaplot
+    return cocaplot.plotChart(*args, **kwargs)
+
+def getChartContours(*args, **kwargs):
+    import cocaplot
+    return cocaplot.getChartContours(*args, **kwargs)
@@ -4,6 +4,9 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <stdint.h>
+#include <pthread.h>
+#include <time.h>
 
 // define useful stuff
 #define STAND 0
@@ -13,6 +16,9 @@
 #define SURRENDER 4
 #define INSURANCE 5
 typedef double real;
+
+// bump whenever solver output changes, so stored tables are regenerated
+#define ENGINE_VERSION 3
 typedef struct {
 	int points;
 	int softness;
@@ -38,31 +44,553 @@ typedef struct {
 	int optimal; 
 } Strategy; 
 
+// xoshiro256** random number generator state.
+// Each stream is 2^128 draws apart from the last.
+typedef struct {
+	uint64_t s[4];
+} Rng;
+
+// transposition cache for expected_value()
+// entries are keyed on the full subproblem and
+// stored in sets of CACHE_WAYS with clock eviction
+#define CACHE_WAYS 4
+#define CACHE_VALID 1
+#define CACHE_USED 2
+typedef struct {
+	Hand hand;
+	Hand dealer;
+	Shoe shoe;
+	Rules rules;
+} CacheKey;
+typedef struct {
+	CacheKey key;
+	real exp[7]; // action values, or dealer outcome probabilities
+	real bet; // the bet these values were solved with
+	int action;
+	int flags;
+} CacheEntry;
+typedef struct {
+	CacheEntry* entries;
+	long numsets; // power of two
+	long numentries;
+	long hits, misses, inserts, evictions;
+	int exact; // only reuse entries solved with the same bet
+} Cache;
+typedef struct {
+	long capacity;
+	long numentries;
+	long hits, misses, inserts, evictions;
+} CacheStats;
+
+// opt-in counters of the work done by the solver
+typedef struct {
+	long nodes; // expected_value() subproblems visited
+	long expanded[6]; // subproblems spawned by each action
+	long pruned; // player branches cut by errtol
+	long dealer_solves; // dealer outcome distributions walked
+	long dealer_nodes; // dealer_draw() subtrees expanded
+	long dealer_pruned; // dealer draws cut by errtol
+	long cache_hits, cache_misses;
+	long dealer_cache_hits, dealer_cache_misses;
+	long max_depth; // deepest expected_value() recursion
+} SolverStats;
+
+// state shared by the whole recursive solve
+typedef struct {
+	Strategy* strategy;
+	Cache* cache; // NULL if caching is disabled
+	Cache* dealer_cache; // always on
+	SolverStats* stats; // NULL unless stats are enabled
+	int depth; // current expected_value() recursion depth
+	real pruned; // bound on the value cut off by errtol so far
+	real* action_pruned; // if not NULL, gets pruned for each action at the root
+	real deadline; // wall_time() to give up at, if > 0
+	long ticks;
+	int aborted; // passed the deadline, results are meaningless
+} Solver;
+
+// final dealer outcomes are 17-21, then these
+#define NUM_OUTCOMES 7
+#define OUTCOME_BLACKJACK 5
+#define OUTCOME_BUST 6
+#define DEALER_CACHE_SIZE (1<<16)
+
+// a Monte Carlo blackjack table, persistent between batches of rounds.
+// Keeps Welford running statistics of each seat's net result per round.
+#define MAX_SEATS 8
+#define MAX_HANDS 32
+#define HAND_LIVE 0
+#define HAND_BUST 1
+#define HAND_SURRENDERED 2
+typedef struct {
+	Shoe shoe;
+	Rules rules;
+	Rng rng;
+	real penetration; // fraction of the shoe dealt before reshuffling
+	int numseats;
+	int peek; // dealer checks for blackjack before anyone plays
+	long rounds;
+	long shuffles;
+	real mean[MAX_SEATS];
+	real m2[MAX_SEATS];
+	int tags[12]; // card counting tags, for the true count in RoundRecords
+} Game;
+
+// what happened to one seat in one round, for streaming simulations
+typedef struct {
+	int64_t round;
+	double net;
+	float true_count; // at the deal
+	int8_t seat;
+	int8_t dealer_card; // the up card, 2-11
+	int8_t chart_ind; // the seat's first two cards
+	int8_t action; // the first action on them, -1 if there was no choice
+	int8_t numhands; // after splitting
+} RoundRecord;
+
+// a full-chart solve shared between worker threads
+typedef struct {
+	Shoe* shoes; // every cell is solved for each shoe in turn
+	int numshoes;
+	Rules rules;
+	Strategy* strategy;
+	int* actions; // [numshoes][10][34]
+	real* exps; // [numshoes][10][34][6]
+	real* times; // [10][34] wall time per cell in seconds, for all shoes, or NULL
+	SolverStats* stats; // the threads' stats are summed here, or NULL
+	pthread_mutex_t lock; // guards stats
+	long cache_capacity; // per thread, 0 for no transposition cache
+	long dealer_cache_capacity; // per thread
+	int next_cell; // claimed atomically
+} ChartJob;
+
+// one hand solved against many shoe compositions, shared between worker threads
+typedef struct {
+	int* counts; // [n][10] number of 2..11 left in each shoe
+	long n;
+	int numdecks; // < 0 for infinite shoes
+	Hand hand, dealer;
+	Rules rules;
+	Strategy* strategy;
+	int* actions; // [n]
+	real* exps; // [n][6]
+	SolverStats* stats; // the threads' stats are summed here, or NULL
+	pthread_mutex_t lock; // guards stats
+	long block; // compositions per block, which share a transposition cache
+	long cache_capacity; // per thread
+	long next_block; // claimed atomically
+} CompositionJob;
+
 // prototypes
-void seed_rand(int seed);
+void seed_rand(uint64_t seed);
+int engine_version(void);
+void rng_seed(Rng* rng, uint64_t seed, int stream);
+void rng_jump(Rng* rng);
+uint64_t rng_next(Rng* rng);
+uint64_t rng_below(Rng* rng, uint64_t n);
+void random_cards_from_shoe(Shoe* shoe, Rng* rng, long numcards, int* cards);
 void init_shoe(Shoe* shoe, int numdecks);
 void init_hand(Hand* hand);
 int blackjack(Hand hand);
 int split_to_21(Hand hand);
 real choose_card_from_shoe(Shoe* shoe, int card);
+int random_card_from_shoe(Shoe* shoe, Rng* rng);
 void add_card_to_hand(Hand* hand, int card);
-int deal_card_to_hand_random(Shoe* shoe, Hand* hand);
+int deal_card_to_hand_random(Shoe* shoe, Hand* hand, Rng* rng);
 real deal_card_to_hand_choose(Shoe* shoe, Hand* hand, int card);
-void exp_stand(real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, real* exp);
-void expected_value(real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, Strategy strategy, int* best_action, real* all_exp);
+void exp_stand(Solver* solver, real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, real* exp);
+void exp_split(Solver* solver, real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, real* exp);
+void dealer_outcomes(Solver* solver, Hand dealer, Shoe shoe, Rules rules, real* outcomes);
+void dealer_draw(Solver* solver, real prb, Hand dealer, Shoe shoe, Rules rules, real* outcomes);
+int dealer_hits(Hand dealer, Rules rules);
+void get_dealer_outcomes(Hand dealer, Shoe shoe, Rules rules, real* outcomes);
+void expected_value(Solver* solver, real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, int* best_action, real* all_exp);
+void add_card_to_dealer(Hand* dealer, int card);
 void chart_ind_from_hands(Hand hand, Hand dealer, int* my_ind, int* dealer_ind); 
+int table_action(Strategy* strategy, Hand hand, Hand dealer, int* allowed);
+void simulate_rounds(Game* game, Strategy* strategies, long numrounds, real* net, RoundRecord* records);
+void play_round(Game* game, Strategy* strategies, real* net, RoundRecord* records);
+int play_hands(Game* game, Strategy* strategy, Hand dealer, Hand* hands, real* bets, int* status, int* first_action);
+real true_count(Game* game);
+real settle_hand(Hand hand, Hand dealer, real bet, int status);
+int draw_card(Game* game);
+void hands_from_chart_ind(int my_ind, int dealer_ind, Hand* hand, Hand* dealer);
+void compute_chart(Shoe shoe, Rules rules, Strategy* strategy, int numthreads, int* actions, real* exps, real* times);
+void compute_chart_exact(Shoe shoe, Rules rules, Strategy* strategy, int numthreads, long max_bytes, int* actions, real* exps, real* times);
+void compute_charts(Shoe* shoes, int numshoes, Rules rules, Strategy* strategy, int numthreads, int exact, long max_bytes, int* actions, real* exps, real* times);
+void run_chart_job(ChartJob* job, int numthreads);
+void* compute_chart_worker(void* arg);
+void solve_chart_cell(Solver* solver, Shoe shoe, Rules rules, int my_ind, int dealer_ind, int* best_action, real* exps);
+void evaluate_compositions(int* counts, long n, int numdecks, Hand hand, Hand dealer, Rules rules, Strategy* strategy, int numthreads, long block, long cache_capacity, int* actions, real* exps);
+void* evaluate_compositions_worker(void* arg);
 void simulate_unit_bet(Hand hand, Hand dealer, Shoe shoe, Rules rules, Strategy strategy, int* best_action, real* all_exp);
+int simulate_unit_bet_bounded(Hand hand, Hand dealer, Shoe shoe, Rules rules, Strategy strategy, real deadline, int* best_action, real* all_exp, real* bounds);
+void init_solver(Solver* solver, Strategy* strategy);
+int cache_enable(long capacity, int exact);
+void cache_disable(void);
+void cache_clear(void);
+void cache_reset(Cache* cache);
+void cache_get_stats(CacheStats* stats);
+Cache* cache_new(long capacity);
+long cache_capacity_for_bytes(long bytes);
+void cache_free(Cache* cache);
+CacheEntry* cache_find(Cache* cache, CacheKey* key);
+void cache_store(Cache* cache, CacheKey* key, real bet, int action, real* vals, int numvals);
+void cache_make_key(CacheKey* key, Hand hand, Hand dealer, Shoe shoe, Rules rules);
+unsigned long cache_hash(CacheKey* key);
+Cache* get_dealer_cache(void);
+void make_dealer_cache_key(void);
+void free_dealer_cache(void* cache);
+void stats_enable(int enable);
+void stats_reset(void);
+void stats_get(SolverStats* stats);
+void stats_add(SolverStats* total, SolverStats* stats);
+real wall_time(void);
+
+// the process-wide transposition cache, opt-in from Python
+Cache* global_cache = NULL;
+
+// each thread's dealer outcome cache, allocated on first use and freed 
+// when the thread exits, so that concurrent calls never share one
+pthread_key_t dealer_cache_key;
+pthread_once_t dealer_cache_once = PTHREAD_ONCE_INIT;
+
+// the process-wide solver stats, opt-in from Python
+SolverStats global_stats;
+int stats_enabled = 0;
+
+// the default random stream, for callers that do not bring their own 
+Rng global_rng = {{0x9e3779b97f4a7c15UL, 0xbf58476d1ce4e5b9UL, 0x94d049bb133111ebUL, 0x2545f4914f6cdd1dUL}};
+
+// the version of the solver, recorded with stored tables
+int engine_version(void) {
+	return ENGINE_VERSION;
+}
 
 // the main function
 void simulate_unit_bet(Hand hand, Hand dealer, Shoe shoe, Rules rules, Strategy strategy, int* best_action, real* all_exp) {
 
+	Solver solver;
+	init_solver(&solver, &strategy);
+	solver.cache = strategy.optimal? global_cache : NULL; // table lookups are not cached
+	solver.dealer_cache = get_dealer_cache();
+
 	// simulate on the whole unit bet
 	// NOTE: assumes that all allowed moves have been passed correctly!
-	expected_value(1.0, hand, dealer, shoe, rules, strategy, best_action, all_exp);
+	expected_value(&solver, 1.0, hand, dealer, shoe, rules, best_action, all_exp);
+}
+
+// as simulate_unit_bet(), but also gives a bound on how far errtol pruning 
+// can have moved each action's value in bounds[6]. Gives up and returns 0 
+// once wall_time() passes the deadline, if it is > 0. 
+int simulate_unit_bet_bounded(Hand hand, Hand dealer, Shoe shoe, Rules rules, Strategy strategy, real deadline, int* best_action, real* all_exp, real* bounds) {
+
+	Solver solver;
+	init_solver(&solver, &strategy);
+	solver.cache = strategy.optimal? global_cache : NULL;
+	solver.dealer_cache = get_dealer_cache();
+	solver.action_pruned = bounds;
+	solver.deadline = deadline;
+	memset(bounds, 0, 6*sizeof(real));
+	expected_value(&solver, 1.0, hand, dealer, shoe, rules, best_action, all_exp);
+	return !solver.aborted;
+}
+
+// a solver with no caches, stats or deadline
+void init_solver(Solver* solver, Strategy* strategy) {
+	memset(solver, 0, sizeof(Solver));
+	solver->strategy = strategy;
+	solver->stats = stats_enabled? &global_stats : NULL;
+}
+
+// solves all 10x34 chart cells, each on the shoe left after its deal
+// (see solve_chart_cell()), spreading them over numthreads threads.
+// Each thread keeps private caches, and a cell's result never depends 
+// on what else a thread has solved, so the chart is bit-identical for any
+// number of threads. The transposition cache runs in exact mode here. 
+// If times is not NULL, it gets the wall time spent on each cell. 
+void compute_chart(Shoe shoe, Rules rules, Strategy* strategy, int numthreads, int* actions, real* exps, real* times) {
+	compute_charts(&shoe, 1, rules, strategy, numthreads, 0, 0, actions, exps, times);
+}
+
+// solves the chart with no errtol pruning at all. Every subproblem, for the 
+// player and the dealer, is memoized on its remaining shoe, so the tree walk
+// becomes dynamic programming over the cards removed from the shoe. 
+// The caches of all threads together hold at most max_bytes; entries 
+// evicted past that are just solved again, so the results stay exact.
+// A quarter of the memory goes to the dealer outcomes. 
+void compute_chart_exact(Shoe shoe, Rules rules, Strategy* strategy, int numthreads, long max_bytes, int* actions, real* exps, real* times) {
+	compute_charts(&shoe, 1, rules, strategy, numthreads, 1, max_bytes, actions, exps, times);
+}
+
+// solves the chart for each of numshoes shoes, as compute_chart(), or as
+// compute_chart_exact() if exact. Each thread solves a cell for every shoe 
+// in turn on the same caches, so shoes that differ by a few cards share 
+// the subproblems they have in common. The caches are private to the job,
+// so in exact mode a table strategy is memoized too.
+void compute_charts(Shoe* shoes, int numshoes, Rules rules, Strategy* strategy, int numthreads, int exact, long max_bytes, int* actions, real* exps, real* times) {
+
+	ChartJob job;
+
+	if(numthreads < 1) 
+		numthreads = 1;
+	job.shoes = shoes;
+	job.numshoes = numshoes;
+	job.strategy = strategy;
+	job.actions = actions;
+	job.exps = exps;
+	job.times = times;
+	if(exact) {
+		rules.errtol = 0.0;
+		job.cache_capacity = cache_capacity_for_bytes(3*(max_bytes/4)/numthreads);
+		job.dealer_cache_capacity = cache_capacity_for_bytes(max_bytes/4/numthreads);
+	}
+	else {
+		job.cache_capacity = 0;
+		if(global_cache && strategy->optimal)
+			job.cache_capacity = global_cache->numsets*CACHE_WAYS/numthreads;
+		job.dealer_cache_capacity = DEALER_CACHE_SIZE;
+	}
+	job.rules = rules;
+	run_chart_job(&job, numthreads);
+}
+
+// runs the chart job over numthreads worker threads
+void run_chart_job(ChartJob* job, int numthreads) {
+
+	int t, started;
+	pthread_t* threads;
+
+	job->stats = stats_enabled? &global_stats : NULL;
+	pthread_mutex_init(&job->lock, NULL);
+	job->next_cell = 0;
+
+	// workers take cells until none are left, so if some threads
+	// cannot be started the rest do their share, and with no threads
+	// at all the calling thread does the whole job
+	threads = (pthread_t*) malloc(numthreads*sizeof(pthread_t));
+	started = 0;
+	while(threads && started < numthreads
+			&& !pthread_create(&threads[started], NULL, compute_chart_worker, job))
+		started++;
+	if(!started)
+		compute_chart_worker(job);
+	for(t = 0; t < started; ++t)
+		pthread_join(threads[t], NULL);
+	pthread_mutex_destroy(&job->lock);
+	free(threads);
+}
+
+void* compute_chart_worker(void* arg) {
+
+	int cell, my_ind, dealer_ind, s, ind;
+	real tstart;
+	Solver solver;
+	SolverStats stats;
+	ChartJob* job;
+	job = (ChartJob*) arg;
+
+	// count into private stats, summed into the job's at the end
+	memset(&stats, 0, sizeof(SolverStats));
+	init_solver(&solver, job->strategy);
+	solver.stats = job->stats? &stats : NULL;
+	solver.dealer_cache = cache_new(job->dealer_cache_capacity);
+	solver.cache = NULL;
+	if(job->cache_capacity > 0) {
+		solver.cache = cache_new(job->cache_capacity);
+		if(solver.cache)
+			solver.cache->exact = 1;
+	}
+
+	// claim cells one at a time, pairs first since they are the slowest
+	while((cell = __sync_fetch_and_add(&job->next_cell, 1)) < 340) {
+		my_ind = 33 - cell/10;
+		dealer_ind = cell%10;
+		tstart = wall_time();
+		for(s = 0; s < job->numshoes; ++s) {
+			ind = 340*s + 34*dealer_ind + my_ind;
+			solve_chart_cell(&solver, job->shoes[s], job->rules, my_ind, dealer_ind,
+					&job->actions[ind], &job->exps[6*ind]);
+		}
+		if(job->times)
+			job->times[34*dealer_ind+my_ind] = wall_time() - tstart;
+	}
+
+	if(job->stats) {
+		pthread_mutex_lock(&job->lock);
+		stats_add(job->stats, &stats);
+		pthread_mutex_unlock(&job->lock);
+	}
+
+	cache_free(solver.cache);
+	cache_free(solver.dealer_cache);
+	return NULL;
+}
+
+// solves one chart cell on the shoe left after the deal, i.e. with the 
+// dealer's up card and the player's two cards removed from it. A hard total 
+// can be dealt as several pairs of cards (never aces or a pair), so its values
+// are the average over those, weighted by how likely each is given the up card.
+// The best action is the best for the total, and the chart's values weighted
+// by the deal probabilities give the house edge of playing it exactly.
+// Drawing from an infinite shoe leaves it unchanged, so there this is 
+// a single solve of the cell's representative hand.
+void solve_chart_cell(Solver* solver, Shoe shoe, Rules rules, int my_ind, int dealer_ind, int* best_action, real* exps) {
+
+	int a, c0, c1;
+	real w, wsum, max_exp, exptmp[6];
+	Hand hand, dealer;
+	Shoe stmp;
+
+	hands_from_chart_ind(my_ind, dealer_ind, &hand, &dealer);
+	choose_card_from_shoe(&shoe, dealer_ind+2);
+	if(my_ind >= 24) {
+		choose_card_from_shoe(&shoe, 35-my_ind);
+		choose_card_from_shoe(&shoe, 35-my_ind);
+	}
+	else if(my_ind >= 15) {
+		choose_card_from_shoe(&shoe, 11);
+		choose_card_from_shoe(&shoe, 25-my_ind);
+	}
+	if(my_ind >= 15 || shoe.numdecks < 0) {
+		expected_value(solver, 1.0, hand, dealer, shoe, rules, best_action, exps);
+		return;
+	}
+
+	// a hard total, dealt as c0 < c1
+	memset(exps, 0, 6*sizeof(real));
+	wsum = 0.0;
+	for(c0 = 2; c0 <= 9; ++c0) {
+		c1 = hand.points - c0;
+		if(c1 <= c0 || c1 > 10 || shoe.num[c0] <= 0 || shoe.num[c1] <= 0)
+			continue;
+		w = ((real)shoe.num[c0])*shoe.num[c1];
+		stmp = shoe;
+		choose_card_from_shoe(&stmp, c0);
+		choose_card_from_shoe(&stmp, c1);
+		expected_value(solver, 1.0, hand, dealer, stmp, rules, best_action, exptmp);
+		for(a = 0; a < 6; ++a)
+			exps[a] += w*exptmp[a];
+		wsum += w;
+	}
+
+	// the total cannot be dealt from this shoe, so its values are never used
+	if(wsum <= 0.0) {
+		expected_value(solver, 1.0, hand, dealer, shoe, rules, best_action, exps);
+		return;
+	}
+	for(a = 0; a < 6; ++a)
+		exps[a] = (exptmp[a] <= -1000.0)? -1000.0 : exps[a]/wsum;
+
+	// a table strategy already gave the same action for every way to deal the total
+	if(solver->strategy->optimal) {
+		max_exp = -1000.0;
+		for(a = 0; a < 6; ++a) {
+			if(exps[a] > max_exp) {
+				*best_action = a;
+				max_exp = exps[a];
+			}
+		}
+	}
+}
+
+// solves one hand against n shoes given as counts of 2..11, spread over 
+// numthreads threads. The compositions are taken in blocks of the given size, 
+// each solved in order on one transposition cache, so that neighbouring 
+// compositions share the subproblems they reach in common. The cache starts 
+// empty for every block, so results do not depend on the number of threads.
+void evaluate_compositions(int* counts, long n, int numdecks, Hand hand, Hand dealer, Rules rules, Strategy* strategy, int numthreads, long block, long cache_capacity, int* actions, real* exps) {
+
+	int t, started;
+	pthread_t* threads;
+	CompositionJob job;
+
+	if(numthreads < 1) 
+		numthreads = 1;
+	if(block < 1)
+		block = 1;
+	job.counts = counts;
+	job.n = n;
+	job.numdecks = numdecks;
+	job.hand = hand;
+	job.dealer = dealer;
+	job.rules = rules;
+	job.strategy = strategy;
+	job.actions = actions;
+	job.exps = exps;
+	job.block = block;
+	job.cache_capacity = strategy->optimal? cache_capacity : 0;
+	job.next_block = 0;
+	job.stats = stats_enabled? &global_stats : NULL;
+	pthread_mutex_init(&job.lock, NULL);
+
+	// as in run_chart_job(), join only the threads that started
+	threads = (pthread_t*) malloc(numthreads*sizeof(pthread_t));
+	started = 0;
+	while(threads && started < numthreads
+			&& !pthread_create(&threads[started], NULL, evaluate_compositions_worker, &job))
+		started++;
+	if(!started)
+		evaluate_compositions_worker(&job);
+	for(t = 0; t < started; ++t)
+		pthread_join(threads[t], NULL);
+	pthread_mutex_destroy(&job.lock);
+	free(threads);
+}
+
+void* evaluate_compositions_worker(void* arg) {
+
+	int c;
+	long b, i, end;
+	Shoe shoe;
+	Solver solver;
+	SolverStats stats;
+	CompositionJob* job;
+	job = (CompositionJob*) arg;
+
+	// count into private stats, summed into the job's at the end
+	memset(&stats, 0, sizeof(SolverStats));
+	init_solver(&solver, job->strategy);
+	solver.stats = job->stats? &stats : NULL;
+	solver.dealer_cache = cache_new(DEALER_CACHE_SIZE);
+	solver.cache = NULL;
+	if(job->cache_capacity > 0) {
+		solver.cache = cache_new(job->cache_capacity);
+		if(solver.cache)
+			solver.cache->exact = (job->rules.errtol <= 0.0);
+	}
+
+	// claim blocks of compositions one at a time
+	init_shoe(&shoe, job->numdecks);
+	while((b = __sync_fetch_and_add(&job->next_block, 1)) * job->block < job->n) {
+		cache_reset(solver.cache);
+		end = (b+1)*job->block;
+		if(end > job->n)
+			end = job->n;
+		for(i = b*job->block; i < end; ++i) {
+			shoe.total = 0;
+			for(c = 0; c < 10; ++c) {
+				shoe.num[c+2] = job->counts[10*i+c];
+				shoe.total += shoe.num[c+2];
+			}
+			expected_value(&solver, 1.0, job->hand, job->dealer, shoe, job->rules,
+					&job->actions[i], &job->exps[6*i]);
+		}
+	}
+
+	if(job->stats) {
+		pthread_mutex_lock(&job->lock);
+		stats_add(job->stats, &stats);
+		pthread_mutex_unlock(&job->lock);
+	}
+
+	cache_free(solver.cache);
+	cache_free(solver.dealer_cache);
+	return NULL;
 }
 
 // returns the expected value for the best possible action for the given hand
-void expected_value(real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, Strategy strategy, int* best_action, real* all_exp) {
+void expected_value(Solver* solver, real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, int* best_action, real* all_exp) {
 
 
 	// from WIZARD of ODDS:
@@ -70,19 +598,76 @@ void expected_value(real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, St
 	// after a split, split up to three times except for aces, and draw only one card to split
 	// aces. Based on these rules, the player's expected value is -0.511734%.'
 
-	int c, c0, c1, a, batmp, dealer_ind, my_ind;
-	real max_exp, prb, prc0, prc1, exptmp[6];
-	Hand ht0, ht1, htmp;
-	Shoe st0, st1, stmp;
+	int c, a, batmp;
+	real max_exp, prb, exptmp[7], pstart, pact;
+	Hand htmp;
+	Shoe stmp;
 	Rules rtmp;
+	CacheKey key;
+	CacheEntry* entry;
+
+	// with no errtol pruning the values are linear in the bet, so solve 
+	// every subproblem on a unit bet and scale. Cached values are then
+	// exact for any bet, and do not depend on the order of the solve.
+	if(rules.errtol <= 0.0 && bet != 1.0) {
+		expected_value(solver, 1.0, hand, dealer, shoe, rules, best_action, all_exp);
+		for(a = 0; a < 6; ++a)
+			all_exp[a] *= bet;
+		return;
+	}
 
-	// return if the bet is << 1
+	// return if the bet is << 1, counting the most 
+	// this hand could have won or lost, with splits and doubles
 	if(bet < rules.errtol) {
+		if(solver->stats)
+			solver->stats->pruned++;
+		solver->pruned += 3.0*bet*((rules.allowed[SPLIT] && hand.ispair)? 2+rules.max_split_depth : 1);
 		*best_action = STAND;
 		all_exp[STAND] = 0.0;
 		return;
 	} 
 
+	// give up past the deadline, checking the clock every so often
+	if(solver->deadline > 0.0 && !(++solver->ticks & 1023) && wall_time() > solver->deadline)
+		solver->aborted = 1;
+	if(solver->aborted) {
+		*best_action = STAND;
+		memset(all_exp, 0, 6*sizeof(real));
+		return;
+	}
+	solver->depth++;
+	pstart = solver->pruned;
+	if(solver->stats) {
+		solver->stats->nodes++;
+		if(solver->depth > solver->stats->max_depth)
+			solver->stats->max_depth = solver->depth;
+	}
+
+	// reuse a cached solution if it was solved with at least this bet,
+	// i.e. its errtol pruning was at least as fine as ours would be.
+	// In exact mode, the bets must match so that results are bit-identical.
+	// A root that wants its per-action error bounds is always re-solved.
+	if(solver->cache) {
+		cache_make_key(&key, hand, dealer, shoe, rules);
+		entry = (solver->action_pruned && solver->depth == 1)? NULL : cache_find(solver->cache, &key);
+		if(entry && (solver->cache->exact? entry->bet == bet : entry->bet >= bet)) {
+			solver->cache->hits++;
+			if(solver->stats)
+				solver->stats->cache_hits++;
+			entry->flags |= CACHE_USED;
+			*best_action = entry->action;
+			max_exp = bet/entry->bet;
+			for(a = 0; a < 6; ++a)
+				all_exp[a] = max_exp*entry->exp[a];
+			solver->pruned += max_exp*entry->exp[6];
+			solver->depth--;
+			return;
+		}
+		solver->cache->misses++;
+		if(solver->stats)
+			solver->stats->cache_misses++;
+	}
+
 	// simulate the expected value of standing
 	// should always be allowed 
 	if(rules.allowed[STAND]) {
@@ -95,8 +680,13 @@ void expected_value(real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, St
 		}
 
 		// get the expected value of standing on this hand
-		exp_stand(bet, htmp, dealer, shoe, rules, &all_exp[STAND]);
+		if(solver->stats)
+			solver->stats->expanded[STAND]++;
+		exp_stand(solver, bet, htmp, dealer, shoe, rules, &all_exp[STAND]);
 	}
+	pact = solver->pruned;
+	if(solver->action_pruned && solver->depth == 1)
+		solver->action_pruned[STAND] = pact - pstart;
 
 	// simulate the expected value of hitting 
 	if(rules.allowed[HIT]) { // should be always
@@ -122,11 +712,16 @@ void expected_value(real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, St
 				all_exp[HIT] -= prb*bet;	
 			} 
 			else  {
-				expected_value(prb*bet, htmp, dealer, stmp, rtmp, strategy, &batmp, exptmp);
+				if(solver->stats)
+					solver->stats->expanded[HIT]++;
+				expected_value(solver, prb*bet, htmp, dealer, stmp, rtmp, &batmp, exptmp);
 				all_exp[HIT] += exptmp[batmp]; // use the action giving the highest expected outcome
 			}
 		}
 	}
+	if(solver->action_pruned && solver->depth == 1)
+		solver->action_pruned[HIT] = solver->pruned - pact;
+	pact = solver->pruned;
 
 	// simulate the expected value of doubling (allowed exactly one more card) 
 	if(rules.allowed[DOUBLE]) { 
@@ -142,61 +737,25 @@ void expected_value(real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, St
 				all_exp[DOUBLE] -= prb*2.0*bet;	
 			} 
 			else {
-				exp_stand(2.0*prb*bet, htmp, dealer, stmp, rules, exptmp);
+				if(solver->stats)
+					solver->stats->expanded[DOUBLE]++;
+				exp_stand(solver, 2.0*prb*bet, htmp, dealer, stmp, rules, exptmp);
 				all_exp[DOUBLE] += exptmp[0];
 			} 
 		}
 	}
+	if(solver->action_pruned && solver->depth == 1)
+		solver->action_pruned[DOUBLE] = solver->pruned - pact;
+	pact = solver->pruned;
 
 	// simulate splitting, if hand is a pair and splitting is allowed
 	// can only split up to a maximum depth 
 	rules.allowed[SPLIT] *= hand.ispair;
 	rules.allowed[SPLIT] *= (hand.depth < (2+rules.max_split_depth)); 
-	if(rules.allowed[SPLIT]) {
-
-		// Make the split hand
-		// Do not decrement the hand depth though!
-		htmp = hand; 
-		htmp.points /= 2; 
-		htmp.softness /= 2; 
-		htmp.numcards /= 2;
-		htmp.ispair = 0; 
-
-		// set up post-split rules
-		all_exp[SPLIT] = 0.0;
-		rtmp = rules;
-		if(htmp.points == 11 && !rtmp.can_hit_split_aces) {
-
-			// if the player splits aces, we can only take one more card
-			// unless splitting again, up to the max depth
-			rtmp.allowed[HIT] = 0; 
-			rtmp.allowed[DOUBLE] = 0;
-		}
-		else {
-
-			// player may double or hit after split, depending on the rules 
-			rtmp.allowed[DOUBLE] *= (rtmp.double_after_split > 0); 
-		}
-
-		// we must simulate all possible combinations of the next two cards
-		// to precisely capture the state of the deck after two subsequent draws 
-		for(c0 = 2; c0 <= 11; ++c0) {
-			st0 = shoe;
-			ht0 = htmp;
-			prc0 = deal_card_to_hand_choose(&st0, &ht0, c0); 
-			for(c1 = 2; c1 <= 11; ++c1) {
-				st1 = st0;
-				ht1 = htmp;
-				prc1 = deal_card_to_hand_choose(&st1, &ht1, c1); 
-
-				// play out the two sub-hand independently
-				expected_value(prc0*prc1*bet, ht0, dealer, st0, rtmp, strategy, &batmp, exptmp);
-				all_exp[SPLIT] += exptmp[batmp];
-				expected_value(prc0*prc1*bet, ht1, dealer, st1, rtmp, strategy, &batmp, exptmp);
-				all_exp[SPLIT] += exptmp[batmp];
-			}
-		}
-	}
+	if(rules.allowed[SPLIT])
+		exp_split(solver, bet, hand, dealer, shoe, rules, &all_exp[SPLIT]);
+	if(solver->action_pruned && solver->depth == 1)
+		solver->action_pruned[SPLIT] = solver->pruned - pact;
 
 	// if these two hands are freshly dealt, 
 	// do pre-play options and side bets
@@ -214,7 +773,7 @@ void expected_value(real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, St
 	for(a = 0; a < 6; ++a)
 		if(!rules.allowed[a])
 			all_exp[a] = -1000*bet;
-	if(strategy.optimal) {
+	if(solver->strategy->optimal) {
 		max_exp = -1000*bet;
 		for(a = 0; a < 6; ++a) {
 			if(all_exp[a] > max_exp) {
@@ -224,95 +783,488 @@ void expected_value(real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, St
 		}
 	}
 	else {
-		if(hand.points > 19 && !hand.softness) {
-			*best_action = STAND;
-		}
-		else {
-			chart_ind_from_hands(hand, dealer, &my_ind, &dealer_ind);
-			*best_action = strategy.actions[dealer_ind][my_ind];
-			while(!rules.allowed[*best_action]) {
-
-				// seconday options from the strategy chart
-				if(*best_action == SURRENDER) {
-					if(hand.points >= 17)
-						*best_action = STAND;
-					else
-						*best_action = HIT;
-				}
-				else if(*best_action == DOUBLE)
-					*best_action = HIT;
-				else if(*best_action == SPLIT)
-					*best_action = HIT;
-				else if(*best_action == HIT)
-					*best_action = STAND;
-			}
+		*best_action = table_action(solver->strategy, hand, dealer, rules.allowed);
+	}
+
+	// remember this solution for later, with the value it left out
+	if(solver->cache && !solver->aborted) {
+		for(a = 0; a < 6; ++a)
+			exptmp[a] = all_exp[a];
+		exptmp[6] = solver->pruned - pstart;
+		cache_store(solver->cache, &key, bet, *best_action, exptmp, 7);
+	}
+	solver->depth--;
+}
+
 
-			//if(!rules.allowed[*best_action]) {
-				//printf("STOP! action = %d, rules = %d %d %d %d %d %d \n", *best_action,
-						//rules.allowed[0], rules.allowed[1], rules.allowed[2], rules.allowed[3], rules.allowed[4], rules.allowed[5]);
-				//exit(0);
-			//}
+// the expected value of splitting a pair, playing out the two sub-hands independently.
+// The first sub-hand draws c0 and the second draws c1 after it, so the first does not
+// depend on c1 and is solved once for each c0, on the whole weight of c0. Drawing
+// from an infinite shoe leaves it unchanged, so there the second sub-hand does not
+// depend on c0 either and is solved once for each c1.
+// Each sub-hand keeps the pair's depth, so with its second card it is one deeper
+// and may split again while its depth < 2+max_split_depth, i.e. at most
+// max_split_depth splits along any line of play, as in play_hands().
+// Split aces get one card each and may only split again, unless can_hit_split_aces.
+void exp_split(Solver* solver, real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, real* exp) {
+
+	int c0, c1, batmp, second;
+	real prc0, prc1, exptmp[6];
+	Hand htmp, ht0, ht1;
+	Shoe st0, st1;
+
+	// Make the split hand
+	// Do not decrement the hand depth though!
+	htmp = hand; 
+	htmp.points /= 2; 
+	htmp.softness /= 2; 
+	htmp.numcards /= 2;
+	htmp.ispair = 0; 
+
+	// set up post-split rules
+	if(htmp.points == 11 && !rules.can_hit_split_aces) {
+		rules.allowed[HIT] = 0; 
+		rules.allowed[DOUBLE] = 0;
+	}
+	else {
+
+		// player may double or hit after split, depending on the rules 
+		rules.allowed[DOUBLE] *= (rules.double_after_split > 0); 
+	}
+
+	*exp = 0.0;
+	second = 1;
+	for(c0 = 2; c0 <= 11; ++c0) {
+		st0 = shoe;
+		ht0 = htmp;
+		prc0 = deal_card_to_hand_choose(&st0, &ht0, c0); 
+		if(prc0 <= 0.0)
+			continue;
+
+		// the first sub-hand
+		if(solver->stats)
+			solver->stats->expanded[SPLIT]++;
+		expected_value(solver, prc0*bet, ht0, dealer, st0, rules, &batmp, exptmp);
+		*exp += exptmp[batmp];
+
+		// the second sub-hand, for every c1 that can follow c0
+		if(!second)
+			continue;
+		second = (shoe.numdecks >= 0);
+		for(c1 = 2; c1 <= 11; ++c1) {
+			st1 = st0;
+			ht1 = htmp;
+			prc1 = deal_card_to_hand_choose(&st1, &ht1, c1); 
+			if(prc1 <= 0.0)
+				continue;
+			if(solver->stats)
+				solver->stats->expanded[SPLIT]++;
+			expected_value(solver, (second? prc0 : 1.0)*prc1*bet, ht1, dealer, st1, rules, &batmp, exptmp);
+			*exp += exptmp[batmp];
 		}
 	}
 }
 
+// gives the expected winnings if the player stands,
+// as a dot product against the dealer's final outcomes
+void exp_stand(Solver* solver, real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, real* exp) {
 
-// gives the expected winnings if the player stands
-void exp_stand(real bet, Hand hand, Hand dealer, Shoe shoe, Rules rules, real* exp) {
+	int d;
+	real outcomes[NUM_OUTCOMES], payoff[NUM_OUTCOMES], missing;
 
-	int c;
-	real prb, exptmp;
+	// stop if bet << 1
+	*exp = 0.0;
+	if(bet < rules.errtol) {
+		if(solver->stats)
+			solver->stats->pruned++;
+		solver->pruned += 1.5*bet;
+		return;
+	}
+
+	// split to 21 beats a non-blackjack dealer 21
+	// in all cases, push against dealer blackjack
+	if(blackjack(hand) || split_to_21(hand)) {
+		for(d = 17; d <= 21; ++d)
+			payoff[d-17] = blackjack(hand)? 1.5 : 1.0;
+		payoff[OUTCOME_BLACKJACK] = 0.0;
+		payoff[OUTCOME_BUST] = blackjack(hand)? 1.5 : 1.0;
+	}
+	else {
+		for(d = 17; d <= 21; ++d)
+			payoff[d-17] = (hand.points > d) - (hand.points < d);
+		payoff[OUTCOME_BLACKJACK] = -1.0;
+		payoff[OUTCOME_BUST] = 1.0;
+	}
+
+	dealer_outcomes(solver, dealer, shoe, rules, outcomes);
+	missing = 1.0;
+	for(d = 0; d < NUM_OUTCOMES; ++d) {
+		*exp += bet*payoff[d]*outcomes[d];
+		missing -= outcomes[d];
+	}
+
+	// the dealer draws that were pruned pay at most 1.5 either way 
+	if(missing > 0.0)
+		solver->pruned += 1.5*bet*missing;
+}
+
+// gives the probability of each final dealer hand
+// {17, 18, 19, 20, 21, blackjack, bust}.
+// These depend only on the dealer hand, the shoe and the 
+// soft 17 rule, so they are cached and shared by every player hand.
+void dealer_outcomes(Solver* solver, Hand dealer, Shoe shoe, Rules rules, real* outcomes) {
+
+	int d;
+	CacheKey key;
+	CacheEntry* entry;
+
+	// the dealer's key ignores the player and all other rules.
+	// Past the first two cards, the card count no longer matters.
+	memset(&key, 0, sizeof(CacheKey));
+	key.dealer = dealer;
+	if(dealer.numcards > 2) {
+		key.dealer.numcards = 3;
+		key.dealer.depth = 3;
+	}
+	key.shoe = shoe;
+	key.rules.dealer_hits_soft_17 = rules.dealer_hits_soft_17;
+	key.rules.errtol = rules.errtol;
+	if(solver->dealer_cache) {
+		entry = cache_find(solver->dealer_cache, &key);
+		if(entry) {
+			solver->dealer_cache->hits++;
+			if(solver->stats)
+				solver->stats->dealer_cache_hits++;
+			entry->flags |= CACHE_USED;
+			for(d = 0; d < NUM_OUTCOMES; ++d)
+				outcomes[d] = entry->exp[d];
+			return;
+		}
+		solver->dealer_cache->misses++;
+		if(solver->stats)
+			solver->stats->dealer_cache_misses++;
+	}
+
+	// walk the dealer's draws once and remember the result
+	memset(outcomes, 0, NUM_OUTCOMES*sizeof(real));
+	if(solver->stats)
+		solver->stats->dealer_solves++;
+	dealer_draw(solver, 1.0, dealer, shoe, rules, outcomes);
+	if(solver->dealer_cache)
+		cache_store(solver->dealer_cache, &key, 1.0, STAND, outcomes, NUM_OUTCOMES);
+}
+
+// recursively accumulates the dealer outcomes, weighted by prb
+void dealer_draw(Solver* solver, real prb, Hand dealer, Shoe shoe, Rules rules, real* outcomes) {
+
+	int c, d;
+	real prc, sub[NUM_OUTCOMES];
 	Hand dtmp;
 	Shoe stmp;
 
-	// stop if bet << 1
-	*exp = 0.0;
-	if(bet < rules.errtol) 
+	if(solver->stats)
+		solver->stats->dealer_nodes++;
+
+	// the dealer must stand. 
+	if(blackjack(dealer)) {
+		outcomes[OUTCOME_BLACKJACK] += prb;
+		return;
+	}
+	if(dealer.points > 21) {
+		outcomes[OUTCOME_BUST] += prb;	
 		return;
+	}
+	if(!dealer_hits(dealer, rules)) {
+		outcomes[dealer.points-17] += prb;
+		return;
+	}
 
-	// dealer hits
-	if(dealer.points < 17
-			|| (rules.dealer_hits_soft_17 && dealer.points == 17 && dealer.softness)) {
+	// dealer hits, stop if prb << 1
+	if(prb < rules.errtol) {
+		if(solver->stats)
+			solver->stats->dealer_pruned++;
+		return;
+	}
+	for(c = 2; c <= 11; ++c) {
+		dtmp = dealer;
+		stmp = shoe;
+		if(stmp.num[c] <= 0) continue;
+		prc = choose_card_from_shoe(&stmp, c); 
+		add_card_to_dealer(&dtmp, c);
+
+		// with no errtol pruning, memoize every hand the dealer must hit
+		if(rules.errtol <= 0.0 && solver->dealer_cache && dealer_hits(dtmp, rules)) {
+			dealer_outcomes(solver, dtmp, stmp, rules, sub);
+			for(d = 0; d < NUM_OUTCOMES; ++d)
+				outcomes[d] += prb*prc*sub[d];
+		}
+		else {
+			dealer_draw(solver, prb*prc, dtmp, stmp, rules, outcomes);
+		}
+	}
+}
 
-		// simulate the dealers hit/stand/bust, recursing as needed
-		for(c = 2; c <= 11; ++c) {
-			dtmp = dealer;
-			stmp = shoe;
-			if(stmp.num[c] <= 0) continue;
+// whether the dealer must draw to this (non-blackjack, non-bust) hand
+int dealer_hits(Hand dealer, Rules rules) {
+	return dealer.points < 17
+			|| (rules.dealer_hits_soft_17 && dealer.points == 17 && dealer.softness);
+}
+
+// Python-facing dealer outcomes for a single dealer hand. A hand built with
+// add_card_to_hand() may be a pair, e.g. A,A at 22 points, so it is made
+// into the hand add_card_to_dealer() would have built.
+void get_dealer_outcomes(Hand dealer, Shoe shoe, Rules rules, real* outcomes) {
+	Solver solver;
+	dealer.ispair = 0;
+	while(dealer.softness > 0 && dealer.points > 21) {
+		dealer.points -= 10;
+		dealer.softness -= 1;
+	}
+	init_solver(&solver, NULL);
+	solver.dealer_cache = get_dealer_cache();
+	dealer_outcomes(&solver, dealer, shoe, rules, outcomes);
+}
+
+
+
+// Monte Carlo play of whole rounds
+
+// plays numrounds rounds at the table, each seat s following the strategy
+// chart strategies[s]. Writes each seat's net result per round to
+// net[numrounds][numseats] and a RoundRecord per seat per round to
+// records[numrounds][numseats]. Either may be NULL, and with both NULL
+// only the game's running statistics are kept.
+void simulate_rounds(Game* game, Strategy* strategies, long numrounds, real* net, RoundRecord* records) {
+
+	long r;
+	int s;
+	real delta, seatnet[MAX_SEATS];
+
+	if(game->numseats < 1) game->numseats = 1;
+	if(game->numseats > MAX_SEATS) game->numseats = MAX_SEATS;
+	for(r = 0; r < numrounds; ++r) {
+		play_round(game, strategies, seatnet, records? &records[r*game->numseats] : NULL);
+		if(net)
+			memcpy(&net[r*game->numseats], seatnet, game->numseats*sizeof(real));
+
+		// update the running mean and variance
+		game->rounds++;
+		for(s = 0; s < game->numseats; ++s) {
+			delta = seatnet[s] - game->mean[s];
+			game->mean[s] += delta/game->rounds;
+			game->m2[s] += delta*(seatnet[s] - game->mean[s]);
+		}
+	}
+}
+
+void play_round(Game* game, Strategy* strategies, real* net, RoundRecord* records) {
+
+	int s, h, hole, anylive, my_ind, dealer_ind;
+	int numhands[MAX_SEATS], status[MAX_SEATS][MAX_HANDS], first_action[MAX_SEATS];
+	real bets[MAX_SEATS][MAX_HANDS];
+	Hand dealer, dfinal;
+	Hand hands[MAX_SEATS][MAX_HANDS];
+
+	// reshuffle once the cut card comes out
+	if(game->shoe.numdecks > 0 
+			&& game->shoe.total <= (1.0-game->penetration)*52*game->shoe.numdecks) {
+		init_shoe(&game->shoe, game->shoe.numdecks);
+		game->shuffles++;
+	}
+	if(records) {
+		records[0].true_count = true_count(game);
+		for(s = 0; s < game->numseats; ++s) {
+			records[s].round = game->rounds;
+			records[s].true_count = records[0].true_count;
+			records[s].seat = s;
+		}
+	}
+
+	// deal one card each round the table, dealer last, 
+	// and the dealer's hole card face down
+	init_hand(&dealer);
+	for(s = 0; s < game->numseats; ++s) {
+		init_hand(&hands[s][0]);
+		add_card_to_hand(&hands[s][0], draw_card(game));
+	}
+	add_card_to_dealer(&dealer, draw_card(game));
+	for(s = 0; s < game->numseats; ++s) 
+		add_card_to_hand(&hands[s][0], draw_card(game));
+	hole = draw_card(game);
+	dfinal = dealer;
+	add_card_to_dealer(&dfinal, hole);
+
+	if(records) {
+		for(s = 0; s < game->numseats; ++s) {
+			chart_ind_from_hands(hands[s][0], dealer, &my_ind, &dealer_ind);
+			records[s].dealer_card = dealer.points;
+			records[s].chart_ind = my_ind;
+			records[s].action = -1;
+			records[s].numhands = 1;
+		}
+	}
+
+	// the dealer peeks under a ten or ace, 
+	// and a blackjack ends the round before anyone acts
+	if(game->peek && blackjack(dfinal)) {
+		for(s = 0; s < game->numseats; ++s) {
+			net[s] = blackjack(hands[s][0])? 0.0 : -1.0;
+			if(records)
+				records[s].net = net[s];
+		}
+		return;
+	}
+
+	// each seat plays out its hands in turn
+	anylive = 0;
+	for(s = 0; s < game->numseats; ++s) {
+		bets[s][0] = 1.0;
+		numhands[s] = play_hands(game, &strategies[s], dealer, hands[s], bets[s], status[s], 
+				&first_action[s]);
+		for(h = 0; h < numhands[s]; ++h)
+			anylive |= (status[s][h] == HAND_LIVE && !blackjack(hands[s][h]));
+	}
+
+	// the dealer only draws if there is someone left to beat
+	while(anylive && (dfinal.points < 17
+			|| (game->rules.dealer_hits_soft_17 && dfinal.points == 17 && dfinal.softness)))
+		add_card_to_dealer(&dfinal, draw_card(game));
+
+	// settle up
+	for(s = 0; s < game->numseats; ++s) {
+		net[s] = 0.0;
+		for(h = 0; h < numhands[s]; ++h)
+			net[s] += settle_hand(hands[s][h], dfinal, bets[s][h], status[s][h]);
+		if(records) {
+			records[s].net = net[s];
+			records[s].action = first_action[s];
+			records[s].numhands = numhands[s];
+		}
+	}
+}
 
-			prb = deal_card_to_hand_choose(&stmp, &dtmp, c); 
+// the true count of the shoe: the running count of the cards 
+// dealt since the shuffle, per deck remaining
+real true_count(Game* game) {
+	int c, full, running;
+	if(game->shoe.numdecks <= 0 || game->shoe.total <= 0)
+		return 0.0;
+	running = 0;
+	for(c = 2; c <= 11; ++c) {
+		full = (c == 10)? 16*game->shoe.numdecks : 4*game->shoe.numdecks;
+		running += game->tags[c]*(full - game->shoe.num[c]);
+	}
+	return 52.0*running/game->shoe.total;
+}
 
-			// got through special win/loss scenarios 
-			// barring all else, try hitting again
-			// split to 21 beats a non-blackjack dealer 21
-			// in all cases, push against dealer 21
-			if(blackjack(dtmp)) {
-				if(!blackjack(hand) && !split_to_21(hand))
-					*exp -= 1.0*prb*bet;
+// plays out one seat's hand and any hands split from it.
+// Returns the number of hands, and the first action taken in first_action.
+int play_hands(Game* game, Strategy* strategy, Hand dealer, Hand* hands, real* bets, int* status, int* first_action) {
+
+	int h, numhands, action, allowed[6], splitaces[MAX_HANDS];
+	Hand* hand;
+	Rules* rules;
+
+	rules = &game->rules;
+	numhands = 1;
+	splitaces[0] = 0;
+	*first_action = -1;
+	for(h = 0; h < numhands; ++h) {
+		hand = &hands[h];
+		status[h] = HAND_LIVE;
+		while(1) {
+
+			// split hands get their second card when they are played
+			if(hand->numcards == 1)
+				add_card_to_hand(hand, draw_card(game));
+			if(hand->points > 21 && !hand->ispair) {
+				status[h] = HAND_BUST;
+				break;
 			}
-			else if(blackjack(hand)) {
-				*exp += 1.5*prb*bet;
+			if(blackjack(*hand))
+				break;
+
+			// the same options as in expected_value()
+			memcpy(allowed, rules->allowed, 6*sizeof(int));
+			allowed[INSURANCE] = 0;
+			allowed[SURRENDER] *= (hand->depth == 2 && hand->numcards == 2);
+			allowed[DOUBLE] *= (hand->numcards == 2 && (hand->depth == 2 || rules->double_after_split));
+			allowed[SPLIT] *= (hand->ispair && hand->depth < (2+rules->max_split_depth) 
+					&& numhands < MAX_HANDS);
+			if(splitaces[h] && !rules->can_hit_split_aces) {
+				allowed[HIT] = 0;
+				allowed[DOUBLE] = 0;
 			}
-			else if(split_to_21(hand)) {
-				*exp += 1.0*prb*bet;
+			action = table_action(strategy, *hand, dealer, allowed);
+			if(*first_action < 0)
+				*first_action = action;
+
+			if(action == STAND)
+				break;
+			else if(action == HIT)
+				add_card_to_hand(hand, draw_card(game));
+			else if(action == DOUBLE) {
+				bets[h] *= 2.0;
+				add_card_to_hand(hand, draw_card(game));
+				if(hand->points > 21)
+					status[h] = HAND_BUST;
+				break;
 			}
-			else if(dtmp.points > 21) {
-				*exp += 1.0*prb*bet;	
-			} 
-			else {
-				exp_stand(prb*bet, hand, dtmp, stmp, rules, &exptmp); 
-				*exp += exptmp;
+			else if(action == SPLIT) {
+
+				// Make the split hands
+				// Do not decrement the hand depth though!
+				hand->points /= 2; 
+				hand->softness /= 2; 
+				hand->numcards /= 2;
+				hand->ispair = 0; 
+				splitaces[h] = (hand->points == 11);
+				hands[numhands] = *hand;
+				bets[numhands] = bets[h];
+				splitaces[numhands] = splitaces[h];
+				numhands++;
+			}
+			else if(action == SURRENDER) {
+				status[h] = HAND_SURRENDERED;
+				break;
 			}
 		}
 	}
+	return numhands;
+}
+
+// the net result of a finished hand against the dealer's final hand,
+// using the same conventions as exp_stand()
+real settle_hand(Hand hand, Hand dealer, real bet, int status) {
+
+	// guard against soft pairs exceeding 21
+	while(hand.softness > 0 && hand.points > 21) {
+		hand.points -= 10;
+		hand.softness -= 1;
+	}
 
-	// the dealer must stand. See who won.
-	else {
-		if(dealer.points < hand.points) 
-			*exp = +1.0*bet;
-		if(dealer.points > hand.points)
-			*exp = -1.0*bet;
+	if(status == HAND_SURRENDERED)
+		return -0.5*bet;
+	if(status == HAND_BUST || hand.points > 21)
+		return -1.0*bet;
+	if(blackjack(dealer))
+		return (blackjack(hand) || split_to_21(hand))? 0.0 : -1.0*bet;
+	if(blackjack(hand))
+		return 1.5*bet;
+	if(split_to_21(hand) || dealer.points > 21 || dealer.points < hand.points)
+		return 1.0*bet;
+	if(dealer.points > hand.points)
+		return -1.0*bet;
+	return 0.0;
+}
+
+// draws a random card, reshuffling an exhausted shoe 
+int draw_card(Game* game) {
+	if(game->shoe.total <= 0) {
+		init_shoe(&game->shoe, game->shoe.numdecks);
+		game->shuffles++;
 	}
+	return random_card_from_shoe(&game->shoe, &game->rng);
 }
 
 
@@ -362,21 +1314,25 @@ real choose_card_from_shoe(Shoe* shoe, int card) {
 	return prb;
 }
 
-int random_card_from_shoe(Shoe* shoe) {
+// draws one card from the shoe in constant time: a single bounded integer 
+// from rng, then a walk over at most the 10 ranks. This walk is the sampler 
+// of choice, rather than an alias table, since every draw changes the shoe 
+// and a table would have to be rebuilt, at the same 10 steps, for each card.
+// Returns 0 if the shoe is empty.
+int random_card_from_shoe(Shoe* shoe, Rng* rng) {
 
 	int card;	
-	real cdf, x;
-	if(!shoe->total) 
+	uint64_t x;
+	if(shoe->total <= 0) 
 		return 0;
 
-	// multinomial distribution
-	// TODO: untested!
-	x = (1.0*rand())/RAND_MAX; 
+	// multinomial distribution, in integers:
+	// pick one of the remaining cards uniformly and find its rank
+	x = rng_below(rng, shoe->total);
 	card = 2;
-	cdf = ((real)shoe->num[card])/shoe->total;
-	while(x > cdf) {
+	while(x >= (uint64_t)shoe->num[card] && card < 11) {
+		x -= shoe->num[card];
 		card += 1;
-		cdf += ((real)shoe->num[card])/shoe->total;
 	}
 	
 	// decrements the deck state, 
@@ -411,9 +1367,29 @@ void add_card_to_hand(Hand* hand, int card) {
 	}
 }
 
-int deal_card_to_hand_random(Shoe* shoe, Hand* hand) {
+// the dealer never has a pair, so a soft total over 21 always
+// drops by ten (i.e. A,A is a soft 12, not a bust)
+void add_card_to_dealer(Hand* dealer, int card) {
+	add_card_to_hand(dealer, card);
+	dealer->ispair = 0;
+	while(dealer->softness > 0 && dealer->points > 21) {
+		dealer->points -= 10;
+		dealer->softness -= 1;
+	}
+}
+
+// draws numcards random cards into cards[]
+void random_cards_from_shoe(Shoe* shoe, Rng* rng, long numcards, int* cards) {
+	long i;
+	if(!rng) rng = &global_rng;
+	for(i = 0; i < numcards; ++i)
+		cards[i] = random_card_from_shoe(shoe, rng);
+}
+
+int deal_card_to_hand_random(Shoe* shoe, Hand* hand, Rng* rng) {
 	int card;
-	card = random_card_from_shoe(shoe);
+	if(!rng) rng = &global_rng;
+	card = random_card_from_shoe(shoe, rng);
 	add_card_to_hand(hand, card);
 	return card;
 }
@@ -437,10 +1413,133 @@ void chart_ind_from_hands(Hand hand, Hand dealer, int* my_ind, int* dealer_ind)
 	*dealer_ind = (dealer.points-2);
 }
 
+// looks up the action for this hand in a strategy chart,
+// falling back to secondary options if it is not allowed
+int table_action(Strategy* strategy, Hand hand, Hand dealer, int* allowed) {
+
+	int action, my_ind, dealer_ind;
+
+	if(hand.points > 19 && !hand.softness) 
+		return STAND;
+	chart_ind_from_hands(hand, dealer, &my_ind, &dealer_ind);
+	action = strategy->actions[dealer_ind][my_ind];
+	while(!allowed[action]) {
+
+		// seconday options from the strategy chart
+		if(action == SURRENDER) {
+			if(hand.points >= 17)
+				action = STAND;
+			else
+				action = HIT;
+		}
+		else if(action == DOUBLE)
+			action = HIT;
+		else if(action == SPLIT)
+			action = HIT;
+		else if(action == HIT)
+			action = STAND;
+		else 
+			action = STAND;
+	}
+	return action;
+}
+
+// builds the representative hands for a chart cell:
+// hard totals are two generic cards, soft totals are A,x 
+void hands_from_chart_ind(int my_ind, int dealer_ind, Hand* hand, Hand* dealer) {
+
+	init_hand(dealer);
+	add_card_to_hand(dealer, dealer_ind+2);
+	init_hand(hand);
+	if(my_ind >= 24) {
+		add_card_to_hand(hand, 35-my_ind);
+		add_card_to_hand(hand, 35-my_ind);
+	}
+	else if(my_ind >= 15) {
+		add_card_to_hand(hand, 11);
+		add_card_to_hand(hand, 25-my_ind);
+	}
+	else {
+		hand->points = 19-my_ind;
+		hand->numcards = 2;
+		hand->depth = 2;
+	}
+}
+
+
+// seeeds the default random stream
+void seed_rand(uint64_t seed) {
+	rng_seed(&global_rng, seed, 0);
+}
+
+// seeds a random stream, filling the state from splitmix64
+// and jumping ahead 2^128 draws for each stream number
+void rng_seed(Rng* rng, uint64_t seed, int stream) {
+	int i;
+	uint64_t z;
+	for(i = 0; i < 4; ++i) {
+		seed += 0x9e3779b97f4a7c15UL;
+		z = seed;
+		z = (z ^ (z >> 30))*0xbf58476d1ce4e5b9UL;
+		z = (z ^ (z >> 27))*0x94d049bb133111ebUL;
+		rng->s[i] = z ^ (z >> 31);
+	}
+	for(i = 0; i < stream; ++i)
+		rng_jump(rng);
+}
+
+static inline uint64_t rotl(uint64_t x, int k) {
+	return (x << k) | (x >> (64 - k));
+}
+
+uint64_t rng_next(Rng* rng) {
+	uint64_t result, t;
+	result = rotl(rng->s[1]*5, 7)*9;
+	t = rng->s[1] << 17;
+	rng->s[2] ^= rng->s[0];
+	rng->s[3] ^= rng->s[1];
+	rng->s[1] ^= rng->s[2];
+	rng->s[0] ^= rng->s[3];
+	rng->s[2] ^= t;
+	rng->s[3] = rotl(rng->s[3], 45);
+	return result;
+}
+
+// equivalent to 2^128 calls to rng_next()
+void rng_jump(Rng* rng) {
+	int i, b;
+	uint64_t s[4];
+	static const uint64_t jump[4] = {0x180ec6d33cfd0abaUL, 0xd5a61266f0c9392cUL, 
+		0xa9582618e03fc9aaUL, 0x39abdc4529b1661cUL};
+	memset(s, 0, sizeof(s));
+	for(i = 0; i < 4; ++i)
+		for(b = 0; b < 64; ++b) {
+			if(jump[i] & ((uint64_t)1 << b)) {
+				s[0] ^= rng->s[0];
+				s[1] ^= rng->s[1];
+				s[2] ^= rng->s[2];
+				s[3] ^= rng->s[3];
+			}
+			rng_next(rng);	
+		}
+	memcpy(rng->s, s, sizeof(s));
+}
 
-// seeeds the random number generator
-void seed_rand(int seed) {
-	srand(seed);
+// an unbiased integer in [0, n) by Lemire's multiply-shift method. 
+// The modulo only runs in the rare case that a rejection is possible.
+uint64_t rng_below(Rng* rng, uint64_t n) {
+	uint64_t low, threshold;
+	__uint128_t m;
+	m = (__uint128_t)rng_next(rng)*n;
+	low = (uint64_t)m;
+	if(low < n) {
+		threshold = -n % n;
+		while(low < threshold) {
+			m = (__uint128_t)rng_next(rng)*n;
+			low = (uint64_t)m;
+		}
+	}
+	return (uint64_t)(m >> 64);
 }
 
 // checks for player blackjack
@@ -452,3 +1551,226 @@ int blackjack(Hand hand) {
 int split_to_21(Hand hand) {
 	return (hand.depth > 2 && hand.numcards == 2 && hand.points == 21);
 }
+
+
+
+// transposition cache helpers
+
+// builds a canonical key for the subproblem.
+// Non-pair hands with three or more cards can no longer
+// split, surrender or make blackjack, so their card counts are merged.
+void cache_make_key(CacheKey* key, Hand hand, Hand dealer, Shoe shoe, Rules rules) {
+	memset(key, 0, sizeof(CacheKey));
+	if(!hand.ispair && hand.numcards > 2) {
+		hand.numcards = 3;
+		hand.depth = 3;
+	}
+	key->hand = hand;
+	key->dealer = dealer;
+	key->shoe = shoe;
+	key->rules = rules;
+}
+
+// FNV-1a over the key bytes
+unsigned long cache_hash(CacheKey* key) {
+	size_t i;
+	unsigned long h;
+	unsigned char* bytes;
+	bytes = (unsigned char*) key;
+	h = 14695981039346656037UL;
+	for(i = 0; i < sizeof(CacheKey); ++i) {
+		h ^= bytes[i];
+		h *= 1099511628211UL;
+	}
+	return h;
+}
+
+Cache* cache_new(long capacity) {
+	Cache* cache;
+	cache = (Cache*) malloc(sizeof(Cache));
+	if(!cache) 
+		return NULL;
+	memset(cache, 0, sizeof(Cache));
+
+	// round the number of sets up to a power of two
+	cache->numsets = 1;
+	while(cache->numsets*CACHE_WAYS < capacity)
+		cache->numsets *= 2;
+	cache->entries = (CacheEntry*) calloc(cache->numsets*CACHE_WAYS, sizeof(CacheEntry));
+	if(!cache->entries) {
+		free(cache);
+		return NULL;
+	}
+	return cache;
+}
+
+// the largest capacity cache_new() allocates in at most bytes
+long cache_capacity_for_bytes(long bytes) {
+	long numsets;
+	numsets = 1;
+	while(2*numsets*CACHE_WAYS*(long)sizeof(CacheEntry) <= bytes)
+		numsets *= 2;
+	return numsets*CACHE_WAYS;
+}
+
+void cache_free(Cache* cache) {
+	if(!cache) 
+		return;
+	free(cache->entries);
+	free(cache);
+}
+
+CacheEntry* cache_find(Cache* cache, CacheKey* key) {
+	int w;
+	CacheEntry* set;
+	set = &cache->entries[(cache_hash(key) & (cache->numsets-1))*CACHE_WAYS];
+	for(w = 0; w < CACHE_WAYS; ++w)
+		if((set[w].flags & CACHE_VALID) && !memcmp(&set[w].key, key, sizeof(CacheKey)))
+			return &set[w];
+	return NULL;
+}
+
+void cache_store(Cache* cache, CacheKey* key, real bet, int action, real* vals, int numvals) {
+
+	int a, w;
+	CacheEntry *set, *entry;
+
+	// overwrite a matching key, else take an empty way
+	set = &cache->entries[(cache_hash(key) & (cache->numsets-1))*CACHE_WAYS];
+	entry = NULL;
+	for(w = 0; w < CACHE_WAYS; ++w)
+		if((set[w].flags & CACHE_VALID) && !memcmp(&set[w].key, key, sizeof(CacheKey)))
+			entry = &set[w];
+	for(w = 0; w < CACHE_WAYS && !entry; ++w)
+		if(!(set[w].flags & CACHE_VALID)) {
+			entry = &set[w];
+			cache->numentries++;
+		}
+
+	// otherwise, clock eviction within the set: 
+	// recently used entries get a second chance
+	if(!entry) {
+		for(w = 0; w < CACHE_WAYS && !entry; ++w) {
+			if(set[w].flags & CACHE_USED)
+				set[w].flags &= ~CACHE_USED;
+			else
+				entry = &set[w];
+		}
+		if(!entry)
+			entry = &set[0];
+		cache->evictions++;
+	}
+
+	// store the solution along with its bet
+	entry->key = *key;
+	entry->bet = bet;
+	entry->action = action;
+	for(a = 0; a < numvals; ++a)
+		entry->exp[a] = vals[a];
+	entry->flags = CACHE_VALID;
+	cache->inserts++;
+}
+
+// Python-facing controls for the process-wide cache
+
+int cache_enable(long capacity, int exact) {
+	cache_free(global_cache);
+	global_cache = cache_new(capacity);
+	if(!global_cache)
+		return 0;
+	global_cache->exact = exact;
+	return 1;
+}
+
+void cache_disable(void) {
+	cache_free(global_cache);
+	global_cache = NULL;
+}
+
+// clears the transposition cache and the calling thread's dealer cache
+void cache_clear(void) {
+	cache_reset(global_cache);
+	cache_reset(get_dealer_cache());
+}
+
+void cache_reset(Cache* cache) {
+	if(!cache) 
+		return;
+	memset(cache->entries, 0, cache->numsets*CACHE_WAYS*sizeof(CacheEntry));
+	cache->numentries = 0;
+	cache->hits = 0;
+	cache->misses = 0;
+	cache->inserts = 0;
+	cache->evictions = 0;
+}
+
+// the calling thread's dealer outcome cache
+Cache* get_dealer_cache(void) {
+	Cache* cache;
+	pthread_once(&dealer_cache_once, make_dealer_cache_key);
+	cache = pthread_getspecific(dealer_cache_key);
+	if(!cache) {
+		cache = cache_new(DEALER_CACHE_SIZE);
+		pthread_setspecific(dealer_cache_key, cache);
+	}
+	return cache;
+}
+
+void make_dealer_cache_key(void) {
+	pthread_key_create(&dealer_cache_key, free_dealer_cache);
+}
+
+void free_dealer_cache(void* cache) {
+	cache_free((Cache*)cache);
+}
+
+void cache_get_stats(CacheStats* stats) {
+	memset(stats, 0, sizeof(CacheStats));
+	if(!global_cache) 
+		return;
+	stats->capacity = global_cache->numsets*CACHE_WAYS;
+	stats->numentries = global_cache->numentries;
+	stats->hits = global_cache->hits;
+	stats->misses = global_cache->misses;
+	stats->inserts = global_cache->inserts;
+	stats->evictions = global_cache->evictions;
+}
+
+// Python-facing controls for the process-wide solver stats
+
+void stats_enable(int enable) {
+	stats_enabled = enable;
+}
+
+void stats_reset(void) {
+	memset(&global_stats, 0, sizeof(SolverStats));
+}
+
+void stats_get(SolverStats* stats) {
+	*stats = global_stats;
+}
+
+// sums stats into total, keeping the larger max_depth
+void stats_add(SolverStats* total, SolverStats* stats) {
+	int a;
+	total->nodes += stats->nodes;
+	for(a = 0; a < 6; ++a)
+		total->expanded[a] += stats->expanded[a];
+	total->pruned += stats->pruned;
+	total->dealer_solves += stats->dealer_solves;
+	total->dealer_nodes += stats->dealer_nodes;
+	total->dealer_pruned += stats->dealer_pruned;
+	total->cache_hits += stats->cache_hits;
+	total->cache_misses += stats->cache_misses;
+	total->dealer_cache_hits += stats->dealer_cache_hits;
+	total->dealer_cache_misses += stats->dealer_cache_misses;
+	if(stats->max_depth > total->max_depth)
+		total->max_depth = stats->max_depth;
+}
+
+// monotonic wall clock time in seconds
+real wall_time(void) {
+	struct timespec ts;
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return ts.tv_sec + 1.0e-9*ts.tv_nsec;
+}
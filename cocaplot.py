@@ -0,0 +1,257 @@
+# cocaplot.py
+# plotting for strategy charts, kept out of coca so that 
+# importing the solver does not pull in matplotlib
+
+import numpy as np
+import matplotlib
+from matplotlib import colors
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PathCollection
+from matplotlib.font_manager import FontProperties
+from matplotlib.textpath import TextPath
+from matplotlib.path import Path
+from matplotlib.transforms import Affine2D
+import multiprocessing
+import cgi
+import os
+from coca import cardLabels
+
+# one letter for each action, for chart labels
+actionLetters = ['S', 'H', 'D', 'P', 'R', 'I']
+
+# the colors of the actions, in order
+actionColors = ['green', 'yellow', 'red', 'cyan', 'white']
+
+# the chart's three panels, as (first column, number of rows, y extent)
+chartPanels = [(0, 15, (5, 20)), (15, 9, (13, 21)), (24, 10, (2, 11))]
+
+# the labels of the chart rows, indexed like the chart
+chartRowLabels = ['%d' % (19-m) for m in xrange(15)] \
+        + ['A,%d' % (25-m) for m in xrange(15, 24)] \
+        + ['%s,%s' % (cardLabels[35-m], cardLabels[35-m]) for m in xrange(24, 34)]
+
+# the center of every cell of the chart, in each panel's data coordinates
+def _cellCenters():
+    x = np.empty((10, 34))
+    y = np.empty((10, 34))
+    for start, rows, (y0, y1) in chartPanels:
+        for m in xrange(rows):
+            x[:,start+m] = 2.0 + 0.8*(np.arange(10)+0.5)
+            y[:,start+m] = y1 - (y1-y0)*(m+0.5)/rows
+    return x, y
+
+# the outline of a label, centered on the origin, in points, 
+# with its lines stacked and each centered horizontally.
+# Cached, since charts repeat the same few labels many times.
+_textPaths = {}
+def _textPath(label, size):
+    if (label, size) not in _textPaths:
+        lines = label.split('\n')
+        paths = []
+        for i, line in enumerate(lines):
+            path = TextPath((0, 0), line, size=size, prop=FontProperties(family='serif'))
+            ext = path.get_extents()
+            paths.append(path.transformed(Affine2D().translate(-0.5*(ext.x0+ext.x1),
+                    1.2*size*(0.5*(len(lines)-1)-i) - 0.35*size)))
+        _textPaths[label, size] = Path.make_compound_path(*paths)
+    return _textPaths[label, size]
+
+# draws all the labels of one panel as a single collection of 
+# glyph outlines, rather than one text artist per cell
+def _drawLabels(ax, x, y, labels, size=10):
+    keep = [i for i, label in enumerate(labels) if label]
+    if not keep:
+        return
+    paths = [_textPath(labels[i], size) for i in keep]
+    labels = PathCollection(paths, offsets=np.column_stack([x[keep], y[keep]]),
+            transOffset=ax.transData, facecolors='black', edgecolors='none')
+    labels.set_transform(Affine2D().scale(ax.figure.dpi/72.0))
+    ax.add_collection(labels, autolim=False)
+
+
+# draws the chart onto fig, returning the three axes
+def drawChart(fig, ar, title=None, cmap=None, vrange=None, grid=True, textarr=None, textfmt=None,
+        contours=None, fontsize=10):
+
+    # set up the axes 
+    ax = fig.subplots(3, 1, gridspec_kw={'height_ratios': [16./35.,9./35.,10./35.]}, sharex=True)
+    fig.subplots_adjust(hspace=0.02)
+    if title is not None:
+        ax[0].set_title(title, fontsize=18) 
+    dticks = np.linspace(2, 10, 11)
+    for axx in ax:
+        if grid:
+            axx.grid(ls='-', lw=0.3)
+        axx.set_xticks(dticks)
+        axx.set_xticks(dticks+0.4, minor=True)
+        axx.set_xticklabels('')
+        axx.set_yticklabels('')
+    hardticks = np.linspace(5, 20, 16)
+    ax[0].set_yticks(hardticks)
+    ax[0].set_yticks(hardticks+0.4, minor=True)
+    ax[0].set_yticklabels(["%d"%i for i in range(5,20)], minor=True)
+    ax[0].set_ylabel("Hard hands")
+    softticks = np.linspace(13, 21, 10)
+    ax[1].set_yticks(softticks)
+    ax[1].set_yticks(softticks+0.4, minor=True)
+    ax[1].set_yticklabels(["A,%d"%(i-11) for i in range(13,22)], minor=True)
+    ax[1].set_ylabel("Soft hands")
+    pairticks = np.linspace(2, 11, 11)
+    ax[2].set_yticks(pairticks)
+    ax[2].set_yticks(pairticks+0.4, minor=True)
+    ax[2].set_yticklabels(["%s,%s"%(cardLabels[i], cardLabels[i]) for i in xrange(2,12)], minor=True)
+    ax[2].set_ylabel("Pairs")
+    ax[2].set_xticklabels(["%s"%(cardLabels[i]) for i in xrange(2,12)], minor=True)
+    ax[2].set_xlabel("Dealer up")
+
+    # plot it
+    if vrange is None:
+        vrange = (np.min(ar), np.max(ar))
+    if cmap is None:
+        cmap = colors.ListedColormap(actionColors)
+        bounds = [0,1,2,3,4,5] 
+        norm = colors.BoundaryNorm(bounds, cmap.N)
+    else:
+        norm = None
+
+    imargs = {'interpolation': 'nearest', 'aspect': 'auto', 'cmap': cmap, 'vmin': vrange[0],
+            'vmax': vrange[1], 'norm': norm}
+    for axx, (start, rows, (y0, y1)) in zip(ax, chartPanels):
+        imargs['extent'] = [2, 10, y0, y1]
+        axx.imshow(ar[:,start:start+rows].T, **imargs)
+
+    # label the cells if asked for
+    labels = np.zeros((10, 34), dtype=object)
+    labels[:] = ''
+    if textarr is not None and textfmt is not None:
+        for d in xrange(10):
+            for m in xrange(34):
+                labels[d,m] = textfmt(textarr[d,m], ar[d,m])
+
+    # mark the contours, X inside one sigma and O inside two, 
+    # in place of the labels of the cells they mark
+    if contours is not None:
+        for area, char in zip(contours, ['X','O']):
+            for ind in area:
+                labels[ind] = char
+    x, y = _cellCenters()
+    for axx, (start, rows, _) in zip(ax, chartPanels):
+        _drawLabels(axx, x[:,start:start+rows].ravel(), y[:,start:start+rows].ravel(),
+                list(labels[:,start:start+rows].ravel()), size=fontsize)
+    return ax
+
+# plots the chart with pyplot, and shows it unless show is False.
+# usetex renders all the text with LaTeX, which is much slower.
+def plotChart(ar, title=None, cmap=None, vrange=None, grid=True, textarr=None, textfmt=None,
+        contours=None, usetex=False, show=True):
+    import matplotlib.pyplot as plt
+    with matplotlib.rc_context(_texParams if usetex else {}):
+        fig = plt.figure(figsize=(10, 20))
+        ax = drawChart(fig, ar, title=title, cmap=cmap, vrange=vrange, grid=grid, textarr=textarr,
+                textfmt=textfmt, contours=contours)
+        if show:
+            plt.show()
+    return fig, ax
+
+_texParams = {'text.usetex': True, 'font.family': 'serif', 'font.serif': 'computer modern roman'}
+
+
+# writes the chart for an action table, labeled with each action and its 
+# expected value if all_exp is given, without pyplot or a display. 
+# The format comes from the extension of path: .png, .svg, .pdf or .html.
+def renderChart(path, best_action, all_exp=None, title=None, usetex=False, dpi=72, fontsize=9):
+    best_action = np.asarray(best_action)
+    best_exp = None
+    if all_exp is not None:
+        best_exp = np.choose(best_action, np.rollaxis(np.asarray(all_exp), -1))
+    if path.endswith('.html'):
+        with open(path, 'w') as f:
+            f.write(chartHTML(best_action, best_exp, title=title))
+        return
+    with matplotlib.rc_context(_texParams if usetex else {}):
+        # fixed margins rather than bbox_inches='tight', which draws everything twice
+        fig = Figure(figsize=(10, 17))
+        FigureCanvasAgg(fig)
+        fig.subplots_adjust(left=0.08, right=0.98, bottom=0.04, top=0.96)
+        if best_exp is None:
+            drawChart(fig, best_action, title=title, textarr=best_action,
+                    textfmt=(lambda x, a: actionLetters[a]), fontsize=fontsize)
+        else:
+            drawChart(fig, best_action, title=title, textarr=best_exp,
+                    textfmt=(lambda x, a: '%s\n%+.3f' % (actionLetters[a], x)), fontsize=fontsize)
+        fig.savefig(path, dpi=dpi)
+
+# the chart as a standalone HTML table, colored by action
+def chartHTML(best_action, best_exp=None, title=None):
+    html = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8">']
+    if title is not None:
+        html.append('<title>%s</title>' % cgi.escape(title))
+    html.append('<style>table{border-collapse:collapse;font-family:serif}'
+            'td,th{border:1px solid #888;padding:2px 6px;text-align:center}'
+            'th.section{text-align:left;background:#eee}</style></head><body>')
+    if title is not None:
+        html.append('<h2>%s</h2>' % cgi.escape(title))
+    html.append('<table><tr><th>Dealer up</th>%s</tr>' % ''.join('<th>%s</th>' % cardLabels[c]
+            for c in xrange(2, 12)))
+    for name, (start, rows, _) in zip(['Hard hands', 'Soft hands', 'Pairs'], chartPanels):
+        html.append('<tr><th class="section" colspan="11">%s</th></tr>' % name)
+        for m in xrange(start, start+rows):
+            cells = []
+            for d in xrange(10):
+                a = best_action[d,m]
+                label = actionLetters[a]
+                if best_exp is not None:
+                    label += '<br><small>%+.3f</small>' % best_exp[d,m]
+                cells.append('<td style="background:%s">%s</td>' % (actionColors[a], label))
+            html.append('<tr><th>%s</th>%s</tr>' % (chartRowLabels[m], ''.join(cells)))
+    html.append('</table></body></html>')
+    return '\n'.join(html) + '\n'
+
+def _renderJob(args):
+    path, best_action, all_exp, kwargs = args
+    renderChart(path, best_action, all_exp, **kwargs)
+    return path
+
+# renders many charts at once over a pool of worker processes.
+# charts is a list of (path, best_action, all_exp) with all_exp possibly None,
+# and kwargs are passed on to renderChart(). Returns the paths written.
+def renderCharts(charts, processes=None, **kwargs):
+    jobs = [(path, best_action, all_exp, kwargs) for path, best_action, all_exp in charts]
+    for path, _, _, _ in jobs:
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+    if processes == 1:
+        return map(_renderJob, jobs)
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        return pool.map(_renderJob, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+
+def getChartContours(ar):
+
+
+    sorted_inds = np.dstack(np.unravel_index(np.argsort(ar.ravel()), ar.shape))[0]
+
+    # tally a cumulative probabilty through the sorted cells, breaking at 
+    # standard deviations from the unit bet
+    one_sigma = []
+    two_sigma = []
+    cumprb = 0.0
+    invartot = 1.0/np.sum(ar)
+    for ind in sorted_inds: 
+        ind = tuple(ind)
+        prb = np.abs(ar[ind]*invartot)
+        if cumprb < 0.6827:
+            one_sigma.append(ind)
+        elif cumprb < 0.9545:
+            two_sigma.append(ind)
+        cumprb += prb
+
+    return one_sigma, two_sigma
+
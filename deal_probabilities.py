@@ -11,8 +11,6 @@ import sys
 
 # a new infinite shoe
 shoe = coca.Shoe(numdecks=-1)
-dealprob = np.zeros((10, 34), dtype=np.float64)
-weightedexp = np.zeros((10, 34), dtype=np.float64)
 
 best_action = np.fromfile('tables/basic_strategy_infinite_deck_actions.np', 
          dtype=np.int32).reshape((10,34))
@@ -25,32 +23,10 @@ for a in best_action.flatten():
     print '%d,'%a,
 print ']'
 
-# pairs 
+# weight each initial deal by its probability
 tstart = time.time()
-for d0 in coca.allCards: 
-    for m0 in coca.allCards: 
-        for m1 in coca.allCards: 
-
-            # shuffle the shoe and deal the hand
-            shoe.shuffle()
-            dealer_hand = coca.Hand()
-            my_hand = coca.Hand()
-
-            # just to test a skewed deck
-            #for c in xrange(2,6):
-                #delta = shoe.num[c]/2
-                #shoe.num[c] -= delta
-                #shoe.total -= delta
-
-            prb = 1.0;
-            prb *= coca.dealCardToHand(shoe, dealer_hand, card=d0, way='choose')
-            prb *= coca.dealCardToHand(shoe, my_hand, card=m0, way='choose')
-            prb *= coca.dealCardToHand(shoe, my_hand, card=m1, way='choose')
-            ind = coca.getChartIndFromCards(my_hand, dealer_hand)
-            #coca.getAction(shoe, my_hand, dealer_hand, )
-            ind = coca.getChartIndFromCards(my_hand, dealer_hand)
-            dealprob[ind] += prb 
-            weightedexp[ind] += prb*best_exp[ind]
+dealprob = coca.dealProbabilities(shoe)
+weightedexp = dealprob*best_exp
 
 # time it
 tstop = time.time()
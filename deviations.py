@@ -0,0 +1,124 @@
+#!/home/devon/anaconda2/bin/python
+
+# deviations.py
+# builds composition-dependent strategy tables binned by true count.
+# For each deck count, random shoe states are sampled and binned by
+# true count, and the chart is solved for the mean composition of each bin.
+# The result is read back with coca.loadDeviationTable() and coca.lookupAction().
+#
+# usage: ./deviations.py tables/deviations_hilo.npz --decks 1 2 6 8 --system hilo
+
+import numpy as np
+import multiprocessing
+import argparse
+import json
+import time
+import coca
+
+
+# samples shoe states for a numdecks-deck shoe dealt to random depths
+# up to the penetration, and bins them by true count, with bins of width step
+# centred on bins. Returns the number of samples and the mean remaining rank 
+# counts in each bin.
+def sampleCompositions(numdecks, bins, step=1.0, system='hilo', penetration=0.75, num_samples=20000,
+        seed=0, stream=0):
+    rng = coca.Rng(seed=seed, stream=stream)
+    depths = np.random.RandomState(seed+stream).randint(0, int(penetration*52*numdecks)+1,
+            size=num_samples)
+    samples = np.zeros(len(bins), dtype=np.int64)
+    sums = np.zeros((len(bins), 10), dtype=np.float64)
+    for depth in depths:
+        shoe = coca.Shoe(numdecks=numdecks)
+        coca.drawCards(shoe, depth, rng=rng)
+        counts = np.array(shoe.num[2:12], dtype=np.float64)
+        tc = coca.trueCount(counts, numdecks, system=system)
+        b = int(round((tc-bins[0])/step))
+        if 0 <= b < len(bins):
+            samples[b] += 1
+            sums[b] += counts
+    compositions = sums/np.maximum(samples, 1)[:,None]
+    return samples, compositions
+
+# the shoe with the given (rounded) rank counts
+def compositionShoe(composition, numdecks):
+    shoe = coca.Shoe(numdecks=numdecks)
+    for c in xrange(10):
+        shoe.num[c+2] = int(round(composition[c]))
+    shoe.total = sum(shoe.num[2:12])
+    return shoe
+
+# solves one bin's composition through the table store. Runs in a worker process.
+def solveBin(args):
+    d, b, composition, numdecks, rules = args
+    rules = coca.Rules(**rules)
+    best_action, all_exp = coca.getChart(compositionShoe(composition, numdecks), rules=rules,
+            threads=1)
+    return d, b, np.array(best_action), np.array(all_exp)
+
+
+# builds and saves the deviation tables for each deck count
+def buildDeviationTables(path, decks=[1, 2, 6, 8], system='hilo', tc_range=(-10, 10), tc_step=1.0,
+        rules=None, penetration=0.75, num_samples=20000, seed=0, processes=None, verbose=True):
+
+    if rules is None:
+        rules = coca.Rules()
+    bins = np.arange(tc_range[0], tc_range[1]+0.5*tc_step, tc_step)
+    samples = np.zeros((len(decks), len(bins)), dtype=np.int64)
+    compositions = np.zeros((len(decks), len(bins), 10), dtype=np.float64)
+    actions = np.zeros((len(decks), len(bins), 10, 34), dtype=np.int8)
+    exps = np.zeros((len(decks), len(bins), 10, 34, 6), dtype=np.float32)
+
+    # bin the sampled shoe compositions by true count
+    tstart = time.time()
+    for d, numdecks in enumerate(decks):
+        samples[d], compositions[d] = sampleCompositions(numdecks, bins, step=tc_step, system=system,
+                penetration=penetration, num_samples=num_samples, seed=seed, stream=d)
+        if verbose:
+            print '%d decks: %d of %d bins populated' % (numdecks, np.count_nonzero(samples[d]),
+                    len(bins))
+
+    # solve the chart for each populated bin
+    jobs = [(d, b, compositions[d,b], numdecks, coca.rulesArgs(rules))
+            for d, numdecks in enumerate(decks) for b in xrange(len(bins)) if samples[d,b]]
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        for d, b, best_action, all_exp in pool.imap_unordered(solveBin, jobs):
+            actions[d,b] = best_action
+            exps[d,b] = all_exp
+            if verbose:
+                print ' - %d decks, true count %+.1f: solved' % (decks[d], bins[b])
+    finally:
+        pool.close()
+        pool.join()
+
+    np.savez_compressed(path, system=system, decks=np.array(decks, dtype=np.int32), bins=bins,
+            step=tc_step, samples=samples, compositions=compositions, actions=actions, exps=exps,
+            rules=json.dumps(coca.rulesArgs(rules), sort_keys=True), penetration=penetration)
+    if verbose:
+        print 'Saved %d tables to %s in %.1f s' % (len(jobs), path, time.time()-tstart)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Build true-count binned deviation tables.')
+    parser.add_argument('path', help='output file (.npz)')
+    parser.add_argument('--decks', type=int, nargs='+', default=[1, 2, 6, 8], help='deck counts')
+    parser.add_argument('--system', default='hilo', choices=sorted(coca.countingSystems.keys()),
+            help='counting system')
+    parser.add_argument('--tc-range', type=float, nargs=2, default=[-10, 10],
+            help='lowest and highest true count bins')
+    parser.add_argument('--tc-step', type=float, default=1.0, help='true count bin width')
+    parser.add_argument('--penetration', type=float, default=0.75,
+            help='fraction of the shoe dealt before reshuffling')
+    parser.add_argument('--samples', type=int, default=20000, help='shoe states sampled per deck count')
+    parser.add_argument('--errtol', type=float, default=1.0e-5, help='solver error tolerance')
+    parser.add_argument('--h17', type=int, default=0, help='dealer hits soft 17')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes')
+    args = parser.parse_args()
+
+    rules = coca.Rules(dealer_hits_soft_17=args.h17, errtol=args.errtol)
+    buildDeviationTables(args.path, decks=args.decks, system=args.system,
+            tc_range=args.tc_range, tc_step=args.tc_step, rules=rules,
+            penetration=args.penetration, num_samples=args.samples, seed=args.seed,
+            processes=args.processes)
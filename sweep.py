@@ -0,0 +1,189 @@
+#!/home/devon/anaconda2/bin/python
+
+# sweep.py
+# solves the strategy chart for a grid of rule variants across a
+# process pool, collecting everything into one resumable result store
+#
+# usage: ./sweep.py results.npz --decks -1 1 2 6 8 --h17 0 1 --surrender 0 1
+#        ./sweep.py results.npz --render charts --formats png html
+
+import numpy as np
+import multiprocessing
+import itertools
+import argparse
+import time
+import os
+import coca
+
+# the grid parameters, in key order, and their short names
+sweepParams = [
+    ('numdecks', 'decks'),
+    ('dealer_hits_soft_17', 'h17'),
+    ('double_after_split', 'das'),
+    ('max_split_depth', 'msd'),
+    ('can_hit_split_aces', 'hsa'),
+    ('surrender', 'sur'),
+]
+
+defaultVariant = {'numdecks': -1, 'dealer_hits_soft_17': 0, 'double_after_split': 1,
+        'max_split_depth': 2, 'can_hit_split_aces': 0, 'surrender': 1}
+
+
+# a unique, readable name for one variant, tagged with the engine version 
+# so that a resumed store re-solves charts made by an older solver
+def variantKey(variant, errtol):
+    return ','.join(['%s=%d' % (short, variant[name]) for name, short in sweepParams]) \
+            + ',errtol=%.1e,engine=%d' % (errtol, coca._caco.engine_version())
+
+# expands a dict of parameter -> list of values into all variants
+def variantGrid(grid):
+    names = [name for name, _ in sweepParams]
+    values = [grid.get(name, [defaultVariant[name]]) for name in names]
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+# the shoe and rules describing one variant
+def variantShoeAndRules(variant, errtol):
+    shoe = coca.Shoe(numdecks=variant['numdecks'])
+    rules = coca.Rules(allowed_actions=[1,1,1,1,variant['surrender'],0],
+            max_split_depth=variant['max_split_depth'],
+            double_after_split=variant['double_after_split'],
+            dealer_hits_soft_17=variant['dealer_hits_soft_17'],
+            can_hit_split_aces=variant['can_hit_split_aces'], errtol=errtol)
+    return shoe, rules
+
+# solves one variant. Runs in a worker process.
+def solveVariant(args):
+    variant, errtol = args
+    tstart = time.time()
+    shoe, rules = variantShoeAndRules(variant, errtol)
+    best_action, all_exp = coca.computeChart(shoe, rules=rules, threads=1)
+    house_edge = coca.houseEdge(shoe, all_exp, best_action=best_action)
+    return variant, best_action, all_exp, house_edge, time.time()-tstart
+
+
+# the consolidated result store: one .npz file holding, for each variant,
+# its key, rule parameters, action table, EV table and house edge
+class SweepStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = []
+        self.params = []
+        self.actions = []
+        self.exps = []
+        self.house_edge = []
+        self.seconds = []
+        if os.path.exists(path):
+            data = np.load(path)
+            self.keys = list(data['keys'])
+            self.params = list(data['params'])
+            self.actions = list(data['actions'])
+            self.exps = list(data['exps'])
+            self.house_edge = list(data['house_edge'])
+            self.seconds = list(data['seconds'])
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, variant, best_action, all_exp, house_edge, seconds):
+        self.keys.append(key)
+        self.params.append([variant[name] for name, _ in sweepParams])
+        self.actions.append(best_action)
+        self.exps.append(all_exp)
+        self.house_edge.append(house_edge)
+        self.seconds.append(seconds)
+
+    # writes the whole store, atomically so that an interrupted
+    # sweep always leaves a readable file behind
+    def save(self):
+        tmppath = self.path + '.tmp.npz'
+        np.savez(tmppath, keys=np.array(self.keys, dtype=str),
+                param_names=np.array([name for name, _ in sweepParams], dtype=str),
+                params=np.array(self.params, dtype=np.int32).reshape((-1, len(sweepParams))),
+                actions=np.array(self.actions, dtype=np.int32).reshape((-1, 10, 34)),
+                exps=np.array(self.exps, dtype=np.float64).reshape((-1, 10, 34, 6)),
+                house_edge=np.array(self.house_edge, dtype=np.float64),
+                seconds=np.array(self.seconds, dtype=np.float64))
+        os.rename(tmppath, self.path)
+
+    # the stored tables for one variant
+    def get(self, key):
+        i = self.keys.index(key)
+        return self.actions[i], self.exps[i], self.house_edge[i]
+
+
+# solves every variant in the grid that is not already in the store at path,
+# saving after each one finishes. Returns the store.
+def sweepRules(grid, path, errtol=1.0e-5, processes=None, verbose=True):
+
+    store = SweepStore(path)
+    todo = [v for v in variantGrid(grid) if variantKey(v, errtol) not in store]
+    if verbose:
+        print 'Sweep: %d variants, %d already done, %d to solve' % (len(store)+len(todo),
+                len(store), len(todo))
+    if not todo:
+        return store
+
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        results = pool.imap_unordered(solveVariant, [(v, errtol) for v in todo])
+        for variant, best_action, all_exp, house_edge, seconds in results:
+            key = variantKey(variant, errtol)
+            store.add(key, variant, best_action, all_exp, house_edge, seconds)
+            store.save()
+            if verbose:
+                print ' - %s: house edge = %+.4f pct (%.1f s)' % (key, 100.0*house_edge, seconds)
+    finally:
+        pool.close()
+        pool.join()
+    return store
+
+
+# writes a chart for every variant in the store at path into outdir,
+# one file per variant and format, rendered over a process pool
+def renderStore(path, outdir, formats=('png',), processes=None, verbose=True):
+    import cocaplot
+    store = SweepStore(path)
+    charts = []
+    for key in store.keys:
+        best_action, all_exp, house_edge = store.get(key)
+        for fmt in formats:
+            charts.append((os.path.join(outdir, '%s.%s' % (key, fmt)), best_action, all_exp))
+    start = time.time()
+    paths = cocaplot.renderCharts(charts, processes=processes)
+    if verbose:
+        print 'Rendered %d charts for %d variants in %.1f s' % (len(paths), len(store),
+                time.time()-start)
+    return paths
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Solve strategy charts for a grid of rule variants.')
+    parser.add_argument('store', help='result store (.npz), resumed if it exists')
+    parser.add_argument('--decks', type=int, nargs='+', default=[-1],
+            help='number of decks, -1 for an infinite shoe')
+    parser.add_argument('--h17', type=int, nargs='+', default=[0], help='dealer hits soft 17')
+    parser.add_argument('--das', type=int, nargs='+', default=[1], help='double after split')
+    parser.add_argument('--msd', type=int, nargs='+', default=[2], help='max split depth')
+    parser.add_argument('--hsa', type=int, nargs='+', default=[0], help='can hit split aces')
+    parser.add_argument('--surrender', type=int, nargs='+', default=[1], help='surrender allowed')
+    parser.add_argument('--errtol', type=float, default=1.0e-5, help='solver error tolerance')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes')
+    parser.add_argument('--render', metavar='DIR', default=None,
+            help='render the charts already in the store into DIR instead of solving')
+    parser.add_argument('--formats', nargs='+', default=['png'],
+            choices=['png', 'svg', 'pdf', 'html'], help='chart formats to render')
+    args = parser.parse_args()
+
+    if args.render is not None:
+        renderStore(args.store, args.render, formats=args.formats, processes=args.processes)
+        raise SystemExit
+
+    grid = {'numdecks': args.decks, 'dealer_hits_soft_17': args.h17,
+            'double_after_split': args.das, 'max_split_depth': args.msd,
+            'can_hit_split_aces': args.hsa, 'surrender': args.surrender}
+    sweepRules(grid, args.store, errtol=args.errtol, processes=args.processes)
@@ -0,0 +1,872 @@
+#!/home/devon/anaconda2/bin/python
+
+# test_coca.py
+# regression tests for the python interface
+#
+# usage: ./test_coca.py
+
+import numpy as np
+import unittest
+import collections
+import subprocess
+import threading
+import tempfile
+import shutil
+import json
+import sys
+import os
+import betting
+import coca
+
+
+class RecordFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'rounds.sim')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def play(self, num_rounds, seed):
+        chunks, game = coca.simulateGame(num_rounds, num_players=2, seed=seed, path=self.path,
+                chunk_rounds=500)
+        for chunk in chunks:
+            pass
+        return game
+
+    # appending from a new Game continues the rounds instead of replaying them
+    def testAppendContinues(self):
+        for seed in [5, None]:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.play(1000, seed)
+            game = self.play(1000, seed)
+            records = coca.openRecords(self.path)
+            self.assertEqual(len(records), 4000)
+            self.assertTrue(np.all(records['round'][::2] == np.arange(2000)))
+            self.assertTrue(np.all(records['seat'] == np.tile([0, 1], 2000)))
+            self.assertFalse(np.all(records['net'][:2000] == records['net'][2000:]))
+            self.assertEqual(game.rounds, 2000)
+
+        # the same rounds as one unbroken run
+        reference = coca.Game(num_seats=2, seed=game.seed)
+        net = reference.play(2000)
+        self.assertTrue(np.all(records['net'].reshape((2000, 2)) == net))
+
+    # a game that has played rounds elsewhere cannot append to the file
+    def testAppendAfterPlaying(self):
+        self.play(1000, 5)
+        game = coca.Game(num_seats=2, seed=5)
+        game.play(10)
+        with self.assertRaises(ValueError):
+            game.openRecords(self.path)
+
+
+class FiniteShoeChartTest(unittest.TestCase):
+
+    # the values of the chart cell for these cards against dealer_card, 
+    # averaged over the given deals, each solved by getAction() on the 
+    # shoe less the deal and weighted by how likely it is after the up card
+    def dealValues(self, numdecks, deals, dealer_card, rules):
+        total, weights = 0.0, 0.0
+        for cards in deals:
+            shoe = coca.Shoe(numdecks=numdecks)
+            dealer_hand = coca.Hand()
+            my_hand = coca.Hand()
+            coca.dealCardToHand(shoe, dealer_hand, dealer_card, way='choose')
+            prb = 1.0
+            for card in cards:
+                prb *= coca.dealCardToHand(shoe, my_hand, card, way='choose')
+            _, exp = coca.getAction(shoe, dealer_hand, my_hand, rules=rules)
+            total += prb*exp
+            weights += prb
+        return coca.getChartIndFromCards(my_hand, dealer_hand), total/weights
+
+    # soft totals and pairs are solved on the shoe less their one deal, 
+    # and hard totals average over every pair of cards that makes them
+    def testCells(self):
+        rules = coca.Rules(errtol=1.0e-5)
+        best_action, all_exp = coca.computeChart(coca.Shoe(numdecks=2), rules=rules)
+        for deals, dealer_card in [([[6, 10], [7, 9]], 10), ([[2, 9], [3, 8], [4, 7], [5, 6]], 6),
+                ([[11, 7]], 9), ([[8, 8]], 11), ([[2, 2]], 4)]:
+            ind, exp = self.dealValues(2, deals, dealer_card, rules)
+            allowed = exp > -999.0
+            self.assertLess(np.abs(all_exp[ind][allowed]-exp[allowed]).max(), 1.0e-12)
+            self.assertEqual(best_action[ind], np.argmax(np.where(allowed, exp, -np.inf)))
+
+    # the 1-deck chart's house edge, solved on the shoe less each deal
+    def testOneDeckEdge(self):
+        shoe = coca.Shoe(numdecks=1)
+        best_action, all_exp = coca.computeChart(shoe, rules=coca.Rules(errtol=1.0e-5))
+        self.assertAlmostEqual(coca.houseEdge(shoe, all_exp, best_action=best_action),
+                -0.0073133784970622, places=12)
+
+
+class GameTest(unittest.TestCase):
+
+    # with no peek, playing the solver's infinite-deck chart in the round 
+    # engine loses -houseEdge() of the chart per round, within 4 standard 
+    # errors, under rules that exercise surrender, doubling after splits, 
+    # re-splits, hitting split aces and a dealer hitting soft 17
+    def testHouseEdge(self):
+        shoe = coca.Shoe(numdecks=-1)
+        for seed, kwargs in [(1, {}), (2, {'dealer_hits_soft_17': 1, 'double_after_split': 0,
+                'can_hit_split_aces': 1}), (3, {'allowed_actions': [1,1,1,1,0,0],
+                'max_split_depth': 1})]:
+            rules = coca.Rules(errtol=0.0, **kwargs)
+            best_action, all_exp = coca.computeChart(shoe, rules=rules, exact=True)
+            edge = coca.houseEdge(shoe, all_exp, best_action=best_action)
+            game = coca.Game(num_decks=-1, rules=rules, peek=False, seed=seed,
+                    strategy=coca.Strategy(type='table', actions=best_action))
+            game.simulate(8000000)
+            self.assertLess(abs(-game.mean[0]-edge), 4*game.stderr[0])
+
+
+class RngTest(unittest.TestCase):
+
+    def draw(self, num_cards, seed, stream, numdecks=6):
+        shoe = coca.Shoe(numdecks=numdecks)
+        return coca.drawCards(shoe, num_cards, rng=coca.Rng(seed=seed, stream=stream)), shoe
+
+    # a seed and stream always give the same cards, and other seeds 
+    # or streams give different ones
+    def testStreams(self):
+        cards, _ = self.draw(200, 5, 0)
+        self.assertTrue(np.array_equal(self.draw(200, 5, 0)[0], cards))
+        for seed, stream in [(5, 1), (5, 2), (6, 0)]:
+            self.assertFalse(np.array_equal(self.draw(200, seed, stream)[0], cards))
+        game = coca.Game(seed=5, stream=3)
+        net = game.play(1000)
+        self.assertTrue(np.array_equal(coca.Game(seed=5, stream=3).play(1000), net))
+        self.assertFalse(np.array_equal(coca.Game(seed=5, stream=4).play(1000), net))
+
+    # drawn cards are taken from the shoe, an emptied shoe gives 0s,
+    # and an infinite shoe never runs out
+    def testDrawCards(self):
+        cards, shoe = self.draw(100, 7, 0)
+        full = coca.Shoe(numdecks=6)
+        taken = np.bincount(cards, minlength=12)[2:12]
+        self.assertTrue(np.array_equal(np.array(full.num[2:12])-taken, shoe.num[2:12]))
+        self.assertEqual(shoe.total, full.total-100)
+
+        cards, shoe = self.draw(60, 7, 0, numdecks=1)
+        self.assertTrue(np.array_equal(np.bincount(cards[:52], minlength=12)[2:12],
+                coca.Shoe(numdecks=1).num[2:12]))
+        self.assertTrue(np.all(cards[52:] == 0))
+        self.assertEqual((shoe.total, sum(shoe.num[2:12])), (0, 0))
+
+        # every rank at its probability, within 5 standard errors
+        cards, shoe = self.draw(1000000, 7, 0, numdecks=-1)
+        self.assertEqual(list(shoe.num), list(coca.Shoe(numdecks=-1).num))
+        prb = np.array(8*[1.0/13] + [4.0/13, 1.0/13])
+        freq = np.bincount(cards, minlength=12)[2:12]/1.0e6
+        self.assertTrue(np.all(np.abs(freq-prb) < 5*np.sqrt(prb*(1-prb)/1.0e6)))
+
+
+class TableStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = coca.TableStore(self.tmpdir)
+        self.shoe = coca.Shoe(numdecks=-1)
+        self.rules = coca.Rules(errtol=1.0e-3)
+        picks = np.random.RandomState(1)
+        self.chart = (picks.randint(0, 5, size=(10, 34)).astype(np.int32), picks.randn(10, 34, 6))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    # a saved chart and its header read back unchanged
+    def testRoundTrip(self):
+        self.assertIsNone(self.store.lookup(self.shoe, self.rules))
+        self.store.save(self.shoe, self.rules, *self.chart)
+        fname = self.store.filename(self.shoe, self.rules)
+        self.assertEqual(self.store.readHeader(fname), self.store.metadata(self.shoe, self.rules))
+        actions, all_exp = self.store.lookup(self.shoe, self.rules)
+        self.assertTrue(np.array_equal(actions, self.chart[0]))
+        self.assertTrue(np.array_equal(all_exp, self.chart[1]))
+        self.assertEqual((self.store.hits, self.store.misses), (1, 1))
+
+        # a file that is not a table is a miss
+        with open(fname, 'r+b') as f:
+            f.write('NOTATBL\0')
+        self.assertIsNone(self.store.lookup(self.shoe, self.rules))
+
+    # other rules, deck counts or shoe compositions get their own files
+    def testKeys(self):
+        self.store.save(self.shoe, self.rules, *self.chart)
+        depleted = coca.Shoe(numdecks=6)
+        coca.drawCards(depleted, 20, rng=coca.Rng(seed=1))
+        others = [(self.shoe, coca.Rules(errtol=1.0e-3, dealer_hits_soft_17=1)),
+                (self.shoe, coca.Rules(errtol=1.0e-4)),
+                (self.shoe, coca.Rules(errtol=1.0e-3, allowed_actions=[1,1,1,1,0,0])),
+                (coca.Shoe(numdecks=6), self.rules), (coca.Shoe(numdecks=2), self.rules),
+                (depleted, self.rules)]
+        names = set([self.store.filename(self.shoe, self.rules)])
+        for shoe, rules in others:
+            self.assertIsNone(self.store.lookup(shoe, rules))
+            names.add(self.store.filename(shoe, rules))
+        self.assertEqual(len(names), len(others)+1)
+        self.assertIsNotNone(self.store.lookup(self.shoe, self.rules))
+
+    # a chart stored by another engine version is solved again
+    def testEngineVersion(self):
+        version = coca._caco.engine_version()
+        coca._caco.engine_version = lambda: version-1
+        try:
+            self.store.save(self.shoe, self.rules, *self.chart)
+            old = self.store.filename(self.shoe, self.rules)
+        finally:
+            del coca._caco.engine_version
+        self.assertEqual(coca._caco.engine_version(), version)
+        self.assertIsNone(self.store.lookup(self.shoe, self.rules))
+
+        # even under the current file name, an old header is a miss
+        fname = self.store.filename(self.shoe, self.rules)
+        self.assertNotEqual(fname, old)
+        shutil.copy(old, fname)
+        self.assertIsNone(self.store.lookup(self.shoe, self.rules))
+        actions, all_exp = self.store.getChart(self.shoe, self.rules)
+        best_action, expected = coca.computeChart(self.shoe, rules=self.rules)
+        self.assertTrue(np.array_equal(actions, best_action))
+        self.assertTrue(np.array_equal(all_exp, expected))
+        self.assertEqual(self.store.readHeader(fname)['engine_version'], version)
+
+
+class SimulateTablesTest(unittest.TestCase):
+
+    # the merged statistics are the same from run to run and for any pool size,
+    # table i is stream i of the seed, and the merge agrees with pooling every round
+    def testReproducible(self):
+        tables = [{'num_seats': 1}, {'num_seats': 3}, {'num_seats': 2, 'num_decks': 2}, {}]
+        first = coca.simulateTables(tables, 3000, seed=9, processes=1, num_seats=2)
+        for processes in [1, 2, 3]:
+            result = coca.simulateTables(tables, 3000, seed=9, processes=processes, num_seats=2)
+            for name in ['rounds', 'mean', 'var', 'stderr']:
+                self.assertTrue(np.array_equal(result['seats'][name], first['seats'][name]))
+            for table, expected in zip(result['tables'], first['tables']):
+                self.assertTrue(np.array_equal(table['mean'], expected['mean']))
+
+        nets = [[] for s in xrange(3)]
+        for i, table in enumerate(tables):
+            game = coca.Game(seed=9, stream=i, **dict({'num_seats': 2}, **table))
+            net = game.play(3000)
+            self.assertTrue(np.array_equal(game.mean, first['tables'][i]['mean']))
+            for s in xrange(net.shape[1]):
+                nets[s].append(net[:,s])
+        for s in xrange(3):
+            net = np.concatenate(nets[s])
+            self.assertEqual(first['seats']['rounds'][s], len(net))
+            self.assertAlmostEqual(first['seats']['mean'][s], net.mean(), places=12)
+            self.assertAlmostEqual(first['seats']['var'][s], net.var(ddof=1), places=12)
+
+
+class BettingTest(unittest.TestCase):
+
+    # a hand-made edge table. The last bin is too sparse to trust and
+    # takes the edge and variance of its neighbor.
+    def setUp(self):
+        rounds = np.array([5000, 20000, 40000, 20000, 5000, 10])
+        self.edges = {'bins': np.arange(-2.0, 4.0), 'rounds': rounds,
+                'frequency': rounds/float(np.sum(rounds)),
+                'edge': np.array([-0.03, -0.01, -0.005, 0.005, 0.015, 0.5]),
+                'var': np.array([1.3, 1.3, 1.3, 1.3, 1.3, 9.0])}
+
+    # win rate and variance of the mixture of bins, and the diffusion risk of ruin
+    def testSpreadStats(self):
+        frequency = np.array([0.5, 0.3, 0.2])
+        edge = np.array([-0.01, 0.01, 0.02])
+        var = np.array([1.2, 1.3, 1.4])
+        bets = np.array([[10.0, 20.0, 40.0], [20.0, 10.0, 5.0]])
+        win, spreadvar, ror = betting.spreadStats(bets, frequency, edge, var, 1000.0)
+        self.assertTrue(np.allclose(win, [0.01*(-0.5*10+0.3*20+0.2*2*40), -0.05]))
+        second = 0.5*100*(1.2+1.0e-4) + 0.3*400*(1.3+1.0e-4) + 0.2*1600*(1.4+4.0e-4)
+        self.assertAlmostEqual(spreadvar[0], second-win[0]**2, places=10)
+        self.assertAlmostEqual(ror[0], np.exp(-2*win[0]*1000/spreadvar[0]), places=12)
+        self.assertEqual(ror[1], 1.0)  # a losing spread is ruined for sure
+
+    # Kelly bets are bankroll*edge/variance within the limits, the spread and the unit
+    def testKelly(self):
+        result = betting.optimalBets(self.edges, 13000.0, 10.0, 100.0)
+        self.assertTrue(np.allclose(result['bets'], [10, 10, 10, 50, 100, 100]))
+        self.assertTrue(np.allclose(result['edge'][4:], 0.015))
+        win = np.dot(result['bets'], self.edges['frequency']*result['edge'])
+        self.assertAlmostEqual(result['win'], win, places=12)
+        self.assertAlmostEqual(result['n0'], result['sd']**2/win**2, places=6)
+        self.assertEqual((result['spread'], result['kelly'], result['feasible']), (10.0, 1.0, True))
+
+        for args, bets in [({'kelly': 0.5}, [10, 10, 10, 25, 75, 75]),
+                ({'unit': 30.0}, [10, 10, 10, 60, 90, 90]),
+                ({'max_spread': 8}, [10, 10, 10, 50, 80, 80]),
+                ({'wong_out': True}, [0, 0, 0, 50, 100, 100])]:
+            result = betting.optimalBets(self.edges, 13000.0, 10.0, 100.0, **args)
+            self.assertTrue(np.allclose(result['bets'], bets))
+        self.assertEqual(result['spread'], 2.0)
+
+        for limits in [(0.0, 100.0), (10.0, 5.0)]:
+            self.assertRaises(ValueError, betting.optimalBets, self.edges, 13000.0, *limits)
+        self.assertRaises(ValueError, betting.optimalBets, self.edges, 13000.0, 10.0, 100.0,
+                ror=1.0)
+        self.assertRaises(ValueError, betting.optimalBets, self.edges, 13000.0, 10.0, 100.0,
+                min_rounds=100000)
+
+    # with one bin bet, the risk of ruin exp(-2*f*e*B/(b*(f*(v+e^2)-f^2*e^2)))
+    # grows with the bet b, so the best bet is the largest one that meets the target
+    def testRiskOfRuin(self):
+        rounds = np.array([90000, 10000])
+        edges = {'bins': np.array([0.0, 1.0]), 'rounds': rounds, 'frequency': rounds/1.0e5,
+                'edge': np.array([-0.01, 0.02]), 'var': np.array([1.3, 1.3])}
+        f, e, v = 0.1, 0.02, 1.3
+        best = -2*f*e*10000/((f*(v+e**2)-(f*e)**2)*np.log(0.05))
+        result = betting.optimalBets(edges, 10000.0, 5.0, 500.0, ror=0.05, wong_out=True)
+        bet = result['bets'][1]
+        self.assertEqual(result['bets'][0], 0.0)
+        self.assertTrue(result['feasible'])
+        self.assertLessEqual(bet, best)
+        self.assertGreater(bet, best*(500.0/5.0)**(-1.0/2047))
+        self.assertLessEqual(result['ror'], 0.05)
+        self.assertAlmostEqual(result['kelly'], bet/(10000*e/v), places=12)
+
+        # a target that even the table minimum misses gets the minimum
+        result = betting.optimalBets(edges, 10000.0, 5.0, 500.0, ror=1.0e-30, wong_out=True)
+        self.assertFalse(result['feasible'])
+        self.assertAlmostEqual(result['bets'][1], 5.0, places=12)
+        self.assertGreater(result['ror'], 1.0e-30)
+
+    # betSpread measures the edges once and solves the same bets as optimalBets
+    def testBetSpread(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            store = betting.EdgeStore(tmpdir)
+            args = {'tc_range': (-4, 4), 'num_rounds': 1<<14, 'processes': 1, 'num_decks': 2,
+                    'store': store}
+            result = betting.betSpread(10000.0, 10.0, 200.0, **args)
+            self.assertEqual((store.hits, store.misses), (0, 1))
+            again = betting.betSpread(10000.0, 10.0, 200.0, **args)
+            self.assertEqual((store.hits, store.misses), (1, 1))
+            self.assertTrue(np.array_equal(result['bets'], again['bets']))
+            edges = betting.countEdges(betting.gameMetadata(num_decks=2), tc_range=(-4, 4),
+                    num_rounds=1<<14, processes=1)
+            expected = betting.optimalBets(edges, 10000.0, 10.0, 200.0)
+            self.assertTrue(np.array_equal(result['bets'], expected['bets']))
+            self.assertEqual(result['win'], expected['win'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class LookupActionsTest(unittest.TestCase):
+
+    # lookupActions() agrees with table_action() in C on every two-card hand,
+    # for a random table where every action, splitting tens included, shows up
+    def testMatchesC(self):
+        actions = np.random.RandomState(3).randint(0, 5, size=(10, 34))
+        strategy = coca.Strategy(type='table', actions=actions)
+        for allowed_actions in [[1,1,1,1,1,0], [1,1,0,1,0,0], [1,1,1,0,1,0]]:
+            rules = coca.Rules(allowed_actions=allowed_actions)
+            dealer_up, points, softness, ispair, expected = [], [], [], [], []
+            for d in coca.allCards:
+                dealer = coca.Hand()
+                dealer.addCard(d)
+                for c0 in coca.allCards:
+                    for c1 in coca.allCards:
+                        hand = coca.Hand()
+                        hand.addCard(c0)
+                        hand.addCard(c1)
+                        dealer_up.append(d)
+                        points.append(hand.points)
+                        softness.append(hand.softness)
+                        ispair.append(hand.ispair)
+                        expected.append(strategy.fromTable(dealer, hand, rules=rules))
+            ispair = np.array(ispair, dtype=bool)
+            allowed = np.tile(np.array(allowed_actions, dtype=bool), (len(ispair), 1))
+            allowed[:,coca.SPLIT] &= ispair
+            action, _ = coca.lookupActions(dealer_up, points, softness, ispair, strategy,
+                    allowed=allowed)
+            self.assertTrue(np.all(action == np.array(expected)))
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rules = coca.Rules(errtol=1.0e-5)
+
+    def tearDown(self):
+        coca.disableCache()
+
+    # the chart solved with the cache enabled is within errtol of the uncached one
+    def testChart(self):
+        shoe = coca.Shoe(numdecks=-1)
+        best_action, all_exp = coca.computeChart(shoe, rules=self.rules)
+        coca.enableCache()
+        cached_action, cached_exp = coca.computeChart(shoe, rules=self.rules)
+        self.assertTrue(np.all(cached_action == best_action))
+        self.assertLessEqual(np.abs(cached_exp-all_exp).max(), self.rules.errtol)
+
+    # single hands solved one after another on a warm cache, each twice,
+    # are within errtol of the uncached solve
+    def testGetAction(self):
+        hands = []
+        for cards, dealer_card in [([10, 6], 10), ([11, 7], 9), ([7, 4], 6), ([8, 8], 10),
+                ([11, 11], 6), ([2, 2], 5)]:
+            shoe = coca.Shoe(numdecks=6)
+            my_hand = coca.Hand()
+            dealer_hand = coca.Hand()
+            for card in cards:
+                coca.dealCardToHand(shoe, my_hand, card, way='choose')
+            coca.dealCardToHand(shoe, dealer_hand, dealer_card, way='choose')
+            hands.append((shoe, dealer_hand, my_hand))
+        uncached = [coca.getAction(*hand, rules=self.rules) for hand in hands]
+        coca.enableCache()
+        for hand, (action, exp) in zip(2*hands, 2*uncached):
+            cached_action, cached_exp = coca.getAction(*hand, rules=self.rules)
+            self.assertEqual(cached_action, action)
+            self.assertLessEqual(np.abs(cached_exp-exp).max(), self.rules.errtol)
+        self.assertGreater(coca.getCacheStats().hits, 0)
+
+        # clearing empties the cache but leaves it enabled
+        self.assertGreater(coca.getCacheStats().numentries, 0)
+        coca.clearCache()
+        stats = coca.getCacheStats()
+        self.assertEqual((stats.numentries, stats.hits, stats.misses), (0, 0, 0))
+        self.assertGreater(stats.capacity, 0)
+
+    # getAction() and dealerOutcomes() give the serial results when called
+    # from many threads at once, each with its own dealer outcome cache
+    def testConcurrent(self):
+        jobs = []
+        for numdecks in [-1, 1, 6]:
+            for cards, dealer_card in [([10, 6], 10), ([11, 7], 9), ([8, 8], 11), ([7, 4], 6)]:
+                shoe = coca.Shoe(numdecks=numdecks)
+                my_hand = coca.Hand()
+                dealer_hand = coca.Hand()
+                for card in cards:
+                    coca.dealCardToHand(shoe, my_hand, card, way='choose')
+                coca.dealCardToHand(shoe, dealer_hand, dealer_card, way='choose')
+                jobs.append((shoe, dealer_hand, my_hand))
+        def solve(job):
+            action, exp = coca.getAction(*job, rules=self.rules)
+            return action, exp, coca.dealerOutcomes(job[0], job[1], rules=self.rules)
+        serial = [solve(job) for job in jobs]
+        results = {}
+        def worker(t):
+            order = np.random.RandomState(t).permutation(len(jobs))
+            results[t] = [(i, solve(jobs[i])) for i in order]
+        threads = [threading.Thread(target=worker, args=(t,)) for t in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 8)
+        for t in results:
+            for i, (action, exp, outcomes) in results[t]:
+                self.assertEqual(action, serial[i][0])
+                self.assertTrue(np.array_equal(exp, serial[i][1]))
+                self.assertTrue(np.array_equal(outcomes, serial[i][2]))
+
+
+class AnytimeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shoe = coca.Shoe(numdecks=2)
+        self.my_hand = coca.Hand()
+        self.dealer_hand = coca.Hand()
+        for card in [10, 6]:
+            coca.dealCardToHand(self.shoe, self.my_hand, card, way='choose')
+        coca.dealCardToHand(self.shoe, self.dealer_hand, 10, way='choose')
+
+    # the bounds of every pass hold the exact values, and with time to
+    # spare the search stops at a dominant action or at min_errtol
+    def testBounds(self):
+        exact_action, exact = coca.getAction(self.shoe, self.dealer_hand, self.my_hand,
+                rules=coca.Rules(errtol=0.0))
+        result = coca.getActionAnytime(self.shoe, self.dealer_hand, self.my_hand, 60.0,
+                errtol=1.0e-1, min_errtol=1.0e-6)
+        allowed = exact > -999.0
+        self.assertTrue(np.all(result['lower'][allowed] <= exact[allowed]+1.0e-12))
+        self.assertTrue(np.all(result['upper'][allowed] >= exact[allowed]-1.0e-12))
+        self.assertTrue(result['dominant'] or result['errtol'] <= 1.0e-6)
+        self.assertEqual(result['action'], exact_action)
+
+    # with no time at all the first pass still finishes
+    def testNoTime(self):
+        result = coca.getActionAnytime(self.shoe, self.dealer_hand, self.my_hand, 0.0,
+                errtol=1.0e-2, min_errtol=1.0e-8)
+        self.assertEqual(result['passes'], 1)
+        self.assertEqual(result['errtol'], 1.0e-2)
+
+
+class DealerOutcomesTest(unittest.TestCase):
+
+    # the dealer's final hand by brute-force enumeration of the draws,
+    # indexed as in coca.outcomeLabels
+    def enumerate(self, cards, counts, hits_soft_17, prb=1.0, outcomes=None):
+        if outcomes is None:
+            outcomes = np.zeros(7)
+        points = sum(cards)
+        soft = cards.count(11)
+        while soft and points > 21:
+            points -= 10
+            soft -= 1
+        if len(cards) == 2 and points == 21:
+            outcomes[5] += prb
+        elif points > 21:
+            outcomes[6] += prb
+        elif points > 17 or (points == 17 and not (soft and hits_soft_17)):
+            outcomes[points-17] += prb
+        else:
+            total = float(sum(counts.values()))
+            for card, num in counts.items():
+                if num:
+                    counts[card] -= 1
+                    self.enumerate(cards+[card], counts, hits_soft_17, prb*num/total, outcomes)
+                    counts[card] += 1
+        return outcomes
+
+    # dealerOutcomes() sums to 1 and matches the enumeration, for every
+    # up card and a few two-card hands, A,A included
+    def testBruteForce(self):
+        shoe = coca.Shoe(numdecks=1)
+        for card in [5, 10, 11]:
+            shoe.num[card] -= 1
+        shoe.total -= 3
+        counts = dict((c, shoe.num[c]) for c in coca.allCards)
+        for hits_soft_17 in [0, 1]:
+            rules = coca.Rules(dealer_hits_soft_17=hits_soft_17, errtol=0.0)
+            for cards in [[c] for c in coca.allCards] + [[11, 11], [6, 11], [10, 6], [2, 3]]:
+                dealer_hand = coca.Hand()
+                for card in cards:
+                    dealer_hand.addCard(card)
+                outcomes = coca.dealerOutcomes(shoe, dealer_hand, rules=rules)
+                self.assertAlmostEqual(outcomes.sum(), 1.0, places=12)
+                self.assertLess(np.abs(outcomes-self.enumerate(cards, counts, hits_soft_17)).max(),
+                        1.0e-12)
+
+
+class ComputeChartTest(unittest.TestCase):
+
+    def tearDown(self):
+        coca.disableCache()
+
+    # the chart is bit-identical for any number of threads, with or without
+    # the cache, on an infinite shoe and on a single suit
+    def testThreads(self):
+        suit = coca.Shoe(numdecks=1)
+        for c in coca.allCards:
+            suit.num[c] = 4 if c == 10 else 1
+        suit.total = 13
+        for shoe in [coca.Shoe(numdecks=-1), suit]:
+            best_action, all_exp = coca.computeChart(shoe, threads=1)
+            for threads, cache in [(4, False), (3, True)]:
+                if cache:
+                    coca.enableCache()
+                threaded_action, threaded_exp = coca.computeChart(shoe, threads=threads)
+                coca.disableCache()
+                self.assertTrue(np.array_equal(threaded_action, best_action))
+                self.assertTrue(np.array_equal(threaded_exp, all_exp))
+
+
+class EvaluateCompositionsTest(unittest.TestCase):
+
+    # one batch call gives the chart cell of computeChart() for each shoe,
+    # which is solved on the shoe less the deal, for any number of threads
+    def testMatchesChart(self):
+        rules = coca.Rules(errtol=1.0e-6)
+        shoes = [np.array(counts) for counts in [[2, 2, 2, 2, 2, 2, 2, 2, 8, 2],
+                [1, 2, 0, 2, 2, 2, 2, 2, 5, 2], [2, 0, 1, 1, 1, 2, 2, 1, 6, 1],
+                [0, 1, 2, 0, 2, 1, 2, 2, 3, 2]]]
+        for cards, dealer_card in [([8, 8], 10), ([11, 6], 9), ([10, 10], 6)]:
+            my_hand = coca.Hand()
+            for card in cards:
+                my_hand.addCard(card)
+            dealer_hand = coca.Hand()
+            dealer_hand.addCard(dealer_card)
+            dealer_ind, my_ind = coca.getChartIndFromCards(my_hand, dealer_hand)
+            dealt, expected = [], []
+            for counts in shoes:
+                shoe = coca.Shoe(numdecks=1)
+                for c in xrange(10):
+                    shoe.num[c+2] = counts[c]
+                shoe.total = counts.sum()
+                best_action, all_exp = coca.computeChart(shoe, rules=rules)
+                expected.append((best_action[dealer_ind,my_ind], all_exp[dealer_ind,my_ind]))
+                counts = counts.copy()
+                for card in cards+[dealer_card]:
+                    counts[card-2] -= 1
+                dealt.append(counts)
+            for threads in [1, 4]:
+                actions, exps = coca.evaluateCompositions(dealt+dealt[:1], dealer_hand, my_hand,
+                        rules=rules, threads=threads, block_size=2)
+                self.assertEqual(len(actions), len(shoes)+1)
+                self.assertTrue(np.array_equal(exps[-1], exps[0]))
+                for (action, exp), batch_action, batch_exp in zip(expected, actions, exps):
+                    self.assertEqual(batch_action, action)
+                    self.assertLessEqual(np.abs(batch_exp-exp).max(), rules.errtol)
+
+
+class ExactChartTest(unittest.TestCase):
+
+    # the player's best expected values (stand, hit, double) by brute-force
+    # enumeration of every draw, for a shoe of counts of 2..11, with a dealer 
+    # standing on all 17s and no peek, splits or surrender
+    def enumerate(self, counts, dealer_card, cards):
+        dealer_memo, player_memo = {}, {}
+        def add(points, soft, card):
+            points, soft = points+card, soft+(card == 11)
+            while soft and points > 21:
+                points, soft = points-10, soft-1
+            return points, soft
+        def draws(counts):
+            total = float(sum(counts))
+            for c in xrange(10):
+                if counts[c]:
+                    left = list(counts)
+                    left[c] -= 1
+                    yield c+2, counts[c]/total, tuple(left)
+        # the dealer's final hands as {points or 'bj' or 'bust': probability}
+        def dealer(counts, points, soft, numcards):
+            key = (counts, points, soft, numcards)
+            if key not in dealer_memo:
+                if numcards == 2 and points == 21:
+                    final = {'bj': 1.0}
+                elif points > 21:
+                    final = {'bust': 1.0}
+                elif points >= 17:
+                    final = {points: 1.0}
+                else:
+                    final = {}
+                    for card, prb, left in draws(counts):
+                        for end, p in dealer(left, *(add(points, soft, card)+(numcards+1,))).items():
+                            final[end] = final.get(end, 0.0) + prb*p
+                dealer_memo[key] = final
+            return dealer_memo[key]
+        def stand(counts, points):
+            exp = 0.0
+            for end, prb in dealer(counts, dealer_card, int(dealer_card == 11), 1).items():
+                if end == 'bj' or (end != 'bust' and end > points):
+                    exp -= prb
+                elif end == 'bust' or end < points:
+                    exp += prb
+            return exp
+        # the best value of playing on, hitting or standing
+        def play(counts, points, soft):
+            key = (counts, points, soft)
+            if key not in player_memo:
+                player_memo[key] = -1.0 if points > 21 else max(stand(counts, points),
+                        hit(counts, points, soft))
+            return player_memo[key]
+        def hit(counts, points, soft):
+            return sum(prb*play(left, *add(points, soft, card))
+                    for card, prb, left in draws(counts))
+        def double(counts, points, soft):
+            return sum(2*prb*(-1.0 if add(points, soft, card)[0] > 21
+                    else stand(left, add(points, soft, card)[0])) for card, prb, left in draws(counts))
+        counts = list(counts)
+        for card in cards+[dealer_card]:
+            counts[card-2] -= 1
+        counts = tuple(counts)
+        points, soft = add(*(add(0, 0, cards[0])+(cards[1],)))
+        return np.array([stand(counts, points), hit(counts, points, soft),
+                double(counts, points, soft)])
+
+    # every hard and soft cell of the exact chart matches the enumeration, 
+    # averaged over the deals of a hard total as computeChart() does
+    def testBruteForce(self):
+        counts = [1, 1, 1, 1, 1, 1, 1, 1, 4, 1]
+        shoe = coca.Shoe(numdecks=1)
+        for c in xrange(10):
+            shoe.num[c+2] = counts[c]
+        shoe.total = sum(counts)
+        rules = coca.Rules(allowed_actions=[1,1,1,0,0,0], errtol=0.0)
+        best_action, all_exp = coca.computeChart(shoe, rules=rules, exact=True)
+        for dealer_card in coca.allCards:
+            left = list(counts)
+            left[dealer_card-2] -= 1
+            deals = collections.defaultdict(list)
+            for c0 in xrange(2, 11):
+                for c1 in xrange(c0+1, 11):
+                    if left[c0-2] and left[c1-2]:
+                        deals[19-(c0+c1)].append(([c0, c1], left[c0-2]*left[c1-2]))
+            for c in xrange(2, 10):
+                if left[9] and left[c-2]:
+                    deals[25-c].append(([11, c], 1))
+            for my_ind, hands in deals.items():
+                exp = sum(weight*self.enumerate(counts, dealer_card, cards)
+                        for cards, weight in hands)/sum(weight for _, weight in hands)
+                cell = (dealer_card-2, my_ind)
+                self.assertLess(np.abs(all_exp[cell][:3]-exp).max(), 1.0e-12)
+                self.assertEqual(best_action[cell], np.argmax(exp))
+
+    # the caches of an exact solve stay within max_memory, which only costs time
+    def testMaxMemory(self):
+        script = '; '.join(['import coca, resource', 'shoe = coca.Shoe(numdecks=1)',
+                'shoe.num[2:12] = [2, 2, 2, 2, 2, 2, 2, 2, 8, 2]', 'shoe.total = 26',
+                'rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss',
+                'best_action, all_exp = coca.computeChart(shoe, rules=coca.Rules(errtol=0.0), '
+                'threads=2, exact=True, max_memory=1<<24)',
+                'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-rss)',
+                'print(repr(coca.houseEdge(shoe, all_exp, best_action=best_action)))'])
+        output = subprocess.check_output([sys.executable, '-c', script],
+                cwd=os.path.dirname(os.path.abspath(coca.__file__))).split()
+        self.assertLessEqual(int(output[0]), 1<<14) # in kB
+        self.assertAlmostEqual(float(output[1]), -0.014502189117693206, places=12)
+
+
+class SplitTest(unittest.TestCase):
+
+    # split EVs from the engine before splits shared their sub-hands,
+    # solved exactly on an infinite shoe: pairs of 2s and of aces by dealer card
+    splitRows = {
+        33: [-0.0848832275553, -0.0168473329684, 0.05714879105734, 0.14873132332819,
+            0.22303216445576, 0.00504373344049, -0.17410923184247, -0.3651211965672,
+            -0.6006117535218, -0.89695125359078],
+        24: [0.67187322543996, 0.71770732214645, 0.7645767633696, 0.81185123362455,
+            0.86269161927483, 0.65983398981062, 0.53246097183771, 0.38957704429863,
+            0.18156934658343, -0.2478384918276],
+    }
+
+    # and as (player cards, dealer card, split EV) on a two-suit shoe, where
+    # tens can be split again and the deal is taken out of the shoe
+    splitHands = [([10, 10], 6, 0.4944657707522829), ([11, 11], 10, 0.24001505740636192)]
+
+    def testChartRows(self):
+        best_action, all_exp = coca.computeChart(coca.Shoe(numdecks=-1), exact=True)
+        for row, exp in self.splitRows.items():
+            self.assertLess(np.abs(all_exp[:,row,coca.SPLIT]-exp).max(), 1.0e-12)
+
+    def testFiniteShoe(self):
+        for cards, dealer_card, exp in self.splitHands:
+            shoe = coca.Shoe(numdecks=1)
+            for c in coca.allCards:
+                shoe.num[c] = 8 if c == 10 else 2
+            shoe.total = 26
+            my_hand = coca.Hand()
+            dealer_hand = coca.Hand()
+            coca.dealCardToHand(shoe, dealer_hand, dealer_card, way='choose')
+            for card in cards:
+                coca.dealCardToHand(shoe, my_hand, card, way='choose')
+            action, all_exp = coca.getAction(shoe, dealer_hand, my_hand,
+                    rules=coca.Rules(errtol=0.0))
+            self.assertAlmostEqual(all_exp[coca.SPLIT], exp, places=12)
+
+
+class RenderChartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    # renderChart() writes a PNG without pyplot or a display,
+    # with and without contour marks over the labels
+    def testPNG(self):
+        import cocaplot
+        best_action, all_exp = coca.computeChart(coca.Shoe(numdecks=-1),
+                rules=coca.Rules(errtol=1.0e-3))
+        path = os.path.join(self.tmpdir, 'chart.png')
+        cocaplot.renderChart(path, best_action, all_exp, title='test')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(8), b'\x89PNG\r\n\x1a\n')
+        self.assertGreater(os.path.getsize(path), 1000)
+
+        fig = cocaplot.Figure(figsize=(10, 17))
+        cocaplot.FigureCanvasAgg(fig)
+        ax = cocaplot.drawChart(fig, best_action, textarr=best_action,
+                textfmt=(lambda x, a: cocaplot.actionLetters[a]),
+                contours=([(0, 0)], [(1, 0)]))
+        self.assertEqual(len(ax), 3)
+        fig.savefig(path)
+        self.assertGreater(os.path.getsize(path), 1000)
+
+
+class DeviationTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'deviations.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    # a table with a single true count bin, where every cell says action
+    def makeTable(self, action, rules):
+        np.savez(self.path, system='hilo', decks=np.array([6], dtype=np.int32),
+                bins=np.array([0.0]), samples=np.ones((1, 1), dtype=np.int64),
+                compositions=np.zeros((1, 1, 10)),
+                actions=action*np.ones((1, 1, 10, 34), dtype=np.int8),
+                exps=np.zeros((1, 1, 10, 34, 6), dtype=np.float32),
+                rules=json.dumps(coca.rulesArgs(rules), sort_keys=True))
+        return coca.loadDeviationTable(self.path)
+
+    def hands(self, dealer_card, cards):
+        dealer = coca.Hand()
+        dealer.addCard(dealer_card)
+        hand = coca.Hand()
+        for card in cards:
+            hand.addCard(card)
+        return dealer, hand
+
+    # actions that are not allowed fall back as in lookupActions()
+    def testFallback(self):
+        shoe = coca.Shoe(numdecks=6)
+        table = self.makeTable(coca.DOUBLE, coca.Rules())
+        self.assertEqual(table.lookup(shoe, *self.hands(6, [5, 6]))[0], coca.DOUBLE)
+        self.assertEqual(table.lookup(shoe, *self.hands(6, [2, 3, 6]))[0], coca.HIT)
+        table = self.makeTable(coca.SURRENDER, coca.Rules())
+        self.assertEqual(table.lookup(shoe, *self.hands(10, [10, 6]))[0], coca.SURRENDER)
+        self.assertEqual(table.lookup(shoe, *self.hands(10, [10, 2, 4]))[0], coca.HIT)
+        self.assertEqual(table.lookup(shoe, *self.hands(10, [10, 2, 5]))[0], coca.STAND)
+        table = self.makeTable(coca.SPLIT, coca.Rules(allowed_actions=[1,1,1,0,1,0]))
+        self.assertEqual(table.lookup(shoe, *self.hands(6, [8, 8]))[0], coca.HIT)
+
+    # on a random chart, every two-card hand gets the action and EVs of lookupActions()
+    def testRandomChart(self):
+        picks = np.random.RandomState(2)
+        actions = picks.randint(0, 5, size=(10, 34)).astype(np.int8)
+        exps = picks.randn(10, 34, 6).astype(np.float32)
+        table = self.makeTable(coca.HIT, coca.Rules())
+        table.actions[0,0] = actions
+        table.exps[0,0] = exps
+        shoe = coca.Shoe(numdecks=6)
+        for up in coca.allCards:
+            for c0 in coca.allCards:
+                for c1 in coca.allCards[c0-2:]:
+                    dealer, hand = self.hands(up, [c0, c1])
+                    action, cell = table.lookup(shoe, dealer, hand)
+                    if hand.points > 19 and not hand.softness:
+                        self.assertEqual((action, cell), (coca.STAND, None))
+                        continue
+                    expected, exp = coca.lookupActions(up, hand.points, hand.softness,
+                            hand.ispair, (actions, exps))
+                    self.assertEqual(action, expected)
+                    self.assertEqual(cell[action], exp)
+
+    # hard 20 and 21 stand, pairs of tens included, with no EVs
+    def testHardTwenty(self):
+        shoe = coca.Shoe(numdecks=6)
+        table = self.makeTable(coca.SPLIT, coca.Rules())
+        for cards in [[10, 10], [10, 4, 6], [10, 5, 6]]:
+            action, exps = table.lookup(shoe, *self.hands(6, cards))
+            self.assertEqual(action, coca.STAND)
+            self.assertIsNone(exps)
+
+
+class EffectOfRemovalTest(unittest.TestCase):
+
+    # burning an unseen card does not change a fixed strategy's game, so the
+    # game EORs of a full deck, weighted by the number of each card, sum to 0.
+    # A single suit keeps the exact solve quick.
+    def testFullDeckSum(self):
+        shoe = coca.Shoe(numdecks=1)
+        for c in coca.allCards:
+            shoe.num[c] = 4 if c == 10 else 1
+        shoe.total = 13
+        strategy = coca.Strategy(type='table', actions=coca.tables['default_table'][0])
+        cells, game = coca.effectOfRemoval(shoe, strategy=strategy, exact=True)
+        self.assertTrue(np.all(np.isfinite(game)))
+        self.assertLess(abs(np.dot(shoe.num[2:12], game)), 1.0e-10)
+
+
+if __name__ == '__main__':
+    unittest.main()